@@ -1,22 +1,29 @@
 from typing import TypedDict, Literal, Optional
 from langgraph.graph import StateGraph, END
 from langgraph.types import Command
+from langgraph.config import get_stream_writer
 from langsmith import traceable
 from datetime import datetime
 from typing import TypedDict, List, Dict, Any
-import json
 
-from app.config import DATA_DIR
 from app.services.gemini import call_gemini_llm
-from app.services.utils import get_conversation, save_conversation, convert_markdown_for_google_chat
-from app.services.KnowledgeBaseFiltering import get_relevant_incidents_weighted_context
+from app.services.llm_resilience import LLM_BREAKER
+from app.services.llm_scheduler import INTERACTIVE
+from app.services.answer_cache import ANSWER_CACHE
+from app.services.utils import convert_markdown_for_google_chat
+from app.services.conversation_history import prepare_history, append_turns, schedule_summary, record_prompt_size
+from app.services.KnowledgeBaseFiltering import score_incidents_weighted_context
+from app.services.context_packer import pack_context
 from app.services.hybrid_search import buscar_hibrido
-from app.services.KnowledgeBaseFiltering import initialize_model_and_kb, rebuild_embeddings
+from app.services.KnowledgeBaseFiltering import initialize_model_and_kb, EMBEDDING_CACHE_FILE
 from app.services.hybrid_search import get_kb_item_by_id
+from app.services import kb_service, kb_reload, metrics  # kb_reload se suscribe a kb_service al importarse
 
 
 MIN_COSINE_SIMILARITY = 0.80
 MIN_HYBRID_SCORE = 0.55
+# Similitud mínima con un paso concreto para señalarlo al usuario en el modo híbrido.
+MIN_STEP_SIMILARITY = 0.85
 
 class SupportState(TypedDict, total=False):
     user_message: str
@@ -36,6 +43,15 @@ class SupportState(TypedDict, total=False):
     output: Optional[str]
     action: Optional[Literal["ticket", "none"]]
 
+    # Con stream=True, GenerativeResponse emite {"token": fragmento} por el canal "custom"
+    # del grafo (astream con stream_mode="custom") según llegan del LLM, y {"reset": True}
+    # si el LLM falla a mitad y la respuesta pasa al modo híbrido.
+    stream: bool
+
+    # Prioridad de la llamada al LLM en el planificador: "interactive" (por defecto) o
+    # "batch" para benchmarks y procesos por lotes.
+    priority: str
+
 @traceable(name="RouteByRole")
 async def route_by_role(state: SupportState) -> Command:
     if state.get("role") == "tech":
@@ -47,6 +63,10 @@ async def route_by_response_mode(state: SupportState) -> Command:
     state["trace"] = f"routing:{state.get('response_mode')}"
 
     mode = state.get("response_mode", "generative")
+    if mode != "hybrid" and LLM_BREAKER.is_open():
+        # Gemini está fallando: se responde con la búsqueda local en vez de esperar a los timeouts.
+        metrics.inc("llm_fallbacks", reason="breaker_open")
+        return Command(goto="HybridResponse")
     return Command(goto="HybridResponse" if mode == "hybrid" else "GenerativeResponse")
 
 @traceable(name="GenerativeResponse")
@@ -54,14 +74,14 @@ async def generative_agent_node(state: SupportState) -> Command:
     user_message = state["user_message"]
     user_email = state["user_email"]
 
-    relevant_incidents = get_relevant_incidents_weighted_context(
+    retrieval = score_incidents_weighted_context(
         user_email=user_email,
         query=user_message,
         top_n=10,
         decay_factor=0.9
     )
 
-    if not relevant_incidents:
+    if not retrieval.scored:
         return Command(
             goto=END,
             update={
@@ -74,20 +94,8 @@ async def generative_agent_node(state: SupportState) -> Command:
             }
         )
 
-    conversation_total = get_conversation(user_email)
-    prev = conversation_total.get("conversation", []) if isinstance(conversation_total, dict) else []
-
-    def _coerce_role(r: str) -> str:
-        return "user" if r == "user" else "model"
-
-    prev_clean = [
-        {
-            "role": _coerce_role(m.get("role", "user")),
-            "content": m.get("content", "")
-        }
-        for m in prev
-        if m.get("role") != "system"
-    ]
+    packed = pack_context(retrieval)
+    history = prepare_history(user_email)
 
     system_msg = {
         "role": "system",
@@ -98,7 +106,7 @@ async def generative_agent_node(state: SupportState) -> Command:
                 2. Guía de conocimiento  
                    • Responde **exclusivamente** con la información contenida en la guía de soporte.
                    Basado en el contexto de la conversación, la siguiente información de la base de conocimiento es la más pertinente: 
-                     \"\"\"{json.dumps(relevant_incidents, indent=4, ensure_ascii=False)}\"\"\"
+                     \"\"\"{packed.text}\"\"\"
 
                 3. Estilo y tono  
                    • Habla siempre en **segunda persona del singular**.  
@@ -123,12 +131,38 @@ async def generative_agent_node(state: SupportState) -> Command:
         "timestamp": datetime.now().isoformat()
     }
 
-    conversation = [system_msg] + prev_clean + [{
+    conversation = [system_msg] + history + [{
         "role": "user",
         "content": user_message
     }]
 
-    parsed = await call_gemini_llm(conversation)
+    on_token = None
+    streamed = []
+    if state.get("stream"):
+        writer = get_stream_writer()
+
+        def on_token(token: str) -> None:
+            streamed.append(token)
+            writer({"token": token})
+
+    # Sin conversación previa la respuesta solo depende de la consulta y de las incidencias.
+    cacheable = not history
+    parsed = ANSWER_CACHE.get(packed.ids, retrieval.query, retrieval.kb_state) if cacheable else None
+    if parsed is not None:
+        if on_token is not None:
+            on_token(parsed.get("Response", ""))
+    else:
+        record_prompt_size(system_msg, history, user_message)
+        parsed = await call_gemini_llm(conversation, on_token=on_token, priority=state.get("priority", INTERACTIVE))
+        if isinstance(parsed, dict) and parsed.get("fallback"):
+            # Sin respuesta del LLM (reintentos agotados o cola saturada): mejor la guía local que un mensaje fijo.
+            metrics.inc("llm_fallbacks", reason="llm_error")
+            if streamed:
+                # El streaming se cortó a medias: el cliente descarta el texto parcial antes de la respuesta híbrida.
+                writer({"reset": True})
+            return Command(goto="HybridResponse")
+        if cacheable and isinstance(parsed, dict) and parsed.get("Response"):
+            ANSWER_CACHE.put(packed.ids, retrieval.query, retrieval.kb_state, parsed)
 
     response_text = convert_markdown_for_google_chat(
         parsed.get("Response", "")
@@ -138,17 +172,15 @@ async def generative_agent_node(state: SupportState) -> Command:
 
     llm_solved = parsed.get("solved", True)
 
-    save_conversation(
+    append_turns(
         user_email,
-        {
-            "conversation": conversation + [
-                {"role": "model", "content": response_text}
-            ],
-            "Incidents": [
-                e["id"] for e in relevant_incidents if "id" in e
-            ]
-        }
+        [
+            {"role": "user", "content": user_message},
+            {"role": "model", "content": response_text}
+        ],
+        packed.ids
     )
+    schedule_summary(user_email)
 
     if not llm_solved:
         return Command(
@@ -227,12 +259,20 @@ async def hybrid_response_node(state: SupportState) -> Command:
             texto += f"- {p}\n"
         texto += "\n"
 
+    paso_destacado = None
+    if len(pasos) > 1 and mejor.get("score_step", 0.0) >= MIN_STEP_SIMILARITY:
+        paso_destacado = mejor["best_step"] + 1
+
     if pasos:
+        if paso_destacado:
+            titulo = pasos[paso_destacado - 1].get("title", "")
+            texto += f"👉 Por lo que describes, empieza por el **Paso {paso_destacado}: {titulo}**.\n\n"
         texto += "**Pasos para resolver la incidencia:**\n\n"
         for i, step in enumerate(pasos, 1):
             titulo = step.get("title", "")
             accion = step.get("user_action", "")
-            texto += f"**Paso {i}: {titulo}**\n{accion}\n\n"
+            marca = "👉 " if i == paso_destacado else ""
+            texto += f"{marca}**Paso {i}: {titulo}**\n{accion}\n\n"
     else:
         texto += "⚠️ Esta incidencia no tiene pasos detallados.\n\n"
 
@@ -252,19 +292,7 @@ async def ticket_node(state: SupportState) -> Command:
 
 @traceable(name="KB_SaveEntry")
 async def kb_save_entry_node(state: SupportState) -> Command:
-    from app.services.KnowledgeBaseFiltering import rebuild_embeddings
-    import json, os
-
-    KB_PATH = DATA_DIR / "KnowledgeBase.json"
-    KB_PATH.parent.mkdir(exist_ok=True)
-
-    if KB_PATH.exists():
-        with open(KB_PATH, "r", encoding="utf-8") as f:
-            kb = json.load(f)
-    else:
-        kb = []
-
-    kb.append({
+    kb_service.add_entry({
         "id": state["id"],
         "title": state["title"],
         "description_problem": state["description_problem"],
@@ -273,11 +301,8 @@ async def kb_save_entry_node(state: SupportState) -> Command:
         "escalation_criteria": state.get("escalation_criteria", ""),
         "keywords_tags": state.get("keywords_tags", [])
     })
-
-    with open(KB_PATH, "w", encoding="utf-8") as f:
-        json.dump(kb, f, indent=4, ensure_ascii=False)
-
-    rebuild_embeddings()
+    # El alta queda en el diario de la KB y kb_reload, suscrito a las generaciones nuevas,
+    # codifica solo esta entrada y publica los índices actualizados.
 
     return Command(
         goto=END,
@@ -286,7 +311,7 @@ async def kb_save_entry_node(state: SupportState) -> Command:
 
 
 def build_support_graph():
-    initialize_model_and_kb(str(DATA_DIR / "kb_embeddings.json"))
+    initialize_model_and_kb(EMBEDDING_CACHE_FILE)
 
     graph = StateGraph(SupportState)
 
@@ -0,0 +1,149 @@
+import json
+import statistics
+import time
+
+import numpy as np
+import torch
+
+from app.services import KnowledgeBaseFiltering as kbf
+from app.services import hybrid_search, kb_service
+from app.services.bm25_index import SparseBM25
+from app.services.model_registry import model_tag
+from app.services.query_cache import QUERY_EMBEDDING_CACHE
+from app.services.vector_index import build_vector_index, top_k_indices
+
+"""
+Microbenchmark del coste por consulta fuera del encoder, con KBs sintéticas de 1k, 10k
+y 100k entradas. Los embeddings de las consultas se dejan en la caché antes de medir,
+así que el transformer nunca se ejecuta: solo se mide búsqueda, selección top-k y
+resolución de ids. Se compara además con las búsquedas lineales que había antes.
+"""
+
+SIZES = [1000, 10000, 100000]
+DIM = 768
+N_QUERIES = 200
+TOP_N = 10
+
+WORDS = [
+    "impresora", "vpn", "correo", "red", "servidor", "usuario", "acceso", "error",
+    "configuración", "conexión", "aplicación", "sistema", "ordenador", "pantalla",
+    "contraseña", "teclado", "licencia", "carpeta", "permiso", "certificado",
+    "actualización", "bloqueo", "sesión", "archivo", "monitor", "wifi", "portátil"
+]
+
+
+def synthetic_kb(n: int, rng: np.random.Generator) -> list:
+    def words(k):
+        return [WORDS[i] for i in rng.integers(0, len(WORDS), k)]
+
+    return [
+        {
+            "id": f"INC-{i:06d}",
+            "title": " ".join(words(4)),
+            "description_problem": " ".join(words(20)),
+            "symptoms": words(5),
+            "keywords_tags": words(3)
+        }
+        for i in range(n)
+    ]
+
+
+def unit_vectors(n: int, rng: np.random.Generator) -> np.ndarray:
+    vectors = rng.standard_normal((n, DIM)).astype(np.float32)
+    return vectors / np.linalg.norm(vectors, axis=1, keepdims=True)
+
+
+def median_us(fn, args_list) -> float:
+    timings = []
+    for args in args_list:
+        start = time.perf_counter()
+        fn(*args)
+        timings.append((time.perf_counter() - start) * 1e6)
+    return statistics.median(timings)
+
+
+def install_snapshots(kb_state, rng: np.random.Generator) -> None:
+    matrix = unit_vectors(len(kb_state.entries), rng)
+    kbf._publish(kbf.KBSnapshot(
+        version=1,
+        fingerprint=f"bench-{len(matrix)}",
+        kb_state=kb_state,
+        index=build_vector_index(matrix, None, f"bench-{len(matrix)}"),
+        built_at=time.time()
+    ))
+
+    filtered = kb_state.hybrid_entries
+    hybrid_matrix = unit_vectors(len(filtered), rng)
+    hybrid_search._publish(hybrid_search.HybridSnapshot(
+        version=1,
+        fingerprint=f"bench-{len(filtered)}",
+        kb_state=kb_state,
+        kb_filtrada=filtered,
+        vocab=frozenset(WORDS),
+        texts=kb_state.hybrid_texts,
+        bm25=SparseBM25([text.lower().split() for text in kb_state.hybrid_texts]),
+        index=build_vector_index(hybrid_matrix, None, f"bench-{len(filtered)}"),
+        built_at=time.time()
+    ))
+
+
+def main():
+    rng = np.random.default_rng(0)
+    # El encoder no debe ejecutarse: todas las consultas están ya en la caché.
+    kbf.model = hybrid_search.model = object()
+
+    queries = [" ".join(WORDS[i] for i in rng.integers(0, len(WORDS), 6)) for _ in range(N_QUERIES)]
+    generative_tag, hybrid_tag = model_tag(kbf.DEFAULT_MODEL_NAME), model_tag(hybrid_search.MODEL_NAME)
+
+    results = []
+    for n in SIZES:
+        entries = synthetic_kb(n, rng)
+        kb_state = kb_service._build_state(entries, 1, f"bench-{n}")
+        install_snapshots(kb_state, rng)
+
+        QUERY_EMBEDDING_CACHE.clear()
+        for q, vector in zip(queries, unit_vectors(N_QUERIES, rng)):
+            QUERY_EMBEDDING_CACHE.put(generative_tag, q, torch.from_numpy(vector))
+            augmented = hybrid_search.augment_query(hybrid_search.normalize_query(q))
+            QUERY_EMBEDDING_CACHE.put(hybrid_tag, augmented, vector)
+
+        ids = [(entries[i]["id"],) for i in rng.integers(0, n, N_QUERIES)]
+        past = [(set(entries[i]["id"] for i in rng.integers(0, n, 5)),) for _ in range(N_QUERIES)]
+        scores = [(rng.standard_normal(n).astype(np.float32),) for _ in range(20)]
+
+        row = {
+            "entries": n,
+            "id_lookup_linear_us": median_us(
+                lambda incident_id: next(item for item in entries if item["id"] == incident_id), ids
+            ),
+            "id_lookup_index_us": median_us(kb_state.get, ids),
+            "past_incidents_linear_us": median_us(
+                lambda incidents: [item for item in entries if item["id"] in incidents], past
+            ),
+            "past_incidents_index_us": median_us(
+                lambda incidents: [entries[p] for p in sorted({kb_state.by_id[i] for i in incidents})], past
+            ),
+            "topk_sorted_list_us": median_us(
+                lambda s: sorted(zip(entries, s.tolist()), key=lambda x: x[1], reverse=True)[:TOP_N], scores
+            ),
+            "topk_argpartition_us": median_us(lambda s: top_k_indices(s, TOP_N), scores),
+            "generative_query_us": median_us(
+                lambda q: kbf.get_relevant_incidents_weighted_context("bench", q, top_n=TOP_N), [(q,) for q in queries]
+            ),
+            "hybrid_query_us": median_us(hybrid_search.buscar_hibrido, [(q,) for q in queries])
+        }
+        results.append(row)
+
+        print(f"\n▶ {n} entradas")
+        for key, value in row.items():
+            if key != "entries":
+                print(f"  {key:<26} {value:>10.1f} µs")
+
+    with open("benchmark_lookup_results.json", "w", encoding="utf-8") as f:
+        json.dump(results, f, ensure_ascii=False, indent=2)
+
+    print("\nMicrobenchmark completado. Resultados guardados.")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,109 @@
+import csv
+import json
+import time
+
+import numpy as np
+
+from app.services import KnowledgeBaseFiltering as kbf
+from app.services import hybrid_search
+from app.services.compact_embeddings import CompactEmbeddings
+from app.services.vector_index import FlatIndex
+
+K_VALUES = [1, 3, 10]
+
+# (dtype, dimensión reducida, método de reducción)
+CONFIGS = [
+    ("float16", 0, ""),
+    ("int8", 0, ""),
+    ("float32", 256, "pca"),
+    ("int8", 256, "pca"),
+    ("float32", 256, "truncate"),
+]
+
+
+def recall_at_k(reference: FlatIndex, candidate: FlatIndex, queries: np.ndarray, k: int) -> float:
+    hits = 0
+    for q in queries:
+        expected = set(reference.search(q, k)[0].tolist())
+        found = set(candidate.search(q, k)[0].tolist())
+        hits += len(expected & found) / max(1, len(expected))
+    return hits / len(queries)
+
+
+def evaluate(engine: str, matrix: np.ndarray, queries: np.ndarray) -> list:
+    reference = FlatIndex(CompactEmbeddings.from_matrix(matrix, "float32", 0, ""))
+    base_mb = matrix.nbytes / (1024 * 1024)
+    rows = []
+
+    print(f"\n▶ {engine}: {matrix.shape[0]} vectores x {matrix.shape[1]} dims ({base_mb:.2f} MB en float32)")
+
+    for dtype, dim, reduction in CONFIGS:
+        if dim and dim >= matrix.shape[1]:
+            continue
+        store = CompactEmbeddings.from_matrix(matrix, dtype, dim, reduction)
+        index = FlatIndex(store)
+
+        t0 = time.perf_counter()
+        for q in queries:
+            index.search(q, max(K_VALUES))
+        latency_ms = (time.perf_counter() - t0) * 1000 / len(queries)
+
+        row = {
+            "engine": engine,
+            "dtype": dtype,
+            "dim": store.shape[1],
+            "reduction": reduction or "-",
+            "mb": store.nbytes / (1024 * 1024),
+            "latency_ms": latency_ms
+        }
+        for k in K_VALUES:
+            recall = recall_at_k(reference, index, queries, k)
+            row[f"recall@{k}"] = recall
+            row[f"recall_loss@{k}"] = 1.0 - recall
+        rows.append(row)
+
+        recalls = " ".join(f"R@{k}={row[f'recall@{k}']:.3f}" for k in K_VALUES)
+        print(
+            f"  ✓ {dtype:<8} dim={row['dim']:<4} {row['reduction']:<9} "
+            f"{row['mb']:.2f} MB ({row['mb'] / base_mb * 100:.0f}%) {recalls} ({latency_ms:.2f} ms/consulta)"
+        )
+
+    return rows
+
+
+def main():
+    with open("benchmark_queries.csv", encoding="utf-8") as f:
+        queries = [row["query"] for row in csv.DictReader(f)]
+
+    results = []
+
+    kbf.initialize_model_and_kb(kbf.EMBEDDING_CACHE_FILE)
+    # El snapshot solo guarda el formato compacto; la referencia float32 sale de la caché
+    # en disco (ya alineada con la KB, no se codifica nada).
+    kb_state = kbf.KB_SNAPSHOT.kb_state
+    generative_matrix, _ = kbf.build_corpus_embeddings(kb_state.entries, kbf.EMBEDDING_CACHE_FILE, kb_state.generative_texts)
+    generative_matrix = np.asarray(generative_matrix, dtype=np.float32)
+    generative_queries = np.stack([kbf.encode_query(q).cpu().numpy() for q in queries])
+    results += evaluate("generative", generative_matrix, generative_queries)
+
+    hybrid_search.initialize_hybrid_search()
+    hybrid_matrix = hybrid_search.model.encode(
+        hybrid_search.texts,
+        normalize_embeddings=True,
+        convert_to_numpy=True,
+        show_progress_bar=False
+    ).astype(np.float32)
+    hybrid_queries = np.stack([
+        hybrid_search.encode_query(hybrid_search.augment_query(hybrid_search.normalize_query(q)))
+        for q in queries
+    ])
+    results += evaluate("hybrid", hybrid_matrix, hybrid_queries)
+
+    with open("benchmark_retrieval_results.json", "w", encoding="utf-8") as f:
+        json.dump(results, f, ensure_ascii=False, indent=2)
+
+    print("\nBenchmark de recuperación completado. Resultados guardados.")
+
+
+if __name__ == "__main__":
+    main()
@@ -29,7 +29,8 @@ async def run_query(query: str, mode: str):
         "user_message": query,
         "user_email": "benchmark@test.com",
         "role": "user",
-        "response_mode": mode
+        "response_mode": mode,
+        "priority": "batch"
     }
 
     t0 = time.perf_counter()
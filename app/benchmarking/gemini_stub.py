@@ -0,0 +1,158 @@
+import argparse
+import asyncio
+import json
+import os
+import random
+import statistics
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+"""
+Servidor local que imita generateContent y streamGenerateContent (SSE) de la API de
+Gemini, con una latencia fija, para probar el cliente sin red ni cuota. Con --bench lanza
+además N llamadas concurrentes con call_gemini_llm contra él y mide la latencia y el
+throughput; con --stream, también el tiempo hasta el primer token. Con --fail-rate una parte de las
+respuestas son 503, para ver los reintentos y el circuit breaker.
+
+    python -m app.benchmarking.gemini_stub --port 8765 --latency 0.5
+    python -m app.benchmarking.gemini_stub --bench 64 --latency 0.5 --stream
+    python -m app.benchmarking.gemini_stub --bench 64 --fail-rate 0.3
+
+Para usarlo desde la app: GEMINI_BASE_URL=http://127.0.0.1:8765/v1beta
+"""
+
+STUB_REPLY = "Prueba a reiniciar el equipo y vuelve a conectarte a la VPN."
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    # HTTP/1.1 para que el cliente pueda reutilizar las conexiones (keep-alive).
+    protocol_version = "HTTP/1.1"
+    latency = 0.5
+    fail_rate = 0.0
+    reply = STUB_REPLY
+
+    def do_POST(self):
+        length = int(self.headers.get("Content-Length") or 0)
+        self.rfile.read(length)
+        if random.random() < self.fail_rate:
+            time.sleep(self.latency / 10)
+            self.send_error(503)
+            return
+        method = self.path.split("?")[0].rsplit(":", 1)[-1]
+        if method == "streamGenerateContent":
+            self._stream()
+            return
+        if method != "generateContent":
+            self.send_error(404)
+            return
+        time.sleep(self.latency)
+        body = json.dumps(self._payload(self.reply)).encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    @staticmethod
+    def _payload(text: str) -> dict:
+        return {"candidates": [{"content": {"role": "model", "parts": [{"text": text}]}, "finishReason": "STOP"}]}
+
+    def _stream(self):
+        # Eventos SSE palabra a palabra; la latencia total se reparte entre los fragmentos.
+        words = self.reply.split(" ")
+        chunks = [word + (" " if i < len(words) - 1 else "") for i, word in enumerate(words)]
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Connection", "close")
+        self.end_headers()
+        self.close_connection = True
+        for chunk in chunks:
+            time.sleep(self.latency / len(chunks))
+            self.wfile.write(f"data: {json.dumps(self._payload(chunk))}\r\n\r\n".encode("utf-8"))
+            self.wfile.flush()
+
+    def log_message(self, format, *args):
+        pass
+
+
+class StubServer(ThreadingHTTPServer):
+    daemon_threads = True
+    request_queue_size = 256
+
+
+def start_stub(port: int = 0, latency: float = 0.5, fail_rate: float = 0.0) -> ThreadingHTTPServer:
+    """Arranca el servidor en un hilo; server.server_address[1] es el puerto elegido."""
+    handler = type("Handler", (StubHandler,), {"latency": latency, "fail_rate": fail_rate})
+    server = StubServer(("127.0.0.1", port), handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+async def run_bench(n_calls: int, stream: bool = False) -> None:
+    from app.services import metrics
+    from app.services.gemini import GEMINI_CLIENT, call_gemini_llm
+    from app.services.llm_scheduler import BATCH
+
+    first_tokens = []
+    fallbacks = []
+
+    async def one(i: int) -> float:
+        start = time.perf_counter()
+        seen = []
+
+        def on_token(token: str) -> None:
+            if not seen:
+                first_tokens.append(time.perf_counter() - start)
+            seen.append(token)
+
+        result = await call_gemini_llm(
+            [{"role": "user", "content": f"consulta {i}"}],
+            on_token=on_token if stream else None,
+            priority=BATCH
+        )
+        assert result["Response"] == STUB_REPLY or result.get("fallback"), result
+        if result.get("fallback"):
+            fallbacks.append(i)
+        return time.perf_counter() - start
+
+    start = time.perf_counter()
+    latencies = await asyncio.gather(*(one(i) for i in range(n_calls)))
+    elapsed = time.perf_counter() - start
+    await GEMINI_CLIENT.aclose()
+    print(
+        f"{n_calls} calls in {elapsed:.2f} s ({n_calls / elapsed:.1f} calls/s), "
+        f"p50 {statistics.median(latencies) * 1000:.0f} ms, max {max(latencies) * 1000:.0f} ms"
+    )
+    if first_tokens:
+        print(f"Time to first token: p50 {statistics.median(first_tokens) * 1000:.0f} ms, max {max(first_tokens) * 1000:.0f} ms")
+    retries = sum(v for k, v in metrics.snapshot()["counters"].items() if k.startswith("llm_retries"))
+    print(f"Retries: {retries:.0f}, fallbacks: {len(fallbacks)}")
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--latency", type=float, default=0.5)
+    parser.add_argument("--bench", type=int, default=0, help="número de llamadas concurrentes")
+    parser.add_argument("--stream", action="store_true", help="mide también el tiempo hasta el primer token")
+    parser.add_argument("--fail-rate", type=float, default=0.0, help="fracción de respuestas 503")
+    args = parser.parse_args()
+
+    if args.bench:
+        server = start_stub(0, args.latency, args.fail_rate)
+        os.environ["GEMINI_BASE_URL"] = f"http://127.0.0.1:{server.server_address[1]}/v1beta"
+        asyncio.run(run_bench(args.bench, args.stream))
+        server.shutdown()
+        return
+
+    server = start_stub(args.port, args.latency, args.fail_rate)
+    print(f"Gemini stub listening on http://127.0.0.1:{args.port}/v1beta (latency {args.latency} s)")
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
@@ -14,7 +14,7 @@ from langchain_core.runnables import RunnableConfig
 from app.config import DATA_DIR
 from app.agents.support_graph import build_support_graph
 #from app.agents.kb_graph import build_kb_graph
-from app.services.KnowledgeBaseFiltering import initialize_model_and_kb
+from app.services.KnowledgeBaseFiltering import initialize_model_and_kb, EMBEDDING_CACHE_FILE
 from app.services.auth import authenticate
 from app.agents.ticket_agent import TicketAgent
 
@@ -27,7 +27,8 @@ def load_support_graph():
 
 SUPPORT_GRAPH = load_support_graph()
 
-async def process_message(user_message: str, prev_state: dict) -> dict:
+async def process_message(user_message: str, prev_state: dict, on_text=None) -> dict:
+    """Con on_text, la respuesta generativa llega en streaming: on_text(texto acumulado)."""
     state = {
         **prev_state,
         "user_message": user_message,
@@ -37,17 +38,26 @@ async def process_message(user_message: str, prev_state: dict) -> dict:
             "generative"
             if st.session_state.modo_respuesta == "IA Generativa"
             else "hybrid"
-        )
+        ),
+        "stream": on_text is not None
     }
-
-    result = await SUPPORT_GRAPH.ainvoke(
-        state,
-        config=RunnableConfig(
-            run_name="Chat soporte",
-            metadata={"usuario": st.session_state.user_email}
-        )
+    config = RunnableConfig(
+        run_name="Chat soporte",
+        metadata={"usuario": st.session_state.user_email}
     )
 
+    if on_text is None:
+        return await SUPPORT_GRAPH.ainvoke(state, config=config)
+
+    text = ""
+    result = state
+    async for mode, chunk in SUPPORT_GRAPH.astream(state, config=config, stream_mode=["custom", "values"]):
+        if mode == "values":
+            result = chunk
+        else:
+            # reset: el LLM falló a mitad y la respuesta llegará por otra vía.
+            text = "" if chunk.get("reset") else text + chunk.get("token", "")
+            on_text(text)
     return result
 
 if "inicio" not in st.session_state:
@@ -104,7 +114,7 @@ if not st.session_state.logged_in:
 
             if user["role"] == "tech":
                 initialize_model_and_kb(
-                    str(DATA_DIR / "kb_embeddings.json"),
+                    EMBEDDING_CACHE_FILE,
                     force_reload=True
                 )
 
@@ -188,18 +198,14 @@ if st.session_state.role == "tech":
                 )
             )
             st.success(out.get("output", "✅ Entrada procesada correctamente."))
-            initialize_model_and_kb(str(DATA_DIR / "kb_embeddings.json"), force_reload=True)
 
         except Exception as e:
             st.error(f"❌ Error guardando la entrada: {e}")
 
     if st.button("Ver base de conocimiento"):
-        from app.services.KnowledgeBaseFiltering import (
-            KB_CORPUS_DATA,
-            initialize_model_and_kb
-        )
+        from app.services import kb_service
 
-        initialize_model_and_kb(str(DATA_DIR / "kb_embeddings.json"))
+        KB_CORPUS_DATA = kb_service.current().entries
 
         if not KB_CORPUS_DATA:
             st.warning("La base de conocimiento está vacía.")
@@ -334,17 +340,52 @@ modo = st.radio(
 st.session_state.modo_respuesta = modo
 
 
+def bot_bubble(content: str) -> str:
+    return f"""
+        <div class="message bot">
+            <div class="avatar">🤖</div>
+            <div class="bubble bot">{content}</div>
+        </div>"""
+
+
+def render_message(msg: dict) -> None:
+    if msg["role"] == "user":
+        st.markdown(f"""
+        <div class="message user">
+            <div class="bubble user">{msg["content"]}</div>
+            <div class="avatar">👤</div>
+        </div>""", unsafe_allow_html=True)
+    else:
+        st.markdown(bot_bubble(msg["content"]), unsafe_allow_html=True)
+
+        if "url" in msg:
+            st.markdown(
+                f'<a href="{msg["url"]}" target="_blank">'
+                '<button style="margin:8px 0; padding:8px 16px; border:none; border-radius:8px; background-color:#1e88e5; color:white; cursor:pointer;">🔗 Abrir ticket en JIRA</button></a>',
+                unsafe_allow_html=True
+            )
+
+
+for msg in st.session_state.chat_history:
+    render_message(msg)
+
+
 user_input = st.chat_input("Escribe tu consulta aquí...")
 
 if user_input:
     st.session_state.esperando_confirmacion = False
     st.session_state.chat_history.append({"role": "user", "content": user_input})
+    render_message(st.session_state.chat_history[-1])
+    first_reply = len(st.session_state.chat_history)
+    # La respuesta se va pintando en esta burbuja según llegan los tokens.
+    stream_box = st.empty()
 
     try:
         bot_state = asyncio.run(
             process_message(
                 user_input,
-                st.session_state.graph_state
+                st.session_state.graph_state,
+                on_text=lambda text: stream_box.markdown(bot_bubble(text + " ▌"), unsafe_allow_html=True)
             )
         )
 
@@ -381,27 +422,10 @@ if user_input:
             {"role": "bot", "content": f"❌ Error: {e}"}
         )
 
+    stream_box.empty()
+    for msg in st.session_state.chat_history[first_reply:]:
+        render_message(msg)
 
-for i, msg in enumerate(st.session_state.chat_history):
-    if msg["role"] == "user":
-        st.markdown(f"""
-        <div class="message user">
-            <div class="bubble user">{msg["content"]}</div>
-            <div class="avatar">👤</div>
-        </div>""", unsafe_allow_html=True)
-    else:
-        st.markdown(f"""
-        <div class="message bot">
-            <div class="avatar">🤖</div>
-            <div class="bubble bot">{msg["content"]}</div>
-        </div>""", unsafe_allow_html=True)
-
-        if "url" in msg:
-            st.markdown(
-                f'<a href="{msg["url"]}" target="_blank">'
-                '<button style="margin:8px 0; padding:8px 16px; border:none; border-radius:8px; background-color:#1e88e5; color:white; cursor:pointer;">🔗 Abrir ticket en JIRA</button></a>',
-                unsafe_allow_html=True
-            )
 
 if st.session_state.get("pendiente_crear_ticket"):
 
@@ -11,6 +11,133 @@ PROJECT_ROOT = Path(__file__).resolve().parent.parent
 APP_DIR = PROJECT_ROOT / "app"
 DATA_DIR = APP_DIR / "data"
 
+# Construcción de embeddings de la KB
+EMBEDDING_BATCH_SIZE = int(os.getenv("EMBEDDING_BATCH_SIZE", "64"))
+EMBEDDING_WORKERS = int(os.getenv("EMBEDDING_WORKERS", "1"))
+EMBEDDING_CHECKPOINT_EVERY = int(os.getenv("EMBEDDING_CHECKPOINT_EVERY", "2048"))
+
+# Si se define, ambos motores de búsqueda comparten este encoder en lugar de cargar dos
+SHARED_ENCODER_MODEL = os.getenv("SHARED_ENCODER_MODEL", "")
+
+# Backend de inferencia de los encoders: "torch", "int8" (cuantización dinámica) u "onnx".
+# ENCODER_BACKENDS permite elegirlo por modelo: "modelo=backend;otro_modelo=backend"
+ENCODER_BACKEND = os.getenv("ENCODER_BACKEND", "torch")
+ENCODER_BACKENDS = os.getenv("ENCODER_BACKENDS", "")
+ENCODER_PARITY_TOLERANCE = float(os.getenv("ENCODER_PARITY_TOLERANCE", "0.02"))
+
+# Almacenamiento de los embeddings de la KB: "float32", "float16" o "int8", y reducción
+# opcional de dimensión ("truncate" o "pca") a EMBEDDING_REDUCED_DIM (0 = sin reducir)
+EMBEDDING_STORAGE_DTYPE = os.getenv("EMBEDDING_STORAGE_DTYPE", "float32")
+EMBEDDING_REDUCED_DIM = int(os.getenv("EMBEDDING_REDUCED_DIM", "0"))
+EMBEDDING_REDUCTION = os.getenv("EMBEDDING_REDUCTION", "pca")
+
+# Índice vectorial de la KB: "flat" (exacto) o "ivf" (aproximado)
+VECTOR_INDEX_TYPE = os.getenv("VECTOR_INDEX_TYPE", "ivf")
+VECTOR_INDEX_MIN_SIZE = int(os.getenv("VECTOR_INDEX_MIN_SIZE", "10000"))
+IVF_NLIST = int(os.getenv("IVF_NLIST", "0"))
+IVF_NPROBE = int(os.getenv("IVF_NPROBE", "16"))
+IVF_TRAIN_ITERATIONS = int(os.getenv("IVF_TRAIN_ITERATIONS", "10"))
+
+# Caché de embeddings de consultas
+QUERY_CACHE_MAX_ENTRIES = int(os.getenv("QUERY_CACHE_MAX_ENTRIES", "5000"))
+QUERY_CACHE_MAX_MB = float(os.getenv("QUERY_CACHE_MAX_MB", "64"))
+QUERY_CACHE_TTL_SECONDS = float(os.getenv("QUERY_CACHE_TTL_SECONDS", "86400"))
+QUERY_CACHE_WARMUP = int(os.getenv("QUERY_CACHE_WARMUP", "50"))
+
+# Contexto de conversación por usuario (acumulador de embeddings con decaimiento).
+# CONTEXT_STORE_PATH vacío desactiva la persistencia entre reinicios
+CONTEXT_STORE_MAX_SESSIONS = int(os.getenv("CONTEXT_STORE_MAX_SESSIONS", "10000"))
+CONTEXT_STORE_MAX_MB = float(os.getenv("CONTEXT_STORE_MAX_MB", "64"))
+CONTEXT_STORE_TTL_SECONDS = float(os.getenv("CONTEXT_STORE_TTL_SECONDS", "86400"))
+CONTEXT_STORE_PATH = os.getenv("CONTEXT_STORE_PATH", str(DATA_DIR / "context_store.npz"))
+CONTEXT_STORE_FLUSH_SECONDS = float(os.getenv("CONTEXT_STORE_FLUSH_SECONDS", "30"))
+
+# Conversaciones por usuario en SQLite (modo WAL). El conversation_store.json antiguo se
+# importa automáticamente la primera vez que se crea la base de datos
+CONVERSATION_DB_PATH = os.getenv("CONVERSATION_DB_PATH", str(DATA_DIR / "conversations.db"))
+CONVERSATION_DB_BUSY_TIMEOUT_MS = int(os.getenv("CONVERSATION_DB_BUSY_TIMEOUT_MS", "5000"))
+# Durabilidad al guardar un turno: "async" confirma en memoria y escribe en segundo plano
+# (write-behind por lotes); "sync" confirma solo tras escribir en disco
+CONVERSATION_DURABILITY = os.getenv("CONVERSATION_DURABILITY", "async")
+CONVERSATION_FLUSH_SECONDS = float(os.getenv("CONVERSATION_FLUSH_SECONDS", "1"))
+CONVERSATION_FLUSH_BATCH = int(os.getenv("CONVERSATION_FLUSH_BATCH", "64"))
+CONVERSATION_MAX_PENDING = int(os.getenv("CONVERSATION_MAX_PENDING", "2000"))
+
+# Historial que se reenvía al LLM: los turnos recientes caben en PROMPT_HISTORY_MAX_TOKENS y
+# los anteriores se resumen (en segundo plano) cuando quedan fuera al menos
+# CONVERSATION_SUMMARY_MIN_TURNS. Solo se conservan CONVERSATION_MAX_STORED_TURNS turnos
+PROMPT_HISTORY_MAX_TOKENS = int(os.getenv("PROMPT_HISTORY_MAX_TOKENS", "1500"))
+CONVERSATION_SUMMARY_MIN_TURNS = int(os.getenv("CONVERSATION_SUMMARY_MIN_TURNS", "4"))
+CONVERSATION_SUMMARY_MAX_WORDS = int(os.getenv("CONVERSATION_SUMMARY_MAX_WORDS", "150"))
+CONVERSATION_MAX_STORED_TURNS = int(os.getenv("CONVERSATION_MAX_STORED_TURNS", "100"))
+
+# Incidencias que se incluyen en el prompt generativo. Los umbrales son fracciones de la
+# mejor puntuación (el modelo generativo puntúa con producto escalar sin normalizar, así
+# que los valores absolutos no significan nada): se descartan las que quedan por debajo de
+# la mejor en más de CONTEXT_MAX_SCORE_DROP o tras un salto de más de CONTEXT_MAX_SCORE_GAP
+# entre dos consecutivas; las CONTEXT_FULL_INCIDENTS mejores van completas
+# (CONTEXT_FULL_FIELDS, CONTEXT_STEP_FIELDS) y el resto resumidas (CONTEXT_BRIEF_FIELDS),
+# hasta CONTEXT_MAX_TOKENS
+CONTEXT_MAX_TOKENS = int(os.getenv("CONTEXT_MAX_TOKENS", "3000"))
+CONTEXT_MAX_SCORE_DROP = float(os.getenv("CONTEXT_MAX_SCORE_DROP", "0.25"))
+CONTEXT_MAX_SCORE_GAP = float(os.getenv("CONTEXT_MAX_SCORE_GAP", "0.10"))
+CONTEXT_FULL_INCIDENTS = int(os.getenv("CONTEXT_FULL_INCIDENTS", "3"))
+CONTEXT_FULL_FIELDS = os.getenv(
+    "CONTEXT_FULL_FIELDS",
+    "id,title,description_problem,symptoms,initial_questions,diagnostic_steps,escalation_criteria,information_needed_for_escalation"
+)
+CONTEXT_STEP_FIELDS = os.getenv("CONTEXT_STEP_FIELDS", "step_number,title,user_action")
+CONTEXT_BRIEF_FIELDS = os.getenv("CONTEXT_BRIEF_FIELDS", "id,title,description_problem")
+# Índice de pasajes (pasos, síntomas y preguntas con embedding propio): en el prompt solo
+# van los CONTEXT_STEPS_PER_INCIDENT pasos más relevantes de cada incidencia (0 = todos)
+PASSAGE_INDEX_ENABLED = os.getenv("PASSAGE_INDEX_ENABLED", "true").lower() == "true"
+CONTEXT_STEPS_PER_INCIDENT = int(os.getenv("CONTEXT_STEPS_PER_INCIDENT", "3"))
+
+# Cambios de la KB: se apuntan en un diario junto a KnowledgeBase.json y, cada
+# KB_JOURNAL_COMPACT_EVERY cambios, se vuelcan en el JSON y el diario se vacía
+KB_JOURNAL_COMPACT_EVERY = int(os.getenv("KB_JOURNAL_COMPACT_EVERY", "200"))
+
+# Caché semántica de respuestas del modo generativo: solo en el primer turno, con las mismas
+# incidencias recuperadas y una consulta con similitud coseno >= ANSWER_CACHE_MIN_SIMILARITY
+ANSWER_CACHE_ENABLED = os.getenv("ANSWER_CACHE_ENABLED", "true").lower() == "true"
+ANSWER_CACHE_MIN_SIMILARITY = float(os.getenv("ANSWER_CACHE_MIN_SIMILARITY", "0.95"))
+ANSWER_CACHE_MAX_ENTRIES = int(os.getenv("ANSWER_CACHE_MAX_ENTRIES", "2000"))
+ANSWER_CACHE_MAX_MB = float(os.getenv("ANSWER_CACHE_MAX_MB", "32"))
+ANSWER_CACHE_TTL_SECONDS = float(os.getenv("ANSWER_CACHE_TTL_SECONDS", "86400"))
+
+# Cliente de Gemini (API REST asíncrona con pool de conexiones keep-alive). GEMINI_BASE_URL
+# puede apuntar a un servidor local de pruebas
+GEMINI_MODEL = os.getenv("GEMINI_MODEL", "gemini-2.0-flash")
+GEMINI_BASE_URL = os.getenv("GEMINI_BASE_URL", "https://generativelanguage.googleapis.com/v1beta")
+GEMINI_TIMEOUT_SECONDS = float(os.getenv("GEMINI_TIMEOUT_SECONDS", "30"))
+GEMINI_CONNECT_TIMEOUT_SECONDS = float(os.getenv("GEMINI_CONNECT_TIMEOUT_SECONDS", "5"))
+GEMINI_MAX_CONNECTIONS = int(os.getenv("GEMINI_MAX_CONNECTIONS", "20"))
+
+# Resiliencia de las llamadas al LLM: reintentos con backoff exponencial y jitter, circuit
+# breaker (el grafo pasa a modo híbrido mientras está abierto) y peticiones de cobertura
+# opcionales lanzadas tras el p95 de latencia
+LLM_MAX_RETRIES = int(os.getenv("LLM_MAX_RETRIES", "2"))
+LLM_BACKOFF_BASE_SECONDS = float(os.getenv("LLM_BACKOFF_BASE_SECONDS", "0.5"))
+LLM_BACKOFF_MAX_SECONDS = float(os.getenv("LLM_BACKOFF_MAX_SECONDS", "4"))
+LLM_BREAKER_FAILURES = int(os.getenv("LLM_BREAKER_FAILURES", "5"))
+LLM_BREAKER_RESET_SECONDS = float(os.getenv("LLM_BREAKER_RESET_SECONDS", "30"))
+LLM_HEDGE_ENABLED = os.getenv("LLM_HEDGE_ENABLED", "false").lower() == "true"
+LLM_HEDGE_MIN_DELAY_SECONDS = float(os.getenv("LLM_HEDGE_MIN_DELAY_SECONDS", "1"))
+LLM_HEDGE_MIN_SAMPLES = int(os.getenv("LLM_HEDGE_MIN_SAMPLES", "20"))
+
+# Planificador global de llamadas al LLM: máximo en vuelo, límite de ritmo (token bucket,
+# 0 lo desactiva), cola por prioridad acotada y plazo máximo de espera en ella (el chat
+# interactivo pasa entonces a modo híbrido; los lotes y resúmenes esperan más)
+LLM_MAX_IN_FLIGHT = int(os.getenv("LLM_MAX_IN_FLIGHT", "16"))
+LLM_RATE_PER_SECOND = float(os.getenv("LLM_RATE_PER_SECOND", "10"))
+LLM_RATE_BURST = int(os.getenv("LLM_RATE_BURST", "20"))
+LLM_QUEUE_MAX = int(os.getenv("LLM_QUEUE_MAX", "64"))
+LLM_QUEUE_TIMEOUT_SECONDS = float(os.getenv("LLM_QUEUE_TIMEOUT_SECONDS", "5"))
+LLM_BATCH_QUEUE_TIMEOUT_SECONDS = float(os.getenv("LLM_BATCH_QUEUE_TIMEOUT_SECONDS", "120"))
+
+# Segundos que una petición espera a que termine el calentamiento antes de devolver 503
+WARMUP_WAIT_SECONDS = float(os.getenv("WARMUP_WAIT_SECONDS", "0"))
+
 CONFIG_PATH = os.path.join(os.path.dirname(__file__), 'config.ini')
 
 if os.path.exists(CONFIG_PATH):
@@ -5,10 +5,22 @@ import os
 from configparser import ConfigParser
 import json
 
+from contextlib import asynccontextmanager
+
 from fastapi import FastAPI
+from fastapi.responses import JSONResponse
 from app.routes.chat import router as chat_router
-from app.services.KnowledgeBaseFiltering import initialize_model_and_kb
+from app.routes.admin import router as admin_router
 from app.config import DATA_DIR
+from app.services import metrics, warmup
+from app.services.query_cache import QUERY_EMBEDDING_CACHE
+from app.services.context_store import CONTEXT_STORE
+from app.services.conversation_store import CONVERSATION_STORE
+from app.services.model_registry import model_stats
+from app.services.gemini import GEMINI_CLIENT
+from app.services.answer_cache import ANSWER_CACHE
+from app.services.llm_resilience import LLM_BREAKER
+from app.services.llm_scheduler import LLM_SCHEDULER
 
 #if os.path.exists('config.ini'):
 CONFIG_PATH = os.path.join(os.path.dirname(__file__), 'config.ini')
@@ -46,17 +58,49 @@ else:
     API_KEYS = json.loads(os.getenv("API_KEYS", "{}"))
 
 
-initialize_model_and_kb(str(DATA_DIR / "kb_embeddings.json"))
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Modelos, KB y grafo se cargan en segundo plano: el servidor acepta conexiones ya.
+    warmup.start()
+    yield
+    CONTEXT_STORE.save()
+    CONVERSATION_STORE.close()
+    await GEMINI_CLIENT.aclose()
+
 
 # Crear instancia FastAPI
 app = FastAPI(
     title="API Soporte Técnico",
-    version="1.0"
+    version="1.0",
+    lifespan=lifespan
 )
 
 # Registrar las rutas del chatbot
 app.include_router(chat_router)
+app.include_router(admin_router)
 
 @app.get("/")
 def root():
-    return {"message": "✔️ API del asistente corporativo funcionando correctamente"}
\ No newline at end of file
+    return {"message": "✔️ API del asistente corporativo funcionando correctamente"}
+
+@app.get("/healthz")
+def healthz():
+    return {"status": "ok", "warmup": warmup.status()["status"]}
+
+@app.get("/readyz")
+def readyz():
+    state = warmup.status()
+    return JSONResponse(status_code=200 if warmup.is_ready() else 503, content=state)
+
+@app.get("/metrics")
+def get_metrics():
+    return {
+        **metrics.snapshot(),
+        "query_embedding_cache": QUERY_EMBEDDING_CACHE.stats(),
+        "answer_cache": ANSWER_CACHE.stats(),
+        "llm_breaker": LLM_BREAKER.stats(),
+        "llm_scheduler": LLM_SCHEDULER.stats(),
+        "context_store": CONTEXT_STORE.stats(),
+        "conversation_store": CONVERSATION_STORE.stats(),
+        "models": model_stats()
+    }
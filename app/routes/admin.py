@@ -0,0 +1,26 @@
+from fastapi import APIRouter, Depends
+from fastapi.responses import JSONResponse
+
+from ..services.utils import api_key_guard
+from ..services import kb_reload, warmup
+
+router = APIRouter(prefix="/admin")
+
+
+@router.post("/reload")
+async def reload_kb(api_key_info: dict = Depends(api_key_guard)):
+    if not warmup.is_ready():
+        return JSONResponse(status_code=503, content={"message": "Warm-up still in progress", "warmup": warmup.status()})
+
+    started = kb_reload.schedule_reload()
+    return JSONResponse(
+        status_code=202,
+        content={"started": started, **kb_reload.status()}
+    )
+
+
+@router.get("/kb_version")
+async def kb_version(api_key_info: dict = Depends(api_key_guard)):
+    if not warmup.is_ready():
+        return JSONResponse(status_code=503, content={"message": "Warm-up still in progress", "warmup": warmup.status()})
+    return kb_reload.status()
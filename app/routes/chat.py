@@ -1,22 +1,34 @@
 from fastapi import APIRouter, Request, Header, Depends, HTTPException
+from fastapi.responses import StreamingResponse
 import urllib3
 import json
 import os
+import time
 from datetime import datetime
 
 from ..services.utils import *
 from ..agents.ticket_agent import TicketAgent
-from app.agents.support_graph import build_support_graph
-from ..services.KnowledgeBaseFiltering import *
-from ..services.gemini import call_gemini_llm
+from ..services import warmup, metrics
+from ..services.conversation_history import prepare_history, append_turns, schedule_summary, record_prompt_size
+from app.config import WARMUP_WAIT_SECONDS
 
 #### AHORA MISMO NO SE USA, ES UN BACKEND PARA GOOGLE CHAT
 
 urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
 
-compiled_graph = build_support_graph()
 router = APIRouter()
 
+
+async def require_ready():
+    # Antes de terminar el calentamiento se responde 503 en lugar de bloquear la petición.
+    if not await warmup.wait_until_ready(WARMUP_WAIT_SECONDS):
+        raise HTTPException(
+            status_code=503,
+            detail={"message": "El asistente se está iniciando, inténtalo de nuevo en unos segundos.",
+                    "warmup": warmup.status()},
+            headers={"Retry-After": "5"}
+        )
+
 @router.get("/delete_cache")
 async def delete_cache(request: Request, api_key_info: dict = Depends(api_key_guard)):
         delete_converation_cache()
@@ -45,87 +57,93 @@ async def delete_cache_user(
         print("ERROR: ", str(e))
         raise HTTPException(status_code=500, detail=f"Error deleting cache: {str(e)}")
 
-@router.post("/message")
-async def handle_message(request: Request, authorization: str = Header(None)):
-    try:
-        data = await request.json()
-        request_type = data.get("type")
-
-        if request_type == "MESSAGE":
-            pregunta = data.get("message", {}).get("text")
-            usuario = (
-                data.get("message", {})
-                .get("sender", {})
-                .get("email", "usuario@local.test")
-                .split("@")[0]
-            )
-
-            modo_ui = data.get("modo_respuesta", "IA Generativa")
-
-            response_mode = (
-                "hybrid"
-                if modo_ui == "Modelo ML (embeddings)"
-                else "generative"
-            )
-
-            state = {
-                "user_message": pregunta,
-                "user_email": usuario,
-                "role": "user",
-                "response_mode": response_mode
-            }
-
-            result = await compiled_graph.ainvoke(state)
-
-            response_text = result.get("output", "")
-            solved = result.get("solved", False)
-
-            response_obj = {"text": response_text}
-            if not solved:
-                response_obj["cardsV2"] = [
-                    {
-                        "cardId": "helpOptions",
-                        "card": {
-                            "header": {
-                                "title": "¿Quieres que creemos un ticket para soporte?",
-                                "subtitle": "Tu incidencia será tratada con prioridad"
-                            },
-                            "sections": [
+def _graph_state(data: dict) -> dict:
+    pregunta = data.get("message", {}).get("text")
+    usuario = (
+        data.get("message", {})
+        .get("sender", {})
+        .get("email", "usuario@local.test")
+        .split("@")[0]
+    )
+
+    modo_ui = data.get("modo_respuesta", "IA Generativa")
+
+    response_mode = (
+        "hybrid"
+        if modo_ui == "Modelo ML (embeddings)"
+        else "generative"
+    )
+
+    return {
+        "user_message": pregunta,
+        "user_email": usuario,
+        "role": "user",
+        "response_mode": response_mode
+    }
+
+
+def _message_response(result: dict, pregunta: str) -> dict:
+    response_text = result.get("output", "")
+    solved = result.get("solved", False)
+
+    response_obj = {"text": response_text}
+    if not solved:
+        response_obj["cardsV2"] = [
+            {
+                "cardId": "helpOptions",
+                "card": {
+                    "header": {
+                        "title": "¿Quieres que creemos un ticket para soporte?",
+                        "subtitle": "Tu incidencia será tratada con prioridad"
+                    },
+                    "sections": [
+                        {
+                            "widgets": [
                                 {
-                                    "widgets": [
-                                        {
-                                            "buttonList": {
-                                                "buttons": [
-                                                    {
-                                                        "text": "Sí",
-                                                        "onClick": {
-                                                            "action": {
-                                                                "function": "createJiraTicket",
-                                                                "parameters": [
+                                    "buttonList": {
+                                        "buttons": [
+                                            {
+                                                "text": "Sí",
+                                                "onClick": {
+                                                    "action": {
+                                                        "function": "createJiraTicket",
+                                                        "parameters": [
+                                                            {
+                                                                "key": "messages",
+                                                                "value": json.dumps([
                                                                     {
-                                                                        "key": "messages",
-                                                                        "value": json.dumps([
-                                                                            {
-                                                                                "role": "user",
-                                                                                "content": pregunta
-                                                                            }
-                                                                        ])
+                                                                        "role": "user",
+                                                                        "content": pregunta
                                                                     }
-                                                                ]
+                                                                ])
                                                             }
-                                                        }
+                                                        ]
                                                     }
-                                                ]
+                                                }
                                             }
-                                        }
-                                    ]
+                                        ]
+                                    }
                                 }
                             ]
                         }
-                    }
-                ]
+                    ]
+                }
+            }
+        ]
+    return response_obj
+
+
+@router.post("/message", dependencies=[Depends(require_ready)])
+async def handle_message(request: Request, authorization: str = Header(None)):
+    compiled_graph = warmup.get_graph()
+    try:
+        data = await request.json()
+        request_type = data.get("type")
 
-            return response_obj
+        if request_type == "MESSAGE":
+            state = _graph_state(data)
+            result = await compiled_graph.ainvoke(state)
+            return _message_response(result, state["user_message"])
 
         elif request_type == "CARD_CLICKED":
             print("resolving card click")
@@ -140,7 +158,64 @@ async def handle_message(request: Request, authorization: str = Header(None)):
             "text": "Lo siento, ha ocurrido un error y no puedo ayudarte ahora mismo."
         }
 
+def _sse(event: str, payload: dict) -> str:
+    return f"event: {event}\ndata: {json.dumps(payload, ensure_ascii=False)}\n\n"
+
+
+@router.post("/message/stream", dependencies=[Depends(require_ready)])
+async def handle_message_stream(request: Request, authorization: str = Header(None)):
+    """
+    Variante Server-Sent Events de /message para mensajes de tipo MESSAGE: un evento "token"
+    por cada fragmento que genera el LLM y al final un evento "done" con la misma respuesta
+    que /message (solved y el guardado de la conversación se resuelven al terminar).
+    Un evento "reset" indica que el LLM falló a mitad: hay que descartar los tokens recibidos.
+    """
+    compiled_graph = warmup.get_graph()
+    try:
+        data = await request.json()
+    except ValueError as e:
+        print("ERROR: ", str(e))
+        raise HTTPException(status_code=400, detail="Request body must be valid JSON.")
+    if not isinstance(data, dict) or data.get("type") != "MESSAGE":
+        raise HTTPException(status_code=400, detail="Only MESSAGE events can be streamed.")
+    state = {**_graph_state(data), "stream": True}
+
+    async def events():
+        start = time.perf_counter()
+        first = True
+        result = state
+        try:
+            async for mode, chunk in compiled_graph.astream(state, stream_mode=["custom", "values"]):
+                if mode == "values":
+                    result = chunk
+                    continue
+                if chunk.get("reset"):
+                    yield _sse("reset", {})
+                    continue
+                if first:
+                    metrics.observe("message_first_token_seconds", time.perf_counter() - start, channel="sse")
+                    first = False
+                yield _sse("token", {"text": chunk.get("token", "")})
+            if first:
+                # Sin tokens (modo híbrido o respuesta fija): el primer contenido es la respuesta entera.
+                metrics.observe("message_first_token_seconds", time.perf_counter() - start, channel="sse")
+            yield _sse("done", _message_response(result, state["user_message"]))
+        except Exception as e:
+            print("ERROR: ", str(e))
+            yield _sse("error", {"text": "Lo siento, ha ocurrido un error y no puedo ayudarte ahora mismo."})
+
+    return StreamingResponse(
+        events(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
+
 async def respond_message(data):
+    from ..services.KnowledgeBaseFiltering import score_incidents_weighted_context
+    from ..services.context_packer import pack_context
+    from ..services.gemini import call_gemini_llm
+
     try:
         user_message = data.get("message", {}).get("text")
         chat_id = data.get("space", {}).get("name")
@@ -149,32 +224,19 @@ async def respond_message(data):
         # --- Semantic Filtering Step ---
         start_filter = time.time()
         print(f"Filtering relevant incidents for query: '{user_message}' (Chat ID: {chat_id}, User Email: {user_email})")
-        relevant_incidents = get_relevant_incidents_weighted_context(
+        retrieval = score_incidents_weighted_context(
             user_email=user_email,
             query=user_message,
             top_n=10,
             decay_factor=0.9
         )
-        ids = []
-        if isinstance(relevant_incidents, list):
-            for e in relevant_incidents:
-                if isinstance(e, dict) and "id" in e:
-                    ids.append(e["id"])
+        packed = pack_context(retrieval) if retrieval.scored else None
+        ids = packed.ids if packed else []
 
         print(ids)
 
 
-        conversation_total = get_conversation(user_email)
-
-        if isinstance(conversation_total, list):
-            conversation = conversation_total
-            incident_ids = []
-        elif isinstance(conversation_total, dict):
-            conversation = conversation_total.get("conversation", [])
-            incident_ids = conversation_total.get("Incidents", [])
-        else:
-            conversation = []
-            incident_ids = []
+        history = prepare_history(user_email)
 
 # todo especificar que no escriba el llm_action
         system_msg = {
@@ -186,7 +248,7 @@ async def respond_message(data):
                 2. Guía de conocimiento  
                    • Responde **exclusivamente** con la información contenida en la guía de soporte.
                    Basado en el contexto de la conversación, la siguiente información de la base de conocimiento es la más pertinente: 
-                     \"\"\"{json.dumps(relevant_incidents, indent=4, ensure_ascii=False)}\"\"\"
+                     \"\"\"{packed.text if packed else ""}\"\"\"
 
                 3. Estilo y tono  
                    • Habla siempre en **segunda persona del singular**.  
@@ -220,12 +282,10 @@ async def respond_message(data):
 
         }
 
-        if not conversation:
-            conversation = [system_msg]
-        else:
-            conversation[0] = system_msg
-
-        conversation.append({"role": "user", "content": user_message, "timestamp": datetime.now().isoformat()})
+        conversation = [system_msg] + history + [
+            {"role": "user", "content": user_message, "timestamp": datetime.now().isoformat()}
+        ]
+        record_prompt_size(system_msg, history, user_message)
 
         tools = [
             {
@@ -257,8 +317,15 @@ async def respond_message(data):
         response_text = convert_markdown_for_google_chat(parsed_reply["Response"])
         solved = parsed_reply["solved"]
 
-        conversation.append({"role": "model", "content": parsed_reply["Response"], "timestamp": datetime.now().isoformat()})
-        save_conversation(user_email, {"conversation": conversation, "Incidents": [e["id"] for e in relevant_incidents]})
+        record = append_turns(
+            user_email,
+            [
+                conversation[-1],
+                {"role": "model", "content": parsed_reply["Response"], "timestamp": datetime.now().isoformat()}
+            ],
+            ids
+        )
+        schedule_summary(user_email)
 
         response_obj = {"text": response_text}
 
@@ -285,7 +352,7 @@ async def respond_message(data):
                                                             "parameters": [
                                                                 {
                                                                     "key": "messages",
-                                                                    "value": json.dumps(conversation[1:])
+                                                                    "value": json.dumps(record["conversation"])
                                                                 }
                                                             ]
                                                         }
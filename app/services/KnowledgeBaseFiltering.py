@@ -1,159 +1,565 @@
 import json
 import re
-from typing import List, Dict, Any, Optional
-from sentence_transformers import SentenceTransformer, util
+import hashlib
+from typing import List, Dict, Any, Optional, Tuple
+from sentence_transformers import SentenceTransformer
 import time
 import os
+import threading
+from dataclasses import dataclass
+import numpy as np
 import torch
 from ..config import *
 from app.config import DATA_DIR
+from app.services import metrics, kb_service
+from app.services.kb_service import KBState, incident_text, preprocess_text
+from app.services.vector_index import build_vector_index
+from app.services.passage_index import PassageIndex, extract_passages
+from app.services.context_packer import Retrieval
+from app.services.model_registry import get_model, model_tag
+from app.services.query_cache import QUERY_EMBEDDING_CACHE, frequent_queries, warm_up
+from app.services.context_store import CONTEXT_STORE
+from app.services.conversation_store import CONVERSATION_STORE
 
 BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
-KB_PATH = os.path.join(BASE_DIR, "data", "KnowledgeBase.json")
+KB_PATH = kb_service.KB_PATH
 
-EMBEDDING_CACHE_FILE = str(DATA_DIR / "kb_embeddings.json")
-DEFAULT_MODEL_NAME = 'multi-qa-mpnet-base-dot-v1'
+EMBEDDING_CACHE_FILE = str(DATA_DIR / "kb_embeddings.npy")
+VECTOR_INDEX_FILE = str(DATA_DIR / "kb_index_generative.npz")
+PASSAGE_CACHE_FILE = str(DATA_DIR / "kb_passage_embeddings.npy")
+PASSAGE_INDEX_FILE = str(DATA_DIR / "kb_passage_index_generative.npz")
+DEFAULT_MODEL_NAME = SHARED_ENCODER_MODEL or 'multi-qa-mpnet-base-dot-v1'
 
 model: Optional[SentenceTransformer] = None
-KB_CORPUS_EMBEDDINGS: Optional[torch.Tensor] = None
 KB_CORPUS_DATA: Optional[List[Dict[str, Any]]] = None
+KB_VECTOR_INDEX = None
 
-conversation_history_embeddings: Dict[str, List[torch.Tensor]] = {}
+
+@dataclass(frozen=True)
+class KBSnapshot:
+    """
+    Versión inmutable de la KB con su índice; se sustituye entera. Los embeddings solo se
+    guardan en el formato compacto del índice (index.store); la matriz float32 completa
+    sigue en la caché en disco.
+    """
+    version: int
+    fingerprint: str
+    kb_state: KBState
+    index: Any
+    built_at: float
+    passages: Optional[PassageIndex] = None
+
+    @property
+    def data(self) -> List[Dict[str, Any]]:
+        return self.kb_state.entries
+
+
+KB_SNAPSHOT: Optional[KBSnapshot] = None
+_build_lock = threading.Lock()
 
 _model_initialized = False
 
-def load_json_data(file_path: str) -> List[Dict[str, Any]]:
+def embedding_key(text: str, model_name: Optional[str] = None) -> str:
+    # La clave depende del texto exacto que se codifica y del modelo (y su backend), así
+    # una descripción editada o un cambio de modelo nunca reutilizan un vector obsoleto.
+    model_name = model_name or model_tag(DEFAULT_MODEL_NAME)
+    return hashlib.sha1(f"{model_name}\n{text}".encode('utf-8')).hexdigest()
+
+def _cache_paths(cache_file: str) -> Tuple[str, str, str]:
+    # La caché binaria vive junto a la antigua: <base>.npy (matriz float32 contigua),
+    # <base>.ids.json (id/clave -> fila) y <base>.json (formato JSON heredado).
+    base, _ = os.path.splitext(cache_file)
+    return base + ".npy", base + ".ids.json", base + ".json"
+
+def _migrate_json_cache(legacy_file: str, cache_file: str) -> Optional[Tuple[List[str], Optional[List[str]], np.ndarray]]:
+    print(f"Migrating legacy JSON embeddings cache {legacy_file} to binary format...")
     try:
-        with open(file_path, 'r', encoding='utf-8') as f:
-            data = json.load(f)
-        return data
-    except FileNotFoundError:
-        print(f"Error: File not found at {file_path}")
-        return []
-    except json.JSONDecodeError:
-        print(f"Error: Invalid JSON format in {file_path}")
-        return []
+        with open(legacy_file, 'r', encoding='utf-8') as f:
+            loaded_data = json.load(f)
     except Exception as e:
-        print(f"An unexpected error occurred: {e}")
-        return []
+        print(f"Error loading legacy embeddings cache: {e}")
+        return None
+    if not loaded_data:
+        return None
 
-def preprocess_text(text: str) -> str:
-    if text is None:
-        return ""
-    text = text.lower()
-    text = re.sub(r'[^\w\s]', '', text)
-    text = re.sub(r'\s+', ' ', text).strip()
-    return text
+    ids = list(loaded_data.keys())
+    matrix = np.asarray([loaded_data[k] for k in ids], dtype=np.float32)
+    if not save_embeddings_to_cache(ids, None, matrix, cache_file):
+        return ids, None, matrix
+    return load_embeddings_from_cache(cache_file)
 
-def load_embeddings_from_cache(cache_file: str) -> Optional[Dict[str, torch.Tensor]]:
-    if not os.path.exists(cache_file):
+def load_embeddings_from_cache(cache_file: str) -> Optional[Tuple[List[str], Optional[List[str]], np.ndarray]]:
+    """Devuelve (ids, claves, matriz). Las claves son None en cachés antiguas indexadas solo por id."""
+    matrix_path, index_path, legacy_path = _cache_paths(cache_file)
+
+    if not (os.path.exists(matrix_path) and os.path.exists(index_path)):
+        if os.path.exists(legacy_path):
+            return _migrate_json_cache(legacy_path, cache_file)
         return None
+
     try:
-        with open(cache_file, 'r', encoding='utf-8') as f:
-            loaded_data = json.load(f)
-            return {k: torch.tensor(v) for k, v in loaded_data.items()}
+        with open(index_path, 'r', encoding='utf-8') as f:
+            index = json.load(f)
+        # mmap_mode='c' (copy-on-write): el array es escribible pero no se carga entero en
+        # memoria; solo se copian las páginas que se modifiquen.
+        matrix = np.load(matrix_path, mmap_mode='c')
+        ids = index.get("ids", [])
+        keys = index.get("keys")
+        if matrix.ndim != 2 or matrix.shape[0] != len(ids) or matrix.dtype != np.float32:
+            print(f"Embeddings cache {matrix_path} does not match its index. Ignoring it.")
+            return None
+        if keys is not None and len(keys) != len(ids):
+            keys = None
+        return ids, keys, matrix
     except Exception as e:
         print(f"Error loading embeddings cache: {e}")
         return None
 
-def save_embeddings_to_cache(embeddings: Dict[str, torch.Tensor], cache_file: str):
+def save_embeddings_to_cache(ids: List[str], keys: Optional[List[str]], matrix: np.ndarray, cache_file: str,
+                             model_name: str = DEFAULT_MODEL_NAME) -> bool:
+    matrix_path, index_path, _ = _cache_paths(cache_file)
     try:
-        os.makedirs(os.path.dirname(cache_file), exist_ok=True)
-        serializable_embeddings = {k: v.tolist() for k, v in embeddings.items()}
-        with open(cache_file, 'w', encoding='utf-8') as f:
-            json.dump(serializable_embeddings, f, indent=4)
+        os.makedirs(os.path.dirname(matrix_path), exist_ok=True)
+        matrix = np.ascontiguousarray(matrix, dtype=np.float32)
+
+        tmp_matrix = matrix_path + ".tmp"
+        with open(tmp_matrix, 'wb') as f:
+            np.save(f, matrix)
+        tmp_index = index_path + ".tmp"
+        index = {
+            "version": 2 if keys is not None else 1,
+            "dtype": "float32",
+            "dim": int(matrix.shape[1]) if matrix.ndim == 2 else 0,
+            "count": len(ids),
+            "ids": list(ids)
+        }
+        if keys is not None:
+            index["model"] = model_name
+            index["keys"] = list(keys)
+        with open(tmp_index, 'w', encoding='utf-8') as f:
+            json.dump(index, f, ensure_ascii=False)
+
+        os.replace(tmp_matrix, matrix_path)
+        os.replace(tmp_index, index_path)
+        return True
     except Exception as e:
         print(f"Error saving embeddings cache: {e}")
+        return False
+
+def _checkpoint_paths(cache_file: str) -> Tuple[str, str]:
+    base, _ = os.path.splitext(cache_file)
+    return base + ".ckpt.f32", base + ".ckpt.keys"
+
+def _load_checkpoint(cache_file: str, dim: int) -> Dict[str, np.ndarray]:
+    vectors_path, keys_path = _checkpoint_paths(cache_file)
+    if not os.path.exists(vectors_path):
+        return {}
+    try:
+        keys: List[str] = []
+        if os.path.exists(keys_path):
+            with open(keys_path, 'r', encoding='utf-8') as f:
+                # Solo cuentan las líneas completas: la última puede haber quedado a medias.
+                keys = f.read().split("\n")[:-1]
+        vectors = np.fromfile(vectors_path, dtype=np.float32)
+        # Los vectores se escriben antes que sus claves: si el proceso murió a mitad
+        # de un bloque, las filas sin clave (o incompletas) se recortan también de los
+        # ficheros. Si no, el siguiente bloque se añadiría detrás de ellas y cada clave
+        # quedaría apuntando al vector de otra.
+        count = min(len(keys), vectors.size // dim)
+        if vectors.size != count * dim:
+            os.truncate(vectors_path, count * dim * vectors.itemsize)
+        keys_size = sum(len(key.encode('utf-8')) + 1 for key in keys[:count])
+        if os.path.exists(keys_path) and os.path.getsize(keys_path) != keys_size:
+            os.truncate(keys_path, keys_size)
+        vectors = vectors[:count * dim].reshape(count, dim)
+        return {keys[i]: vectors[i] for i in range(count)}
+    except Exception as e:
+        print(f"Error loading embeddings checkpoint: {e}")
+        return {}
+
+def _checkpoint_is_consistent(cache_file: str, dim: int) -> bool:
+    # Una fila de vectores por cada línea completa de claves.
+    vectors_path, keys_path = _checkpoint_paths(cache_file)
+    keys = b""
+    if os.path.exists(keys_path):
+        with open(keys_path, 'rb') as f:
+            keys = f.read()
+    vectors_size = os.path.getsize(vectors_path) if os.path.exists(vectors_path) else 0
+    complete = not keys or keys.endswith(b"\n")
+    return complete and vectors_size == keys.count(b"\n") * dim * 4
+
+def _append_checkpoint(cache_file: str, keys: List[str], vectors: np.ndarray) -> None:
+    vectors_path, keys_path = _checkpoint_paths(cache_file)
+    try:
+        os.makedirs(os.path.dirname(vectors_path), exist_ok=True)
+        vectors = np.ascontiguousarray(vectors, dtype=np.float32)
+        if not _checkpoint_is_consistent(cache_file, vectors.shape[1]):
+            # Restos de un proceso que murió a mitad de escribir: se recortan antes de añadir.
+            _load_checkpoint(cache_file, vectors.shape[1])
+        with open(vectors_path, 'ab') as f:
+            f.write(vectors.tobytes())
+            f.flush()
+            os.fsync(f.fileno())
+        with open(keys_path, 'a', encoding='utf-8') as f:
+            f.write("".join(key + "\n" for key in keys))
+            f.flush()
+            os.fsync(f.fileno())
+    except Exception as e:
+        print(f"Error writing embeddings checkpoint: {e}")
+
+def _clear_checkpoint(cache_file: str) -> None:
+    for path in _checkpoint_paths(cache_file):
+        if os.path.exists(path):
+            os.remove(path)
+
+def encode_texts(
+    texts: List[str],
+    batch_size: int = EMBEDDING_BATCH_SIZE,
+    workers: int = EMBEDDING_WORKERS,
+    chunk_size: int = EMBEDDING_CHECKPOINT_EVERY,
+    on_chunk=None,
+    encoder=None,
+    normalize: bool = False
+) -> np.ndarray:
+    """
+    Codifica textos en lotes. Se ordenan por longitud para que cada lote tenga un
+    relleno mínimo y, con workers > 1, los bloques se reparten en un pool de procesos.
+    on_chunk(posiciones, vectores) se llama tras cada bloque (para checkpoints).
+    encoder es por defecto el modelo generativo.
+    """
+    encoder = encoder or model
+    embeddings = np.empty((len(texts), encoder.get_sentence_embedding_dimension()), dtype=np.float32)
+    if not texts:
+        return embeddings
+
+    order = sorted(range(len(texts)), key=lambda i: len(texts[i]))
+    chunk_size = max(chunk_size, batch_size)
+
+    pool = None
+    if workers > 1 and len(texts) >= workers * batch_size and hasattr(encoder, 'start_multi_process_pool'):
+        pool = encoder.start_multi_process_pool(target_devices=['cpu'] * workers)
+
+    try:
+        for start in range(0, len(order), chunk_size):
+            chunk = order[start:start + chunk_size]
+            chunk_texts = [texts[i] for i in chunk]
+            if pool is not None:
+                vectors = encoder.encode_multi_process(chunk_texts, pool, batch_size=batch_size,
+                                                       normalize_embeddings=normalize)
+            else:
+                vectors = encoder.encode(
+                    chunk_texts,
+                    batch_size=batch_size,
+                    convert_to_numpy=True,
+                    normalize_embeddings=normalize,
+                    show_progress_bar=False
+                )
+            vectors = np.asarray(vectors, dtype=np.float32)
+            embeddings[chunk] = vectors
+            if on_chunk is not None:
+                on_chunk(chunk, vectors)
+    finally:
+        if pool is not None:
+            encoder.stop_multi_process_pool(pool)
+
+    return embeddings
+
+def build_corpus_embeddings(data: List[Dict[str, Any]], cache_file: str,
+                            texts: Optional[List[str]] = None, encoder=None,
+                            model_name: str = DEFAULT_MODEL_NAME,
+                            normalize: bool = False) -> Tuple[Optional[np.ndarray], Dict[str, Any]]:
+    """
+    Construye la matriz de embeddings de la KB reutilizando de la caché todos los
+    vectores cuyo texto no ha cambiado. Solo se codifican las incidencias nuevas o
+    modificadas y las entradas huérfanas desaparecen al reescribir la caché.
+    Si una construcción anterior se interrumpió, se retoma desde su checkpoint.
+    Con encoder/model_name sirve también para otro modelo (p. ej. el del modo híbrido).
+    """
+    encoder = encoder or model
+    ids = [incident['id'] for incident in data]
+    if texts is None:
+        texts = [incident_text(incident) for incident in data]
+    keys = [embedding_key(text, model_tag(model_name)) for text in texts]
+
+    cached = load_embeddings_from_cache(cache_file)
+    cached_ids, cached_keys, cached_matrix = cached if cached else ([], None, None)
+    if cached_keys is not None:
+        cached_rows = {key: row for row, key in enumerate(cached_keys)}
+        rows = [cached_rows.get(key) for key in keys]
+    else:
+        # Caché previa indexada solo por id: no hay forma de saber si cada vector corresponde
+        # al texto actual (una incidencia editada conservaría el suyo obsoleto), así que se
+        # vuelve a codificar todo una vez y se reescribe con claves.
+        rows = [None] * len(ids)
+
+    missing_keys: Dict[str, str] = {}
+    for pos, row in enumerate(rows):
+        if row is None:
+            missing_keys.setdefault(keys[pos], texts[pos])
+
+    new_embeddings: Dict[str, np.ndarray] = {}
+    resumed = 0
+    encode_seconds = 0.0
+    if missing_keys:
+        checkpoint = _load_checkpoint(cache_file, encoder.get_sentence_embedding_dimension())
+        for key in list(missing_keys):
+            if key in checkpoint:
+                new_embeddings[key] = checkpoint.pop(key)
+                del missing_keys[key]
+        resumed = len(new_embeddings)
+        if resumed:
+            print(f"Resuming embeddings build from checkpoint: {resumed} vectors already encoded.")
+
+    if missing_keys:
+        pending_keys = list(missing_keys)
+
+        def _checkpoint_chunk(chunk: List[int], vectors: np.ndarray) -> None:
+            _append_checkpoint(cache_file, [pending_keys[i] for i in chunk], vectors)
+
+        start = time.time()
+        vectors = encode_texts([missing_keys[key] for key in pending_keys], on_chunk=_checkpoint_chunk,
+                               encoder=encoder, normalize=normalize)
+        encode_seconds = time.time() - start
+        new_embeddings.update(zip(pending_keys, vectors))
+
+    used_rows = {row for row in rows if row is not None}
+    recomputed = len(new_embeddings) - resumed
+    stats = {
+        "fingerprint": hashlib.sha1("".join(keys).encode('utf-8')).hexdigest(),
+        "total": len(data),
+        "reused": sum(1 for row in rows if row is not None),
+        "resumed": resumed,
+        "recomputed": recomputed,
+        "dropped": len(cached_ids) - len(used_rows),
+        "texts_per_second": recomputed / encode_seconds if encode_seconds > 0 else 0.0
+    }
+    if recomputed:
+        print(f"Encoded {recomputed} texts in {encode_seconds:.2f} seconds ({stats['texts_per_second']:.1f} texts/s).")
+
+    if not data:
+        return None, stats
+
+    if not new_embeddings and keys == cached_keys:
+        # La caché coincide fila a fila con la KB: se usa el mapeo en memoria sin copiar.
+        return cached_matrix, stats
+
+    corpus_matrix = np.stack([
+        cached_matrix[row] if row is not None else new_embeddings[keys[pos]]
+        for pos, row in enumerate(rows)
+    ]).astype(np.float32)
+    if save_embeddings_to_cache(ids, keys, corpus_matrix, cache_file=cache_file, model_name=model_name):
+        _clear_checkpoint(cache_file)
+    return corpus_matrix, stats
 
 
 def get_weighted_context_embedding(user_email: str, new_message_embedding: torch.Tensor, decay_factor: float = 0.8, max_history: int = 5) -> torch.Tensor:
-    global conversation_history_embeddings
+    # El acumulador del store evita volver a apilar el historial en cada mensaje.
+    context = CONTEXT_STORE.update(
+        user_email, new_message_embedding.detach().float().cpu().numpy(), decay_factor, max_history
+    )
+    return torch.from_numpy(context).to(device=new_message_embedding.device, dtype=new_message_embedding.dtype)
+
+
+def _build_snapshot(cache_file: str) -> Tuple[Optional[KBSnapshot], Optional[Dict[str, Any]]]:
+    kb_state = kb_service.current()
+    data = kb_state.entries
+    if not data:
+        print("No knowledge base data loaded.")
+        return None, None
+
+    current = KB_SNAPSHOT
+    if current is not None and current.kb_state.generation == kb_state.generation:
+        return current, None
 
-    if user_email not in conversation_history_embeddings:
-        conversation_history_embeddings[user_email] = []
+    start = time.time()
+    corpus_matrix, stats = build_corpus_embeddings(data, cache_file, kb_state.generative_texts)
+    if corpus_matrix is None:
+        print("No valid embeddings generated for Knowledge Base.")
+        return None, stats
+
+    if current is not None and current.fingerprint == stats["fingerprint"]:
+        # Solo cambian campos que no se codifican: se reutiliza el índice.
+        index = current.index
+    else:
+        index = build_vector_index(corpus_matrix, VECTOR_INDEX_FILE, stats["fingerprint"])
+
+    snapshot = KBSnapshot(
+        version=(current.version + 1) if current is not None else 1,
+        fingerprint=stats["fingerprint"],
+        kb_state=kb_state,
+        index=index,
+        built_at=time.time(),
+        passages=_build_passages(data, current.passages if current is not None else None)
+    )
+    print(
+        f"Knowledge Base snapshot v{snapshot.version} (generation {kb_state.generation}) prepared in {time.time() - start:.2f} seconds. "
+        f"Total {len(data)} entries ({stats['reused']} reused, {stats['recomputed']} recomputed, "
+        f"{stats['dropped']} dropped)."
+    )
+    return snapshot, stats
+
+
+def _build_passages(data: List[Dict[str, Any]], current: Optional[PassageIndex]) -> Optional[PassageIndex]:
+    # Los pasajes usan su propia caché de embeddings, así que al editar un paso solo se
+    # vuelve a codificar ese paso.
+    if not PASSAGE_INDEX_ENABLED:
+        return None
+    passages = extract_passages(data)
+    if not passages:
+        return None
+    records = [{"id": f"{data[p.entry].get('id')}#{p.kind}{p.item}"} for p in passages]
+    matrix, stats = build_corpus_embeddings(records, PASSAGE_CACHE_FILE, [p.text for p in passages])
+    if matrix is None:
+        return None
+    # La huella incluye a qué entrada pertenece cada pasaje, no solo su texto.
+    fingerprint = hashlib.sha1(
+        f"{stats['fingerprint']}|{len(data)}|{','.join(str(p.entry) for p in passages)}".encode('utf-8')
+    ).hexdigest()
+    if current is not None and current.fingerprint == fingerprint:
+        return current
+    print(f"Passage index: {len(passages)} passages ({stats['reused']} reused, {stats['recomputed']} recomputed).")
+    return PassageIndex(passages, np.asarray(matrix, dtype=np.float32), len(data), PASSAGE_INDEX_FILE, fingerprint)
+
+
+def apply_change(kb_state: KBState) -> bool:
+    """
+    Publica un snapshot para una generación que cambia una sola entrada de la anterior
+    (kb_state.change): solo se codifica esa entrada (y sus pasajes) y el índice vectorial
+    y el de pasajes se copian con sus filas sustituidas. Devuelve False si hay
+    que reconstruir entero: el snapshot publicado no es el de la generación anterior,
+    no hay modelo o el índice de pasajes aún no existe.
+    """
+    change = kb_state.change
+    if change is None or model is None or not kb_state.entries:
+        return False
+
+    with _build_lock:
+        current = KB_SNAPSHOT
+        if current is None or current.kb_state.generation != kb_state.generation - 1:
+            return False
+        new_entries = kb_state.entries[change.start:change.start + change.count]
+        new_passages = extract_passages(new_entries) if PASSAGE_INDEX_ENABLED else []
+        if current.passages is None and new_passages:
+            return False
+
+        start = time.time()
+        texts = kb_state.generative_texts[change.start:change.start + change.count]
+        keys = [embedding_key(text) for text in texts]
+        if current.kb_state.generative_texts[change.start:change.stop] == texts:
+            # Solo cambian campos que no se codifican.
+            index, fingerprint = current.index, current.fingerprint
+        else:
+            vectors = encode_texts(texts)
+            # Los vectores nuevos van al checkpoint de la caché: la próxima construcción
+            # completa (p. ej. al reiniciar) los reutiliza en lugar de volver a codificarlos.
+            if keys:
+                _append_checkpoint(EMBEDDING_CACHE_FILE, keys, vectors)
+            fingerprint = hashlib.sha1(
+                f"{current.fingerprint}|{change.start}:{change.stop}|{','.join(keys)}".encode('utf-8')
+            ).hexdigest()
+            index = current.index.splice(change.start, change.stop, vectors, fingerprint)
+
+        passages = current.passages
+        if passages is not None:
+            passage_texts = [p.text for p in new_passages]
+            passage_vectors = encode_texts(passage_texts)
+            if passage_texts:
+                _append_checkpoint(PASSAGE_CACHE_FILE, [embedding_key(text) for text in passage_texts], passage_vectors)
+            passages = passages.splice(
+                change.start, change.stop, change.count, new_passages, passage_vectors,
+                hashlib.sha1(f"{passages.fingerprint}|{fingerprint}|{change.count}".encode('utf-8')).hexdigest()
+            )
+
+        snapshot = KBSnapshot(
+            version=current.version + 1,
+            fingerprint=fingerprint,
+            kb_state=kb_state,
+            index=index,
+            built_at=time.time(),
+            passages=passages
+        )
+        _publish(snapshot)
 
-    conversation_history_embeddings[user_email].append(new_message_embedding)
+    elapsed = time.time() - start
+    metrics.inc("kb_incremental_updates", engine="generative")
+    metrics.observe("kb_incremental_seconds", elapsed, engine="generative")
+    print(
+        f"Knowledge Base snapshot v{snapshot.version} (generation {kb_state.generation}) updated in {elapsed:.2f} seconds "
+        f"({change.op} {change.entry_id})."
+    )
+    return True
 
-    if len(conversation_history_embeddings[user_email]) > max_history:
-        conversation_history_embeddings[user_email] = conversation_history_embeddings[user_email][-max_history:]
 
-    if not conversation_history_embeddings[user_email]:
-        return new_message_embedding
+def _publish(snapshot: KBSnapshot) -> None:
+    # Una única asignación publica el snapshot; las consultas en curso terminan con el
+    # que leyeron. Los alias de módulo se mantienen para la UI y los benchmarks.
+    global KB_SNAPSHOT, KB_CORPUS_DATA, KB_VECTOR_INDEX
+    if snapshot is KB_SNAPSHOT:
+        return
+    KB_SNAPSHOT = snapshot
+    KB_CORPUS_DATA = snapshot.data
+    KB_VECTOR_INDEX = snapshot.index
+    metrics.set_gauge("kb_snapshot_version", snapshot.version, engine="generative")
+    metrics.set_gauge("kb_snapshot_entries", len(snapshot.data), engine="generative")
 
-    weighted_embeddings = []
-    for i, emb in enumerate(reversed(conversation_history_embeddings[user_email])):
-        weight = decay_factor**i
-        weighted_embeddings.append(emb * weight)
 
-    context_embedding = torch.stack(weighted_embeddings).sum(dim=0)
-    return context_embedding / context_embedding.norm()
+def snapshot_info() -> Optional[Dict[str, Any]]:
+    snapshot = KB_SNAPSHOT
+    if snapshot is None:
+        return None
+    return {
+        "version": snapshot.version,
+        "fingerprint": snapshot.fingerprint,
+        "kb_generation": snapshot.kb_state.generation,
+        "entries": len(snapshot.data),
+        "built_at": snapshot.built_at
+    }
 
 
 def initialize_model_and_kb(Route, force_reload=False):
 
-    global model, KB_CORPUS_EMBEDDINGS, KB_CORPUS_DATA, _model_initialized
+    global model, _model_initialized
 
     if _model_initialized and not force_reload:
         return
 
-    _model_initialized = False
-    KB_CORPUS_EMBEDDINGS = None
-    KB_CORPUS_DATA = None
-
-    print(f"Attempting to load SentenceTransformer model '{DEFAULT_MODEL_NAME}'...")
+    # El modelo vive en el registro: recargar la KB (force_reload) no lo vuelve a cargar.
     try:
-        start = time.time()
-        model = SentenceTransformer(DEFAULT_MODEL_NAME, device = 'cpu')
-        print(f"SentenceTransformer model loaded successfully in {time.time() - start} seconds.")
+        model = get_model(DEFAULT_MODEL_NAME)
     except Exception as e:
-        _model_initialized = False
         print(f"CRITICAL ERROR: Failed to load SentenceTransformer model: {e}")
         model = None
         return #
 
     print("Loading Knowledge Base data and embeddings...")
-    data = load_json_data(KB_PATH)
-    if not data:
-        print("No knowledge base data loaded. KB filtering will be inactive.")
-        KB_CORPUS_EMBEDDINGS = None
-        KB_CORPUS_DATA = None
+    with _build_lock:
+        snapshot, _ = _build_snapshot(Route)
+    if snapshot is None:
+        # Si ya había un snapshot se sigue sirviendo; si no, el filtrado queda inactivo.
+        print("KB filtering keeps the previous snapshot." if KB_SNAPSHOT else "KB filtering will be inactive.")
         return
 
-    cached_embeddings = load_embeddings_from_cache(Route)
-    new_embeddings = {}
-    corpus_embeddings_list = []
-    corpus_data_ordered = []
-    start = time.time()
+    _publish(snapshot)
+    _model_initialized = True
+    warm_up_query_cache()
 
-    for incident in data:
-        incident_id = incident['id']
-        text_to_embed = preprocess_text(incident.get('description_problem', '') + ' ' + incident.get('title', '') + ' ' + ", ".join(incident.get('keywords_tags', [])))
 
-        if cached_embeddings and incident_id in cached_embeddings:
-            corpus_embeddings_list.append(cached_embeddings[incident_id])
-        else:
-            embedding = model.encode(text_to_embed, convert_to_tensor=True)
-            corpus_embeddings_list.append(embedding)
-            new_embeddings[incident_id] = embedding
-        corpus_data_ordered.append(incident)
-
-    if new_embeddings:
-        all_embeddings = cached_embeddings or {}
-        all_embeddings.update(new_embeddings)
-        save_embeddings_to_cache(all_embeddings, cache_file=Route)
-
-    if corpus_embeddings_list:
-        KB_CORPUS_EMBEDDINGS = torch.stack(corpus_embeddings_list)
-        KB_CORPUS_DATA = corpus_data_ordered
-        print(f"Knowledge Base and embeddings prepared in {time.time() - start} seconds. Total {len(KB_CORPUS_DATA)} entries.")
-        _model_initialized = True
-    else:
-        KB_CORPUS_EMBEDDINGS = None
-        KB_CORPUS_DATA = None
-        print("No valid embeddings generated for Knowledge Base.")
+def encode_query(query: str) -> torch.Tensor:
+    return QUERY_EMBEDDING_CACHE.get_or_encode(
+        model_tag(DEFAULT_MODEL_NAME),
+        query,
+        lambda text: model.encode(text, convert_to_tensor=True)
+    )
 
+def warm_up_query_cache(limit: int = QUERY_CACHE_WARMUP) -> None:
+    queries = frequent_queries(limit)
+    if queries:
+        start = time.time()
+        warmed = warm_up(model_tag(DEFAULT_MODEL_NAME), queries, lambda text: model.encode(text, convert_to_tensor=True))
+        print(f"Query embedding cache warmed with {warmed} frequent queries in {time.time() - start:.2f} seconds.")
 
-def get_relevant_incidents_weighted_context(
+
+def score_incidents_weighted_context(
     user_email: str,
     query: str,
     query_weight: float = 0.7,
@@ -161,108 +567,90 @@ def get_relevant_incidents_weighted_context(
     decay_factor: float = 0.8,
     max_history: int = 5,
     top_n: int = 1
-) -> List[Dict[str, Any]]:
-    if not isinstance(KB_CORPUS_DATA, list):
-        return []
+) -> Retrieval:
+    """
+    [(posición, puntuación)] de las top_n incidencias de mayor a menor y posiciones de las
+    incidencias previas del usuario, junto con el vector de la consulta y el índice de
+    pasajes. Todo sale del mismo snapshot.
+    """
+    # Toda la consulta usa el mismo snapshot aunque se publique otro mientras tanto.
+    snapshot = KB_SNAPSHOT
     if model is None:
         print("Error: SentenceTransformer model is not loaded. Cannot perform filtering.")
-        return []
-    if KB_CORPUS_EMBEDDINGS is None or KB_CORPUS_DATA is None:
+        return Retrieval(None, [], [])
+    if snapshot is None:
         print("Error: Knowledge Base embeddings not loaded. Cannot perform filtering.")
-        return []
+        return Retrieval(None, [], [])
 
-    incidents = []
-    if os.path.exists(KB_PATH + 'conversation_store.json'):
-        with open(KB_PATH + 'conversation_store.json', 'r') as f:
-            try:
-                data = json.load(f)
-            except json.JSONDecodeError:
-                data = {}
-            incidents = data.get(user_email, {}).get("Incidents", [])
-    else:
-        incidents = []
+    # Incidencias que ya se le mostraron al usuario en el turno anterior.
+    stored = CONVERSATION_STORE.get(user_email)
+    incidents = stored.get("Incidents", []) if isinstance(stored, dict) else []
 
-    query_embedding = model.encode(query, convert_to_tensor=True)
+    query_embedding = encode_query(query)
 
     context_embedding = get_weighted_context_embedding(user_email, query_embedding, decay_factor, max_history)
 
-    query_scores = util.dot_score(query_embedding.unsqueeze(0), KB_CORPUS_EMBEDDINGS)[0]
-    context_scores = util.dot_score(context_embedding.unsqueeze(0), KB_CORPUS_EMBEDDINGS)[0]
+    # q·E * wq + c·E * wc == (q * wq + c * wc)·E: basta una única búsqueda en el índice.
+    combined_embedding = (query_embedding * query_weight) + (context_embedding * context_weight)
+    combined_vector = combined_embedding.detach().cpu().numpy()
+    top_idx, top_scores = snapshot.index.search(combined_vector, top_n)
+    scored = [(int(i), float(score)) for i, score in zip(top_idx, top_scores)]
 
-    combined_scores = (query_scores * query_weight) + (context_scores * context_weight)
+    # Las incidencias previas se resuelven con el mapa id → posición del snapshot,
+    # conservando el orden de la KB.
+    by_id = snapshot.kb_state.by_id
+    past_positions = sorted({by_id[i] for i in incidents if i in by_id})
+    return Retrieval(snapshot.kb_state, scored, past_positions, combined_vector, snapshot.passages)
 
-    incident_scores = list(zip(KB_CORPUS_DATA, combined_scores.tolist()))
-    sorted_incidents = sorted(incident_scores, key=lambda x: x[1], reverse=True)
 
-    past_incidents_from_kb = []
+def get_relevant_incidents_weighted_context(
+    user_email: str,
+    query: str,
+    query_weight: float = 0.7,
+    context_weight: float = 0.3,
+    decay_factor: float = 0.8,
+    max_history: int = 5,
+    top_n: int = 1
+) -> List[Dict[str, Any]]:
+    retrieval = score_incidents_weighted_context(
+        user_email, query, query_weight, context_weight, decay_factor, max_history, top_n
+    )
+    kb_state = retrieval.kb_state
+    if kb_state is None:
+        return []
 
-    for item in KB_CORPUS_DATA:
-        if "id" in item and item["id"] in incidents:
-            past_incidents_from_kb.append(item)
     unique_incident_ids = set()
     top_results = []
 
-    for incident_dict, score in sorted_incidents[:top_n]:
-        if "id" in incident_dict and incident_dict["id"] not in unique_incident_ids:
-            top_results.append(incident_dict)
-            unique_incident_ids.add(incident_dict["id"])
-
-    for incident_dict in past_incidents_from_kb:
+    for pos in [pos for pos, _ in retrieval.scored[:top_n]] + retrieval.past_positions:
+        incident_dict = kb_state.entries[pos]
         if "id" in incident_dict and incident_dict["id"] not in unique_incident_ids:
             top_results.append(incident_dict)
             unique_incident_ids.add(incident_dict["id"])
 
     return top_results
 
-def rebuild_embeddings(cache_file: str = EMBEDDING_CACHE_FILE) -> None:
-    global model, KB_CORPUS_EMBEDDINGS, KB_CORPUS_DATA
+def rebuild_embeddings(cache_file: str = EMBEDDING_CACHE_FILE) -> Optional[Dict[str, Any]]:
+    """
+    Construye un snapshot con la generación actual de la KB y lo publica de forma atómica.
+    Mientras se construye, las consultas siguen usando el snapshot anterior.
+    """
+    global model
 
     print("Rebuilding Knowledge Base embeddings...")
 
     if model is None:
         try:
-            print(f"Loading model '{DEFAULT_MODEL_NAME}' inside rebuild_embeddings...")
-            model = SentenceTransformer(DEFAULT_MODEL_NAME)
+            model = get_model(DEFAULT_MODEL_NAME)
         except Exception as e:
             print(f"CRITICAL ERROR: cannot load model in rebuild_embeddings: {e}")
-            KB_CORPUS_EMBEDDINGS = None
-            KB_CORPUS_DATA = None
-            return
+            return None
 
-    data = load_json_data(KB_PATH)
-    if not data:
-        print("No KB data found in rebuild_embeddings. Globals set to None.")
-        KB_CORPUS_EMBEDDINGS = None
-        KB_CORPUS_DATA = None
-        return
-
-    embeddings_dict: Dict[Any, torch.Tensor] = {}
-    corpus_embeddings_list: List[torch.Tensor] = []
-    corpus_data_ordered: List[Dict[str, Any]] = []
-
-    start = time.time()
-
-    for incident in data:
-        incident_id = incident["id"]
-        text_to_embed = preprocess_text(
-            incident.get("description_problem", "")
-            + " "
-            + incident.get("title", "")
-            + " "
-            + ", ".join(incident.get("keywords_tags", []))
-        )
-
-        emb = model.encode(text_to_embed, convert_to_tensor=True)
-        embeddings_dict[incident_id] = emb
-        corpus_embeddings_list.append(emb)
-        corpus_data_ordered.append(incident)
-
-    save_embeddings_to_cache(embeddings_dict, cache_file=cache_file)
-
-    KB_CORPUS_EMBEDDINGS = torch.stack(corpus_embeddings_list)
-    KB_CORPUS_DATA = corpus_data_ordered
+    with _build_lock:
+        snapshot, stats = _build_snapshot(cache_file)
+    if snapshot is None:
+        print("No KB data found in rebuild_embeddings. Keeping the previous snapshot.")
+        return None
 
-    print(
-        f"Rebuild completado: {len(KB_CORPUS_DATA)} entradas, "
-        f"{time.time() - start:.2f} segundos."
-    )
\ No newline at end of file
+    _publish(snapshot)
+    return stats
@@ -0,0 +1,198 @@
+import hashlib
+import itertools
+import json
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Dict, List, NamedTuple, Optional, Sequence, Tuple
+
+import numpy as np
+
+from app.config import (
+    ANSWER_CACHE_ENABLED,
+    ANSWER_CACHE_MIN_SIMILARITY,
+    ANSWER_CACHE_MAX_ENTRIES,
+    ANSWER_CACHE_MAX_MB,
+    ANSWER_CACHE_TTL_SECONDS
+)
+from app.services import kb_service, metrics
+
+"""
+Caché semántica de respuestas del modo generativo.
+Una respuesta se reutiliza para una consulta nueva si es el primer turno de la
+conversación, se han recuperado exactamente las mismas incidencias y el embedding de la
+consulta se parece al de la cacheada por encima de ANSWER_CACHE_MIN_SIMILARITY. Cada
+entrada guarda la versión (hash del contenido) de sus incidencias: si alguna cambia en la
+KB, la entrada deja de valer. LRU acotada en número de entradas y en memoria.
+"""
+
+
+class _Entry(NamedTuple):
+    key: Tuple[str, ...]
+    vector: np.ndarray
+    versions: Tuple[str, ...]
+    answer: Dict[str, Any]
+    created: float
+    size: int
+
+
+def _unit(vector: Any) -> np.ndarray:
+    vector = np.asarray(vector, dtype=np.float32).reshape(-1)
+    norm = float(np.linalg.norm(vector))
+    return vector / norm if norm > 0 else vector
+
+
+def incident_versions(kb_state: kb_service.KBState, incident_ids: Sequence[str]) -> Tuple[str, ...]:
+    """Hash del contenido de cada incidencia en el estado dado ('' si ya no existe)."""
+    versions = []
+    for incident_id in incident_ids:
+        entry = kb_state.get(incident_id)
+        if entry is None:
+            versions.append("")
+        else:
+            versions.append(hashlib.sha1(json.dumps(entry, sort_keys=True, ensure_ascii=False).encode("utf-8")).hexdigest())
+    return tuple(versions)
+
+
+class AnswerCache:
+    def __init__(self, min_similarity: float = ANSWER_CACHE_MIN_SIMILARITY, max_entries: int = ANSWER_CACHE_MAX_ENTRIES,
+                 max_bytes: int = int(ANSWER_CACHE_MAX_MB * 1024 * 1024), ttl_seconds: float = ANSWER_CACHE_TTL_SECONDS,
+                 enabled: bool = ANSWER_CACHE_ENABLED):
+        self.min_similarity = min_similarity
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl_seconds = ttl_seconds
+        self.enabled = enabled
+        # LRU de entradas por número de entrada y, por cada conjunto de incidencias, sus entradas.
+        self._entries: "OrderedDict[int, _Entry]" = OrderedDict()
+        self._buckets: Dict[Tuple[str, ...], List[int]] = {}
+        self._ids = itertools.count()
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    @staticmethod
+    def _key(incident_ids: Sequence[str]) -> Tuple[str, ...]:
+        return tuple(sorted(set(incident_ids)))
+
+    def get(self, incident_ids: Sequence[str], query_vector: Any, kb_state: kb_service.KBState) -> Optional[Dict[str, Any]]:
+        if not self.enabled or not incident_ids:
+            return None
+        key = self._key(incident_ids)
+        query = _unit(query_vector)
+        versions = incident_versions(kb_state, key)
+        now = time.monotonic()
+
+        best, best_score = None, self.min_similarity
+        with self._lock:
+            for number in list(self._buckets.get(key, ())):
+                entry = self._entries[number]
+                if now - entry.created > self.ttl_seconds:
+                    self._drop(number)
+                    continue
+                if entry.versions != versions:
+                    # Alguna incidencia ha cambiado desde que se generó la respuesta.
+                    self._drop(number)
+                    self.invalidations += 1
+                    metrics.inc("answer_cache_invalidations")
+                    continue
+                if entry.vector.shape != query.shape:
+                    continue
+                score = float(entry.vector @ query)
+                if score >= best_score:
+                    best, best_score = number, score
+            if best is None:
+                self.misses += 1
+            else:
+                self._entries.move_to_end(best)
+                self.hits += 1
+                answer = self._entries[best].answer
+        if best is None:
+            metrics.inc("answer_cache_misses")
+            return None
+        metrics.inc("answer_cache_hits")
+        metrics.observe("answer_cache_hit_similarity", best_score)
+        return dict(answer)
+
+    def put(self, incident_ids: Sequence[str], query_vector: Any, kb_state: kb_service.KBState,
+            answer: Dict[str, Any]) -> None:
+        if not self.enabled or not incident_ids:
+            return
+        key = self._key(incident_ids)
+        vector = _unit(query_vector)
+        entry = _Entry(
+            key=key,
+            vector=vector,
+            versions=incident_versions(kb_state, key),
+            answer=dict(answer),
+            created=time.monotonic(),
+            size=vector.nbytes + len(json.dumps(answer, ensure_ascii=False).encode("utf-8"))
+        )
+        if entry.size > self.max_bytes:
+            return
+        with self._lock:
+            number = next(self._ids)
+            self._entries[number] = entry
+            self._buckets.setdefault(key, []).append(number)
+            self._bytes += entry.size
+            while self._entries and (len(self._entries) > self.max_entries or self._bytes > self.max_bytes):
+                self._drop(next(iter(self._entries)))
+                self.evictions += 1
+                metrics.inc("answer_cache_evictions")
+            metrics.set_gauge("answer_cache_entries", len(self._entries))
+            metrics.set_gauge("answer_cache_bytes", self._bytes)
+
+    def invalidate(self, incident_id: str) -> int:
+        """Descarta las respuestas que usaron la incidencia."""
+        with self._lock:
+            stale = [number for number, entry in self._entries.items() if incident_id in entry.key]
+            for number in stale:
+                self._drop(number)
+            self.invalidations += len(stale)
+        if stale:
+            metrics.inc("answer_cache_invalidations", len(stale))
+        return len(stale)
+
+    def _drop(self, number: int) -> None:
+        entry = self._entries.pop(number)
+        self._bytes -= entry.size
+        bucket = self._buckets[entry.key]
+        bucket.remove(number)
+        if not bucket:
+            del self._buckets[entry.key]
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+            self._buckets.clear()
+            self._bytes = 0
+
+    def stats(self) -> dict:
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                "enabled": self.enabled,
+                "entries": len(self._entries),
+                "bytes": self._bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "invalidations": self.invalidations,
+                "hit_ratio": self.hits / total if total else 0.0
+            }
+
+
+ANSWER_CACHE = AnswerCache()
+
+
+def _on_new_generation(state: kb_service.KBState) -> None:
+    # Con un cambio de una sola entrada se liberan ya sus respuestas; en una recarga completa
+    # las entradas obsoletas se descartan al consultarlas (comparando versiones).
+    if state.change is not None:
+        ANSWER_CACHE.invalidate(state.change.entry_id)
+
+
+kb_service.subscribe(_on_new_generation)
@@ -0,0 +1,272 @@
+import math
+from collections import Counter
+from typing import Dict, List, Optional, Sequence, Tuple
+
+import numpy as np
+from scipy import sparse
+
+"""
+Índice BM25 disperso (variante Okapi de rank_bm25).
+Las frecuencias se guardan en una matriz término-documento CSC, de modo que puntuar
+una consulta solo recorre los documentos que contienen sus términos. Admite altas y
+bajas de incidencias sueltas y búsqueda top-k con poda MaxScore.
+"""
+
+# Por debajo de este tamaño la puntuación completa es más barata que la poda.
+MAXSCORE_MIN_DOCS = 50000
+
+
+class SparseBM25:
+    def __init__(
+        self,
+        corpus: Sequence[Sequence[str]] = (),
+        doc_ids: Optional[Sequence[str]] = None,
+        k1: float = 1.5,
+        b: float = 0.75,
+        epsilon: float = 0.25
+    ):
+        self.k1 = k1
+        self.b = b
+        self.epsilon = epsilon
+
+        self.vocab: Dict[str, int] = {}
+        self.terms: List[str] = []
+        self.df: List[int] = []
+
+        self.doc_ids: List[str] = []
+        self._doc_terms: List[np.ndarray] = []
+        self._doc_tfs: List[np.ndarray] = []
+        self._doc_len: List[int] = []
+        self._total_len = 0
+
+        self._dirty = True
+        self._weights: Optional[sparse.csc_matrix] = None
+        self._idf: Optional[np.ndarray] = None
+        self._max_weight: Optional[np.ndarray] = None
+
+        if doc_ids is None:
+            doc_ids = [str(i) for i in range(len(corpus))]
+        for doc_id, tokens in zip(doc_ids, corpus):
+            self.add_document(doc_id, tokens)
+
+    @property
+    def corpus_size(self) -> int:
+        return len(self.doc_ids)
+
+    def _count_terms(self, tokens: Sequence[str]) -> Tuple[np.ndarray, np.ndarray]:
+        # Columnas y frecuencias del documento; da de alta los términos nuevos y suma su df.
+        frequencies = Counter(tokens)
+        cols = np.empty(len(frequencies), dtype=np.int64)
+        tfs = np.empty(len(frequencies), dtype=np.float64)
+        for i, (term, freq) in enumerate(frequencies.items()):
+            col = self.vocab.get(term)
+            if col is None:
+                col = len(self.terms)
+                self.vocab[term] = col
+                self.terms.append(term)
+                self.df.append(0)
+            self.df[col] += 1
+            cols[i] = col
+            tfs[i] = freq
+        return cols, tfs
+
+    def add_document(self, doc_id: str, tokens: Sequence[str]) -> None:
+        cols, tfs = self._count_terms(tokens)
+        self.doc_ids.append(doc_id)
+        self._doc_terms.append(cols)
+        self._doc_tfs.append(tfs)
+        self._doc_len.append(len(tokens))
+        self._total_len += len(tokens)
+        self._dirty = True
+
+    def splice(self, start: int, stop: int, documents: Sequence[Tuple[str, Sequence[str]]]) -> None:
+        """Sustituye los documentos start:stop por `documents` [(id, tokens)] sin mover el resto."""
+        for pos in range(start, stop):
+            for col in self._doc_terms[pos]:
+                self.df[col] -= 1
+            self._total_len -= self._doc_len[pos]
+
+        counted = [self._count_terms(tokens) for _, tokens in documents]
+        self.doc_ids[start:stop] = [doc_id for doc_id, _ in documents]
+        self._doc_terms[start:stop] = [cols for cols, _ in counted]
+        self._doc_tfs[start:stop] = [tfs for _, tfs in counted]
+        self._doc_len[start:stop] = [len(tokens) for _, tokens in documents]
+        self._total_len += sum(len(tokens) for _, tokens in documents)
+        self._dirty = True
+
+    def copy(self) -> "SparseBM25":
+        """
+        Copia independiente para modificarla sin tocar un índice que ya se está consultando.
+        Los arrays de cada documento y los pesos calculados se comparten: nunca se modifican.
+        """
+        clone = SparseBM25.__new__(SparseBM25)
+        clone.__dict__.update(self.__dict__)
+        clone.vocab = dict(self.vocab)
+        clone.terms = list(self.terms)
+        clone.df = list(self.df)
+        clone.doc_ids = list(self.doc_ids)
+        clone._doc_terms = list(self._doc_terms)
+        clone._doc_tfs = list(self._doc_tfs)
+        clone._doc_len = list(self._doc_len)
+        return clone
+
+    def refresh(self) -> None:
+        """Recalcula ya idf y pesos pendientes, para que no lo pague la primera consulta."""
+        self._refresh()
+
+    def remove_document(self, doc_id: str) -> bool:
+        # Las posiciones siguen el orden de inserción (el mismo que la lista de la KB).
+        try:
+            pos = self.doc_ids.index(doc_id)
+        except ValueError:
+            return False
+
+        for col in self._doc_terms[pos]:
+            self.df[col] -= 1
+        self._total_len -= self._doc_len[pos]
+
+        del self.doc_ids[pos]
+        del self._doc_terms[pos]
+        del self._doc_tfs[pos]
+        del self._doc_len[pos]
+        self._dirty = True
+        return True
+
+    def _refresh(self) -> None:
+        # idf, avgdl y los pesos dependen de todo el corpus, así que tras una alta o
+        # baja se recalculan una sola vez (vectorizado) en la siguiente consulta.
+        if not self._dirty:
+            return
+
+        n_docs = self.corpus_size
+        n_terms = len(self.terms)
+        if n_docs == 0:
+            self._weights = sparse.csc_matrix((0, n_terms))
+            self._idf = np.zeros(n_terms)
+            self._max_weight = np.zeros(n_terms)
+            self._dirty = False
+            return
+
+        # Mismo orden de operaciones que BM25Okapi para obtener puntuaciones idénticas.
+        idf = np.zeros(n_terms)
+        idf_sum = 0
+        n_present = 0
+        negative = []
+        for col, freq in enumerate(self.df):
+            if freq <= 0:
+                continue
+            value = math.log(n_docs - freq + 0.5) - math.log(freq + 0.5)
+            idf[col] = value
+            idf_sum += value
+            n_present += 1
+            if value < 0:
+                negative.append(col)
+        eps = self.epsilon * (idf_sum / n_present) if n_present else 0.0
+        idf[negative] = eps
+
+        avgdl = self._total_len / n_docs
+        doc_len = np.asarray(self._doc_len)
+        lengths = np.fromiter((len(cols) for cols in self._doc_terms), dtype=np.int64, count=n_docs)
+        rows = np.repeat(np.arange(n_docs), lengths)
+        cols = np.concatenate(self._doc_terms) if n_docs else np.empty(0, dtype=np.int64)
+        tf = np.concatenate(self._doc_tfs) if n_docs else np.empty(0)
+
+        values = tf * (self.k1 + 1) / (tf + self.k1 * (1 - self.b + self.b * doc_len[rows] / avgdl))
+        weights = sparse.csc_matrix((values, (rows, cols)), shape=(n_docs, n_terms))
+        weights.sort_indices()
+
+        self._weights = weights
+        self._idf = idf
+        self._max_weight = np.asarray(weights.max(axis=0).todense()).ravel() if weights.nnz else np.zeros(n_terms)
+        self._dirty = False
+
+    def _column(self, col: int) -> Tuple[np.ndarray, np.ndarray]:
+        start, end = self._weights.indptr[col], self._weights.indptr[col + 1]
+        return self._weights.indices[start:end], self._weights.data[start:end]
+
+    def get_scores(self, query: Sequence[str]) -> np.ndarray:
+        self._refresh()
+        scores = np.zeros(self.corpus_size)
+        for term in query:
+            col = self.vocab.get(term)
+            if col is None or self.df[col] <= 0:
+                continue
+            rows, weights = self._column(col)
+            scores[rows] += self._idf[col] * weights
+        return scores
+
+    def score_documents(self, query: Sequence[str], positions: np.ndarray) -> np.ndarray:
+        """Puntuaciones solo de las posiciones dadas; mismo resultado que get_scores(query)[positions]."""
+        self._refresh()
+        positions = np.asarray(positions, dtype=np.int64)
+        scores = np.zeros(len(positions))
+        for term in query:
+            col = self.vocab.get(term)
+            if col is None or self.df[col] <= 0:
+                continue
+            rows, weights = self._column(col)
+            hit = np.searchsorted(rows, positions)
+            hit_ok = hit < len(rows)
+            hit_ok[hit_ok] = rows[hit[hit_ok]] == positions[hit_ok]
+            scores[hit_ok] += self._idf[col] * weights[hit[hit_ok]]
+        return scores
+
+    def top_k(self, query: Sequence[str], k: int) -> Tuple[np.ndarray, np.ndarray]:
+        """Devuelve (posiciones, puntuaciones) de los k mejores documentos, de mayor a menor."""
+        self._refresh()
+        k = min(k, self.corpus_size)
+        if k <= 0:
+            return np.empty(0, dtype=np.int64), np.empty(0)
+
+        if self.corpus_size < MAXSCORE_MIN_DOCS:
+            scores = self.get_scores(query)
+            top = np.argpartition(-scores, k - 1)[:k]
+            top = top[np.argsort(-scores[top], kind="stable")]
+            return top, scores[top]
+
+        return self._top_k_maxscore(query, k)
+
+    def _top_k_maxscore(self, query: Sequence[str], k: int) -> Tuple[np.ndarray, np.ndarray]:
+        # Los términos repetidos se agrupan: su contribución es peso * idf * repeticiones.
+        counts = Counter(
+            self.vocab[t] for t in query
+            if t in self.vocab and self.df[self.vocab[t]] > 0
+        )
+        terms = [(col, self._idf[col] * reps) for col, reps in counts.items()]
+        if not terms or any(q < 0 for _, q in terms):
+            # Con idf negativos las cotas superiores dejan de ser válidas.
+            scores = self.get_scores(query)
+            top = np.argsort(-scores, kind="stable")[:k]
+            return top, scores[top]
+
+        upper = {col: q * self._max_weight[col] for col, q in terms}
+        terms.sort(key=lambda t: upper[t[0]], reverse=True)
+        # remaining_after[i]: máximo que aún pueden sumar los términos posteriores al i-ésimo.
+        remaining_after = [sum(upper[col] for col, _ in terms[i + 1:]) for i in range(len(terms))]
+        scores = np.zeros(self.corpus_size)
+        candidates: Optional[np.ndarray] = None
+
+        for (col, q), remaining in zip(terms, remaining_after):
+            rows, weights = self._column(col)
+
+            if candidates is None:
+                scores[rows] += q * weights
+                touched = np.flatnonzero(scores)
+                if len(touched) < k:
+                    continue
+                threshold = np.partition(scores[touched], len(touched) - k)[len(touched) - k]
+                if remaining < threshold:
+                    # Ningún documento no visto puede alcanzar ya el top-k: a partir de
+                    # aquí solo se completan las puntuaciones de los candidatos.
+                    candidates = touched[scores[touched] + remaining >= threshold]
+            else:
+                hit = np.searchsorted(rows, candidates)
+                hit_ok = hit < len(rows)
+                hit_ok[hit_ok] = rows[hit[hit_ok]] == candidates[hit_ok]
+                scores[candidates[hit_ok]] += q * weights[hit[hit_ok]]
+                threshold = np.partition(scores[candidates], len(candidates) - k)[len(candidates) - k]
+                candidates = candidates[scores[candidates] + remaining >= threshold]
+
+        pool = candidates if candidates is not None else np.arange(self.corpus_size)
+        top = pool[np.argsort(-scores[pool], kind="stable")[:k]]
+        return top, scores[top]
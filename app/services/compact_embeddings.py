@@ -0,0 +1,152 @@
+from typing import Optional, Tuple
+
+import numpy as np
+
+from app.config import (
+    EMBEDDING_STORAGE_DTYPE,
+    EMBEDDING_REDUCED_DIM,
+    EMBEDDING_REDUCTION
+)
+
+"""
+Almacenamiento compacto de la matriz de embeddings de la KB.
+- dtype: "float32" (sin cambios), "float16" o "int8" (una escala por vector).
+- Reducción opcional de dimensión: "truncate" (primeras columnas) o "pca".
+La puntuación se hace sobre la forma compacta, por bloques, sin reconstruir la matriz
+completa en float32. Con PCA se suma mean·q para que los scores sigan siendo comparables
+con los del modelo original (los umbrales del modo híbrido dependen de ellos).
+"""
+
+SCORE_BLOCK_ROWS = 8192
+PCA_FIT_ROWS = 20000
+
+
+class CompactEmbeddings:
+    def __init__(self, codes: np.ndarray, scales: Optional[np.ndarray] = None, mean: Optional[np.ndarray] = None,
+                 components: Optional[np.ndarray] = None, storage_dtype: str = "float32", reduction: str = ""):
+        self.codes = codes
+        self.scales = scales
+        self.mean = mean
+        self.components = components
+        self.storage_dtype = storage_dtype
+        self.reduction = reduction
+
+    @classmethod
+    def from_matrix(cls, matrix: np.ndarray, storage_dtype: str = EMBEDDING_STORAGE_DTYPE,
+                    dim: int = EMBEDDING_REDUCED_DIM, reduction: str = EMBEDDING_REDUCTION,
+                    seed: int = 0) -> "CompactEmbeddings":
+        mean = components = None
+        reduced = matrix
+        if dim and dim < matrix.shape[1]:
+            if reduction == "pca":
+                rng = np.random.default_rng(seed)
+                rows = rng.choice(matrix.shape[0], min(matrix.shape[0], PCA_FIT_ROWS), replace=False)
+                sample = np.asarray(matrix[np.sort(rows)], dtype=np.float32)
+                mean = sample.mean(axis=0)
+                _, _, vt = np.linalg.svd(sample - mean, full_matrices=False)
+                components = np.ascontiguousarray(vt[:dim], dtype=np.float32)
+                # Con menos vectores que dimensiones, PCA devuelve menos componentes.
+                reduced = np.empty((matrix.shape[0], components.shape[0]), dtype=np.float32)
+                for start in range(0, matrix.shape[0], SCORE_BLOCK_ROWS):
+                    block = np.asarray(matrix[start:start + SCORE_BLOCK_ROWS], dtype=np.float32)
+                    reduced[start:start + SCORE_BLOCK_ROWS] = (block - mean) @ components.T
+            else:
+                reduction = "truncate"
+                reduced = np.ascontiguousarray(matrix[:, :dim], dtype=np.float32)
+        else:
+            reduction = ""
+
+        if storage_dtype not in ("float16", "int8"):
+            storage_dtype = "float32"
+        codes, scales = cls._quantize(reduced if reduction else matrix, storage_dtype)
+        return cls(codes, scales, mean, components, storage_dtype, reduction)
+
+    @staticmethod
+    def _quantize(reduced: np.ndarray, storage_dtype: str) -> Tuple[np.ndarray, Optional[np.ndarray]]:
+        if storage_dtype == "float16":
+            return np.ascontiguousarray(reduced, dtype=np.float16), None
+        if storage_dtype == "int8":
+            reduced = np.asarray(reduced, dtype=np.float32)
+            scales = np.abs(reduced).max(axis=1) / 127.0
+            scales[scales == 0] = 1.0
+            codes = np.clip(np.rint(reduced / scales[:, None]), -127, 127).astype(np.int8)
+            return codes, scales.astype(np.float32)
+        return reduced, None
+
+    def encode(self, matrix: np.ndarray) -> Tuple[np.ndarray, Optional[np.ndarray]]:
+        """Codifica vectores nuevos con la reducción ya ajustada (misma media y componentes PCA)."""
+        reduced = np.atleast_2d(np.asarray(matrix, dtype=np.float32))
+        if self.reduction == "pca":
+            reduced = (reduced - self.mean) @ self.components.T
+        elif self.reduction == "truncate":
+            reduced = np.ascontiguousarray(reduced[:, :self.codes.shape[1]])
+        return self._quantize(reduced, self.storage_dtype)
+
+    def splice(self, start: int, stop: int, matrix: np.ndarray) -> "CompactEmbeddings":
+        """
+        Copia con las filas start:stop sustituidas por los vectores de `matrix` (que pueden
+        ser más o menos filas). La original no se modifica: las búsquedas en curso siguen con ella.
+        """
+        if len(matrix):
+            codes, scales = self.encode(matrix)
+        else:
+            codes = np.empty((0, self.codes.shape[1]), dtype=self.codes.dtype)
+            scales = np.empty(0, dtype=np.float32)
+        new_codes = np.concatenate([self.codes[:start], codes.astype(self.codes.dtype, copy=False), self.codes[stop:]])
+        new_scales = None
+        if self.scales is not None:
+            new_scales = np.concatenate([self.scales[:start], scales, self.scales[stop:]]).astype(np.float32)
+        return CompactEmbeddings(new_codes, new_scales, self.mean, self.components, self.storage_dtype, self.reduction)
+
+    @property
+    def shape(self) -> Tuple[int, int]:
+        return self.codes.shape
+
+    @property
+    def nbytes(self) -> int:
+        total = self.codes.nbytes
+        for extra in (self.scales, self.mean, self.components):
+            if extra is not None:
+                total += extra.nbytes
+        return total
+
+    def __len__(self) -> int:
+        return self.codes.shape[0]
+
+    def project(self, query: np.ndarray) -> Tuple[np.ndarray, float]:
+        """Lleva la consulta al espacio almacenado. Devuelve (consulta, desplazamiento del score)."""
+        query = np.asarray(query, dtype=np.float32).reshape(-1)
+        if self.reduction == "pca":
+            return self.components @ query, float(self.mean @ query)
+        if self.reduction == "truncate":
+            return query[:self.codes.shape[1]], 0.0
+        return query, 0.0
+
+    def decode(self, rows=None) -> np.ndarray:
+        """Vectores en el espacio almacenado (reducido), en float32."""
+        codes = self.codes if rows is None else self.codes[rows]
+        if self.storage_dtype == "float32":
+            return codes
+        decoded = codes.astype(np.float32)
+        if self.scales is not None:
+            scales = self.scales if rows is None else self.scales[rows]
+            decoded *= np.reshape(scales, (-1,) + (1,) * (decoded.ndim - 1))
+        return decoded
+
+    def score_projected(self, query: np.ndarray, rows=None) -> np.ndarray:
+        codes = self.codes if rows is None else self.codes[rows]
+        if self.storage_dtype == "float32":
+            return codes @ query
+
+        scores = np.empty(codes.shape[0], dtype=np.float32)
+        for start in range(0, codes.shape[0], SCORE_BLOCK_ROWS):
+            block = codes[start:start + SCORE_BLOCK_ROWS].astype(np.float32)
+            scores[start:start + SCORE_BLOCK_ROWS] = block @ query
+        if self.scales is not None:
+            scores *= self.scales if rows is None else self.scales[rows]
+        return scores
+
+    def score(self, query: np.ndarray, rows=None) -> np.ndarray:
+        projected, offset = self.project(query)
+        scores = self.score_projected(projected, rows)
+        return scores + offset if offset else scores
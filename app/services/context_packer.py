@@ -0,0 +1,175 @@
+import json
+from dataclasses import dataclass
+from typing import Any, Dict, List, NamedTuple, Optional, Sequence, Tuple
+
+from app.config import (
+    CONTEXT_MAX_TOKENS,
+    CONTEXT_MAX_SCORE_DROP,
+    CONTEXT_MAX_SCORE_GAP,
+    CONTEXT_FULL_INCIDENTS,
+    CONTEXT_FULL_FIELDS,
+    CONTEXT_STEP_FIELDS,
+    CONTEXT_BRIEF_FIELDS,
+    CONTEXT_STEPS_PER_INCIDENT
+)
+from app.services import metrics
+from app.services.conversation_history import estimate_tokens
+
+"""
+Empaquetado de las incidencias que se mandan al LLM en el modo generativo.
+Cada incidencia se serializa una sola vez al cargar la KB (kb_service) en dos formas
+compactas: completa (pasos de resolución sin llm_instruction) y resumida (id, título y
+descripción). En cada consulta se eligen las incidencias según sus puntuaciones y se
+rellena el prompt hasta CONTEXT_MAX_TOKENS, pasando a la forma resumida lo que no cabe.
+Si hay índice de pasajes, de las incidencias completas solo van sus pasos más relevantes.
+"""
+
+# Campos que están dentro de resolution_guide_llm en la KB.
+GUIDE_FIELDS = ("initial_questions", "diagnostic_steps")
+
+
+def _fields(spec: str) -> Tuple[str, ...]:
+    return tuple(field.strip() for field in spec.split(",") if field.strip())
+
+
+FULL_FIELDS = _fields(CONTEXT_FULL_FIELDS)
+STEP_FIELDS = _fields(CONTEXT_STEP_FIELDS)
+BRIEF_FIELDS = _fields(CONTEXT_BRIEF_FIELDS)
+
+
+def _project(incident: Dict[str, Any], fields: Sequence[str]) -> Dict[str, Any]:
+    guide = incident.get("resolution_guide_llm") or {}
+    compact = {}
+    for field in fields:
+        value = guide.get(field) if field in GUIDE_FIELDS else incident.get(field)
+        if field == "diagnostic_steps" and isinstance(value, list):
+            value = [
+                {k: step[k] for k in STEP_FIELDS if k in step} if isinstance(step, dict) else step
+                for step in value
+            ]
+        if value not in (None, "", [], {}):
+            compact[field] = value
+    return compact
+
+
+def _dumps(value: Any) -> str:
+    return json.dumps(value, ensure_ascii=False, separators=(",", ":"))
+
+
+class IncidentTexts(NamedTuple):
+    full: str
+    brief: str
+    # Forma completa sin diagnostic_steps y cada paso por separado, para componer la
+    # incidencia solo con los pasos elegidos sin volver a serializar nada.
+    head: str
+    steps: List[str]
+
+
+def serialize_incident(incident: Dict[str, Any]) -> IncidentTexts:
+    """Formas completa y resumida de una incidencia, en JSON compacto."""
+    full = _project(incident, FULL_FIELDS)
+    head = {k: v for k, v in full.items() if k != "diagnostic_steps"}
+    steps = [_dumps(step) for step in full.get("diagnostic_steps", [])]
+    return IncidentTexts(_dumps(full), _dumps(_project(incident, BRIEF_FIELDS)), _dumps(head), steps)
+
+
+def with_steps(texts: IncidentTexts, items: Sequence[int]) -> str:
+    """Forma completa con solo los pasos indicados (índices en diagnostic_steps)."""
+    chosen = [texts.steps[i] for i in items if 0 <= i < len(texts.steps)]
+    if not chosen:
+        return texts.head
+    separator = "," if texts.head != "{}" else ""
+    return f'{texts.head[:-1]}{separator}"diagnostic_steps":[{",".join(chosen)}]}}'
+
+
+@dataclass(frozen=True)
+class Retrieval:
+    """Resultado de la búsqueda generativa: todo referido al mismo estado de la KB."""
+    kb_state: Any
+    scored: List[Tuple[int, float]]
+    past_positions: List[int]
+    # Vector de la consulta e índice de pasajes del snapshot, para elegir pasos sin recodificar.
+    query: Any = None
+    passages: Any = None
+
+
+@dataclass(frozen=True)
+class PackedContext:
+    text: str
+    ids: List[str]
+    tokens: int
+    candidates: int
+    dropped: int
+
+
+def select_by_score(scored: Sequence[Tuple[int, float]], max_drop: float = CONTEXT_MAX_SCORE_DROP,
+                    max_gap: float = CONTEXT_MAX_SCORE_GAP) -> List[int]:
+    """
+    Posiciones que merece la pena mandar, de mayor a menor puntuación. La mejor se
+    conserva siempre; el resto no debe alejarse de la mejor más de max_drop y se corta en
+    el primer salto de más de max_gap entre dos consecutivas, ambos como fracción de la
+    mejor puntuación, así que no dependen de la escala (coseno o producto escalar).
+    """
+    if not scored:
+        return []
+    best = scored[0][1]
+    selected = [scored[0][0]]
+    if best <= 0:
+        return selected
+    previous = best
+    for position, score in scored[1:]:
+        if (best - score) / best > max_drop or (previous - score) / best > max_gap:
+            break
+        selected.append(position)
+        previous = score
+    return selected
+
+
+def pack_context(retrieval: Retrieval, max_tokens: int = CONTEXT_MAX_TOKENS,
+                 full_incidents: int = CONTEXT_FULL_INCIDENTS,
+                 steps_per_incident: int = CONTEXT_STEPS_PER_INCIDENT) -> PackedContext:
+    """
+    Rellena el contexto con las incidencias seleccionadas y después con las que el usuario
+    ya vio en el turno anterior (para poder seguir con sus pasos), sin pasar de max_tokens.
+    """
+    kb_state, scored = retrieval.kb_state, retrieval.scored
+    selected = select_by_score(scored)
+    ordered = [(pos, i < full_incidents) for i, pos in enumerate(selected)]
+    ordered += [(pos, True) for pos in retrieval.past_positions]
+    trim_steps = steps_per_incident > 0 and retrieval.passages is not None and retrieval.query is not None
+
+    seen = set()
+    candidates = 0
+    parts: List[str] = []
+    ids: List[str] = []
+    used = 0
+    for position, full in ordered:
+        incident_id = kb_state.entries[position].get("id")
+        if incident_id in seen:
+            continue
+        seen.add(incident_id)
+        candidates += 1
+
+        texts = kb_state.prompt_texts[position]
+        full_text, brief_text = texts.full, texts.brief
+        if full and trim_steps and len(texts.steps) > steps_per_incident:
+            full_text = with_steps(texts, retrieval.passages.best_steps(retrieval.query, position, steps_per_incident))
+            metrics.inc("context_steps_trimmed", len(texts.steps) - steps_per_incident)
+        options = (full_text, brief_text) if full else (brief_text,)
+        text = next((t for t in options if used + estimate_tokens(t) <= max_tokens), None)
+        if text is None and not parts:
+            # La mejor incidencia entra siempre, aunque sea resumida, para no dejar el prompt vacío.
+            text = brief_text
+        if text is not None:
+            parts.append(text)
+            ids.append(incident_id)
+            used += estimate_tokens(text)
+
+    dropped = len(scored) - len(selected) + candidates - len(parts)
+    packed = PackedContext(text="\n".join(parts), ids=ids, tokens=used, candidates=candidates, dropped=dropped)
+
+    metrics.observe("context_tokens", packed.tokens)
+    metrics.observe("context_incidents", len(packed.ids))
+    metrics.observe("context_incidents_dropped", packed.dropped)
+    print(f"Context packed: {len(packed.ids)} incidents, ~{packed.tokens} tokens, {packed.dropped} dropped.")
+    return packed
@@ -0,0 +1,242 @@
+import atexit
+import os
+import threading
+import time
+from collections import OrderedDict
+from typing import Dict, Optional
+
+import numpy as np
+
+from app.config import (
+    CONTEXT_STORE_MAX_SESSIONS,
+    CONTEXT_STORE_MAX_MB,
+    CONTEXT_STORE_TTL_SECONDS,
+    CONTEXT_STORE_PATH,
+    CONTEXT_STORE_FLUSH_SECONDS
+)
+from app.services import metrics
+
+"""
+Contexto de conversación por usuario para el modo generativo.
+Cada sesión guarda un acumulador con decaimiento exponencial
+    S_t = d·S_{t-1} + e_t − d^h·e_{t-h}
+y una ventana circular con los últimos h embeddings, así que añadir un mensaje cuesta
+O(dim) sea cual sea la longitud de la conversación y el resultado es el mismo que sumar
+d^i·e_{t-i} sobre los h últimos mensajes. Las sesiones se expulsan por LRU, TTL y
+presupuesto de memoria, y se persisten en float16 para sobrevivir a un reinicio.
+"""
+
+
+class UserContext:
+    __slots__ = ("accumulator", "window", "head", "count", "decay", "touched_at", "updated_at")
+
+    def __init__(self, dim: int, max_history: int, decay: float):
+        self.accumulator = np.zeros(dim, dtype=np.float32)
+        self.window = np.zeros((max_history, dim), dtype=np.float32)
+        self.head = 0
+        self.count = 0
+        self.decay = decay
+        self.touched_at = time.monotonic()
+        self.updated_at = time.time()
+
+    @property
+    def nbytes(self) -> int:
+        return self.accumulator.nbytes + self.window.nbytes
+
+    def recompute(self, decay: float) -> None:
+        # Si cambia el factor de decaimiento se rehace el acumulador desde la ventana.
+        self.decay = decay
+        self.accumulator[:] = 0
+        max_history = self.window.shape[0]
+        for i in range(self.count):
+            slot = (self.head - self.count + i) % max_history
+            self.accumulator *= decay
+            self.accumulator += self.window[slot]
+
+    def add(self, embedding: np.ndarray) -> np.ndarray:
+        max_history = self.window.shape[0]
+        self.accumulator *= self.decay
+        if self.count == max_history:
+            self.accumulator -= (self.decay ** max_history) * self.window[self.head]
+        self.accumulator += embedding
+        self.window[self.head] = embedding
+        self.head = (self.head + 1) % max_history
+        self.count = min(self.count + 1, max_history)
+        self.touched_at = time.monotonic()
+        self.updated_at = time.time()
+        return self.accumulator
+
+
+class ContextStore:
+    def __init__(self, max_sessions: int = CONTEXT_STORE_MAX_SESSIONS,
+                 max_bytes: int = int(CONTEXT_STORE_MAX_MB * 1024 * 1024),
+                 ttl_seconds: float = CONTEXT_STORE_TTL_SECONDS, path: str = CONTEXT_STORE_PATH,
+                 flush_seconds: float = CONTEXT_STORE_FLUSH_SECONDS):
+        self.max_sessions = max_sessions
+        self.max_bytes = max_bytes
+        self.ttl_seconds = ttl_seconds
+        self.path = path
+        self.flush_seconds = flush_seconds
+        self._sessions: "OrderedDict[str, UserContext]" = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self._dirty = False
+        self._loaded = False
+        self._flusher: Optional[threading.Thread] = None
+        self.evictions = 0
+
+    def update(self, user: str, embedding: np.ndarray, decay: float, max_history: int) -> np.ndarray:
+        """Añade el embedding del mensaje y devuelve el contexto normalizado del usuario."""
+        embedding = np.asarray(embedding, dtype=np.float32).reshape(-1)
+        self._ensure_loaded()
+        with self._lock:
+            session = self._sessions.get(user)
+            if session is not None and self._expired(session):
+                self._drop(user, "ttl")
+                session = None
+            if session is not None and session.window.shape != (max_history, embedding.shape[0]):
+                self._drop(user, "reshape")
+                session = None
+            if session is None:
+                session = UserContext(embedding.shape[0], max_history, decay)
+                self._sessions[user] = session
+                self._bytes += session.nbytes
+            elif session.decay != decay:
+                session.recompute(decay)
+
+            context = session.add(embedding).copy()
+            self._sessions.move_to_end(user)
+            self._dirty = True
+            self._evict()
+            self._record()
+
+        norm = np.linalg.norm(context)
+        return context / norm if norm > 0 else context
+
+    def forget(self, user: str) -> bool:
+        with self._lock:
+            if user not in self._sessions:
+                return False
+            self._drop(user, "forget")
+            self._dirty = True
+            self._record()
+            return True
+
+    def _expired(self, session: UserContext) -> bool:
+        return time.monotonic() - session.touched_at > self.ttl_seconds
+
+    def _drop(self, user: str, reason: str) -> None:
+        session = self._sessions.pop(user)
+        self._bytes -= session.nbytes
+        if reason in ("lru", "ttl", "memory"):
+            self.evictions += 1
+            metrics.inc("context_store_evictions", reason=reason)
+
+    def _evict(self) -> None:
+        # Primero las sesiones caducadas (las más antiguas están al principio), luego LRU.
+        while self._sessions:
+            user, session = next(iter(self._sessions.items()))
+            if self._expired(session):
+                self._drop(user, "ttl")
+            elif len(self._sessions) > self.max_sessions:
+                self._drop(user, "lru")
+            elif self._bytes > self.max_bytes and len(self._sessions) > 1:
+                self._drop(user, "memory")
+            else:
+                break
+
+    def _record(self) -> None:
+        metrics.set_gauge("context_sessions_active", len(self._sessions))
+        metrics.set_gauge("context_store_bytes", self._bytes)
+
+    def stats(self) -> Dict[str, float]:
+        with self._lock:
+            return {"sessions": len(self._sessions), "bytes": self._bytes, "evictions": self.evictions}
+
+    def _ensure_loaded(self) -> None:
+        if self._loaded:
+            return
+        with self._lock:
+            if self._loaded:
+                return
+            self._loaded = True
+            if self.path:
+                self._load()
+                atexit.register(self.save)
+                if self.flush_seconds > 0:
+                    self._flusher = threading.Thread(target=self._flush_loop, name="context-store-flush", daemon=True)
+                    self._flusher.start()
+
+    def _flush_loop(self) -> None:
+        while True:
+            time.sleep(self.flush_seconds)
+            self.save()
+
+    def save(self) -> None:
+        """Persiste las ventanas en float16 (el acumulador se reconstruye al cargar)."""
+        if not self.path:
+            return
+        with self._lock:
+            if not self._dirty:
+                return
+            users = list(self._sessions)
+            sessions = [self._sessions[user] for user in users]
+            groups: Dict[tuple, list] = {}
+            for i, session in enumerate(sessions):
+                groups.setdefault(session.window.shape, []).append(i)
+            arrays = {"users": np.array(users, dtype=str)}
+            for g, (shape, members) in enumerate(groups.items()):
+                # Ventana rotada para que el mensaje más reciente quede en la última fila.
+                arrays[f"members_{g}"] = np.array(members, dtype=np.int64)
+                arrays[f"windows_{g}"] = np.stack([
+                    np.roll(sessions[i].window, -sessions[i].head, axis=0) for i in members
+                ]).astype(np.float16)
+            arrays["counts"] = np.array([s.count for s in sessions], dtype=np.int64)
+            arrays["decays"] = np.array([s.decay for s in sessions], dtype=np.float64)
+            arrays["updated_at"] = np.array([s.updated_at for s in sessions], dtype=np.float64)
+            self._dirty = False
+
+        try:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            tmp_path = self.path + ".tmp"
+            with open(tmp_path, "wb") as f:
+                np.savez(f, groups=np.array(len(groups)), **arrays)
+            os.replace(tmp_path, self.path)
+        except Exception as e:
+            print(f"Error saving context store {self.path}: {e}")
+
+    def _load(self) -> None:
+        # Se llama con _lock tomado.
+        if not os.path.exists(self.path):
+            return
+        try:
+            with np.load(self.path) as data:
+                users = data["users"].tolist()
+                counts, decays, updated_at = data["counts"], data["decays"], data["updated_at"]
+                now = time.time()
+                for g in range(int(data["groups"])):
+                    windows = data[f"windows_{g}"].astype(np.float32)
+                    for window, i in zip(windows, data[f"members_{g}"]):
+                        age = now - float(updated_at[i])
+                        if age > self.ttl_seconds:
+                            continue
+                        session = UserContext(window.shape[1], window.shape[0], float(decays[i]))
+                        session.window[:] = window
+                        session.count = int(counts[i])
+                        session.head = 0
+                        session.recompute(session.decay)
+                        session.touched_at = time.monotonic() - age
+                        session.updated_at = float(updated_at[i])
+                        self._sessions[users[i]] = session
+                        self._bytes += session.nbytes
+            # El orden LRU se reconstruye por antigüedad del último mensaje.
+            for user in sorted(self._sessions, key=lambda u: self._sessions[u].updated_at):
+                self._sessions.move_to_end(user)
+            self._evict()
+            self._record()
+            print(f"Context store restored with {len(self._sessions)} sessions.")
+        except Exception as e:
+            print(f"Error loading context store {self.path}: {e}")
+
+
+CONTEXT_STORE = ContextStore()
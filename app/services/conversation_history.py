@@ -0,0 +1,208 @@
+import asyncio
+import threading
+import time
+from concurrent.futures import Future
+from typing import Any, Dict, List, Optional
+
+from app.config import (
+    PROMPT_HISTORY_MAX_TOKENS,
+    CONVERSATION_SUMMARY_MIN_TURNS,
+    CONVERSATION_SUMMARY_MAX_WORDS,
+    CONVERSATION_MAX_STORED_TURNS
+)
+from app.services import metrics
+from app.services.conversation_store import CONVERSATION_STORE
+
+"""
+Historial de conversación que se guarda y se reenvía al LLM.
+Se guardan solo los turnos user/model (sin el prompt de sistema, que incluye las
+incidencias y se regenera en cada mensaje) y los ids de las incidencias. Al LLM se le
+mandan los turnos más recientes que caben en PROMPT_HISTORY_MAX_TOKENS; los anteriores
+se pliegan en un resumen que se actualiza en segundo plano y se guarda con la conversación.
+Los resúmenes corren en un bucle de eventos propio, en su hilo: la UI de Streamlit crea un
+bucle por mensaje con asyncio.run, que cancela al salir las tareas que queden pendientes.
+
+Formato guardado por usuario:
+    {"conversation": [{"role", "content", "timestamp"?}], "Incidents": [ids],
+     "summary": str, "summarized_turns": int}
+"""
+
+SUMMARY_PROMPT = """Resume la siguiente conversación entre un usuario y un asistente de soporte informático \
+en un máximo de {max_words} palabras. Conserva el problema del usuario, los pasos que ya se han probado \
+y lo que queda pendiente. Responde solo con el resumen.
+
+Resumen anterior:
+{summary}
+
+Conversación:
+{turns}"""
+
+_summary_tasks: Dict[str, Future] = {}
+_summary_lock = threading.Lock()
+_summary_loop: Optional[asyncio.AbstractEventLoop] = None
+
+
+def estimate_tokens(text: str) -> int:
+    # Aproximación de ~4 caracteres por token; basta para presupuestar y para las métricas.
+    return (len(text or "") + 3) // 4
+
+
+def _coerce_role(role: str) -> str:
+    return "user" if role == "user" else "model"
+
+
+def compact_turns(messages: Any) -> List[Dict[str, Any]]:
+    """Turnos user/model sin mensajes de sistema (las conversaciones antiguas los guardaban)."""
+    turns = []
+    for message in messages if isinstance(messages, list) else []:
+        if not isinstance(message, dict) or message.get("role") == "system":
+            continue
+        turn = {"role": _coerce_role(message.get("role", "user")), "content": message.get("content", "")}
+        if message.get("timestamp"):
+            turn["timestamp"] = message["timestamp"]
+        turns.append(turn)
+    return turns
+
+
+def load_record(user: str) -> Dict[str, Any]:
+    stored = CONVERSATION_STORE.get(user)
+    if isinstance(stored, dict):
+        messages = stored.get("conversation", [])
+        incidents = stored.get("Incidents", [])
+        summary = stored.get("summary", "")
+        summarized = int(stored.get("summarized_turns", 0))
+    else:
+        messages, incidents, summary, summarized = stored, [], "", 0
+
+    turns = compact_turns(messages)
+    return {
+        "conversation": turns,
+        "Incidents": list(incidents),
+        "summary": summary,
+        "summarized_turns": min(summarized, len(turns))
+    }
+
+
+def append_turns(user: str, turns: List[Dict[str, Any]], incident_ids: List[str]) -> Dict[str, Any]:
+    """Añade los turnos nuevos a lo último guardado y descarta los más antiguos ya resumidos."""
+    record = load_record(user)
+    record["conversation"].extend(compact_turns(turns))
+    record["Incidents"] = list(incident_ids)
+
+    excess = len(record["conversation"]) - CONVERSATION_MAX_STORED_TURNS
+    drop = min(max(excess, 0), record["summarized_turns"])
+    if drop:
+        del record["conversation"][:drop]
+        record["summarized_turns"] -= drop
+
+    CONVERSATION_STORE.put(user, record)
+    return record
+
+
+def _split_by_budget(turns: List[Dict[str, Any]], budget_tokens: int) -> int:
+    # Índice a partir del cual los turnos más recientes caben en el presupuesto.
+    used = 0
+    start = len(turns)
+    while start > 0:
+        cost = estimate_tokens(turns[start - 1].get("content", ""))
+        if used + cost > budget_tokens:
+            break
+        used += cost
+        start -= 1
+    return start
+
+
+def build_prompt_history(record: Dict[str, Any], budget_tokens: int = PROMPT_HISTORY_MAX_TOKENS) -> List[Dict[str, Any]]:
+    """Resumen (si lo hay) + turnos recientes sin resumir que caben en el presupuesto."""
+    pending = record["conversation"][record["summarized_turns"]:]
+    start = _split_by_budget(pending, budget_tokens)
+    recent = [{"role": turn["role"], "content": turn["content"]} for turn in pending[start:]]
+
+    history = []
+    if record.get("summary"):
+        history.append({"role": "system", "content": f"Resumen de la conversación anterior: {record['summary']}"})
+    history.extend(recent)
+
+    metrics.observe("prompt_history_turns", len(recent))
+    metrics.observe("prompt_history_tokens", sum(estimate_tokens(m["content"]) for m in history))
+    if start:
+        # Turnos que ya no caben y aún no están en el resumen: se plegarán en segundo plano.
+        metrics.inc("prompt_history_turns_dropped", start)
+    return history
+
+
+def record_prompt_size(system_msg: Dict[str, Any], history: List[Dict[str, Any]], user_message: str) -> int:
+    system_tokens = estimate_tokens(system_msg.get("content", ""))
+    history_tokens = sum(estimate_tokens(m.get("content", "")) for m in history)
+    total = system_tokens + history_tokens + estimate_tokens(user_message)
+    metrics.observe("prompt_tokens", system_tokens, part="system")
+    metrics.observe("prompt_tokens", history_tokens, part="history")
+    metrics.observe("prompt_tokens", total, part="total")
+    return total
+
+
+async def update_summary(user: str, budget_tokens: int = PROMPT_HISTORY_MAX_TOKENS) -> bool:
+    """Pliega en el resumen los turnos que ya no caben en el presupuesto del prompt."""
+    from app.services.gemini import call_gemini_prompt, PROMPT_FALLBACK_RESPONSE
+
+    record = load_record(user)
+    summarized = record["summarized_turns"]
+    pending = record["conversation"][summarized:]
+    overflow = _split_by_budget(pending, budget_tokens)
+    if overflow < CONVERSATION_SUMMARY_MIN_TURNS:
+        return False
+
+    turns_text = "\n".join(f"{turn['role'].upper()}: {turn['content']}" for turn in pending[:overflow])
+    start = time.perf_counter()
+    summary = await call_gemini_prompt(SUMMARY_PROMPT.format(
+        max_words=CONVERSATION_SUMMARY_MAX_WORDS,
+        summary=record["summary"] or "(ninguno)",
+        turns=turns_text
+    ))
+    metrics.observe("conversation_summary_seconds", time.perf_counter() - start)
+    if not summary or summary == PROMPT_FALLBACK_RESPONSE:
+        metrics.inc("conversation_summary_failures")
+        return False
+
+    # Se relee por si mientras tanto ha llegado otro turno o se ha borrado la conversación.
+    latest = load_record(user)
+    if latest["summarized_turns"] != summarized or len(latest["conversation"]) < summarized + overflow:
+        return False
+    latest["summary"] = summary
+    latest["summarized_turns"] = summarized + overflow
+    CONVERSATION_STORE.put(user, latest)
+    metrics.inc("conversation_summaries")
+    return True
+
+
+def _background_loop() -> asyncio.AbstractEventLoop:
+    # Se llama con _summary_lock tomado.
+    global _summary_loop
+    if _summary_loop is None:
+        _summary_loop = asyncio.new_event_loop()
+        threading.Thread(target=_summary_loop.run_forever, name="conversation-summary", daemon=True).start()
+    return _summary_loop
+
+
+def schedule_summary(user: str) -> Future:
+    """Lanza update_summary en el bucle de resúmenes; como mucho una tarea por usuario."""
+    with _summary_lock:
+        running = _summary_tasks.get(user)
+        if running is not None and not running.done():
+            return running
+        task = asyncio.run_coroutine_threadsafe(update_summary(user), _background_loop())
+        _summary_tasks[user] = task
+
+    def _done(t: Future) -> None:
+        with _summary_lock:
+            if _summary_tasks.get(user) is t:
+                del _summary_tasks[user]
+        if not t.cancelled() and t.exception() is not None:
+            print(f"Error updating conversation summary for {user}: {t.exception()}")
+
+    task.add_done_callback(_done)
+    return task
+
+
+def prepare_history(user: str) -> List[Dict[str, Any]]:
+    return build_prompt_history(load_record(user))
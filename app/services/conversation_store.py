@@ -0,0 +1,339 @@
+import atexit
+import json
+import os
+import sqlite3
+import sys
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+
+from app.config import (
+    DATA_DIR,
+    CONVERSATION_DB_PATH,
+    CONVERSATION_DB_BUSY_TIMEOUT_MS,
+    CONVERSATION_DURABILITY,
+    CONVERSATION_FLUSH_SECONDS,
+    CONVERSATION_FLUSH_BATCH,
+    CONVERSATION_MAX_PENDING
+)
+from app.services import metrics
+
+"""
+Almacén de conversaciones por usuario sobre SQLite en modo WAL.
+Cada usuario es una fila, así que leer o guardar un mensaje solo toca su conversación y
+no el fichero entero. WAL permite lectores concurrentes con un escritor, y busy_timeout
+serializa a los escritores de varios workers sin perder actualizaciones.
+
+En modo "async" save_conversation no espera al disco: el turno queda en un buffer en
+memoria (varias escrituras del mismo usuario se funden en una) y un hilo lo vuelca por
+lotes cada CONVERSATION_FLUSH_SECONDS o al llegar a CONVERSATION_FLUSH_BATCH usuarios, y
+al apagar el proceso. Si el buffer se llena, quien escribe espera a que haya hueco.
+Las lecturas ven siempre lo último guardado, esté ya en disco o no.
+
+Migración del conversation_store.json antiguo:
+    python -m app.services.conversation_store migrate [ruta_json]
+"""
+
+LEGACY_JSON_PATH = str(DATA_DIR / "conversation_store.json")
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS conversations (
+    chat_id TEXT PRIMARY KEY,
+    data TEXT NOT NULL,
+    updated_at REAL NOT NULL
+)
+"""
+
+
+class ConversationStore:
+    def __init__(self, path: str = CONVERSATION_DB_PATH, legacy_path: Optional[str] = LEGACY_JSON_PATH,
+                 busy_timeout_ms: int = CONVERSATION_DB_BUSY_TIMEOUT_MS, durability: str = CONVERSATION_DURABILITY,
+                 flush_seconds: float = CONVERSATION_FLUSH_SECONDS, flush_batch: int = CONVERSATION_FLUSH_BATCH,
+                 max_pending: int = CONVERSATION_MAX_PENDING):
+        self.path = path
+        self.legacy_path = legacy_path
+        self.busy_timeout_ms = busy_timeout_ms
+        if durability not in ("async", "sync"):
+            print(f"Unknown conversation durability '{durability}', using 'sync'.")
+            durability = "sync"
+        self.durability = durability
+        self.flush_seconds = flush_seconds
+        self.flush_batch = max(1, flush_batch)
+        self.max_pending = max(1, max_pending)
+        # Una conexión por hilo: sqlite3 no permite compartirlas entre hilos.
+        self._local = threading.local()
+        self._init_lock = threading.Lock()
+        self._initialized = False
+
+        # Write-behind: chat_id -> JSON pendiente de escribir, y el lote que se está escribiendo.
+        self._pending: "OrderedDict[str, str]" = OrderedDict()
+        self._inflight: Dict[str, str] = {}
+        self._cond = threading.Condition()
+        # Serializa los volcados con los borrados para que un lote viejo no resucite una conversación.
+        self._write_lock = threading.Lock()
+        self._flusher: Optional[threading.Thread] = None
+        self._closed = False
+
+    def _connect(self) -> sqlite3.Connection:
+        conn = getattr(self._local, "conn", None)
+        if conn is not None:
+            return conn
+
+        self._ensure_schema()
+        # La importación inicial del JSON puede haber abierto ya la conexión de este hilo.
+        conn = getattr(self._local, "conn", None)
+        if conn is not None:
+            return conn
+        conn = sqlite3.connect(self.path, timeout=self.busy_timeout_ms / 1000, isolation_level=None)
+        conn.execute(f"PRAGMA busy_timeout={int(self.busy_timeout_ms)}")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        self._local.conn = conn
+        return conn
+
+    def _ensure_schema(self) -> None:
+        if self._initialized:
+            return
+        with self._init_lock:
+            if self._initialized:
+                return
+            directory = os.path.dirname(self.path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            is_new = not os.path.exists(self.path)
+            conn = sqlite3.connect(self.path, timeout=self.busy_timeout_ms / 1000, isolation_level=None)
+            try:
+                # El modo WAL es persistente: basta con activarlo una vez por fichero.
+                conn.execute("PRAGMA journal_mode=WAL")
+                conn.execute(SCHEMA)
+            finally:
+                conn.close()
+            self._initialized = True
+
+        if is_new and self.legacy_path and os.path.exists(self.legacy_path):
+            migrated, skipped = self.migrate_from_json(self.legacy_path)
+            print(f"Conversation store: {migrated} conversations imported from {self.legacy_path} ({skipped} skipped).")
+
+    def get(self, chat_id: str) -> Any:
+        start = time.perf_counter()
+        with self._cond:
+            payload = self._pending.get(chat_id, self._inflight.get(chat_id))
+        if payload is None:
+            row = self._connect().execute(
+                "SELECT data FROM conversations WHERE chat_id = ?", (chat_id,)
+            ).fetchone()
+            payload = row[0] if row is not None else None
+        metrics.observe("conversation_store_seconds", time.perf_counter() - start, op="get")
+        if payload is None:
+            return []
+        try:
+            return json.loads(payload)
+        except json.JSONDecodeError:
+            print(f"❌ Conversación corrupta para {chat_id}")
+            return []
+
+    def put(self, chat_id: str, conversation: Any) -> None:
+        start = time.perf_counter()
+        # Se serializa aquí para guardar el estado de este turno aunque el llamante lo modifique después.
+        payload = json.dumps(conversation, ensure_ascii=False, separators=(",", ":"))
+        if self.durability == "sync" or self._closed:
+            with self._write_lock:
+                self._write_rows([(chat_id, payload)])
+        else:
+            self._enqueue(chat_id, payload)
+        metrics.observe("conversation_store_seconds", time.perf_counter() - start, op="put")
+
+    def _enqueue(self, chat_id: str, payload: str) -> None:
+        self._ensure_flusher()
+        with self._cond:
+            if chat_id in self._pending:
+                metrics.inc("conversation_writes_coalesced")
+            else:
+                waited = False
+                while len(self._pending) >= self.max_pending and not self._closed:
+                    # Contrapresión: el buffer está lleno, se espera a que el hilo vacíe un lote.
+                    waited = True
+                    self._cond.notify_all()
+                    self._cond.wait(timeout=1.0)
+                if waited:
+                    metrics.inc("conversation_write_backpressure")
+            self._pending[chat_id] = payload
+            self._pending.move_to_end(chat_id)
+            metrics.set_gauge("conversation_writes_pending", len(self._pending))
+            if len(self._pending) == 1 or len(self._pending) >= self.flush_batch:
+                self._cond.notify_all()
+
+    def _write_rows(self, rows: List[Tuple[str, str]]) -> None:
+        now = time.time()
+        conn = self._connect()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            conn.executemany(
+                "INSERT INTO conversations (chat_id, data, updated_at) VALUES (?, ?, ?) "
+                "ON CONFLICT(chat_id) DO UPDATE SET data = excluded.data, updated_at = excluded.updated_at",
+                [(chat_id, payload, now) for chat_id, payload in rows]
+            )
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+
+    def _ensure_flusher(self) -> None:
+        if self._flusher is not None:
+            return
+        with self._init_lock:
+            if self._flusher is not None:
+                return
+            self._flusher = threading.Thread(target=self._flush_loop, name="conversation-flush", daemon=True)
+            self._flusher.start()
+            atexit.register(self.close)
+
+    def _flush_loop(self) -> None:
+        while True:
+            with self._cond:
+                if not self._pending and not self._closed:
+                    self._cond.wait()
+                if len(self._pending) < self.flush_batch and not self._closed:
+                    # Se espera un poco para juntar más turnos en el mismo lote.
+                    self._cond.wait(timeout=self.flush_seconds)
+                if self._closed:
+                    return
+            self.flush()
+
+    def flush(self) -> int:
+        """Escribe todo lo pendiente en lotes de flush_batch. Devuelve las filas escritas."""
+        written = 0
+        while True:
+            with self._write_lock:
+                with self._cond:
+                    if not self._pending:
+                        break
+                    batch = []
+                    while self._pending and len(batch) < self.flush_batch:
+                        batch.append(self._pending.popitem(last=False))
+                    self._inflight = dict(batch)
+                    self._cond.notify_all()
+
+                start = time.perf_counter()
+                try:
+                    self._write_rows(batch)
+                except Exception as e:
+                    print(f"Error flushing {len(batch)} conversations: {e}")
+                    metrics.inc("conversation_flush_failures")
+                    with self._cond:
+                        # Se vuelve a encolar sin pisar turnos más recientes del mismo usuario.
+                        for chat_id, payload in reversed(batch):
+                            if chat_id not in self._pending:
+                                self._pending[chat_id] = payload
+                                self._pending.move_to_end(chat_id, last=False)
+                        self._inflight = {}
+                    return written
+                finally:
+                    metrics.observe("conversation_flush_seconds", time.perf_counter() - start)
+
+                with self._cond:
+                    self._inflight = {}
+                    metrics.set_gauge("conversation_writes_pending", len(self._pending))
+                metrics.observe("conversation_flush_batch", len(batch))
+                written += len(batch)
+        return written
+
+    def close(self) -> None:
+        """Vuelca lo pendiente y para el hilo de escritura; después se escribe en modo síncrono."""
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+        self.flush()
+
+    def delete(self, chat_id: str) -> bool:
+        with self._write_lock:
+            with self._cond:
+                had_pending = self._pending.pop(chat_id, None) is not None
+            cursor = self._connect().execute("DELETE FROM conversations WHERE chat_id = ?", (chat_id,))
+            return cursor.rowcount > 0 or had_pending
+
+    def clear(self) -> int:
+        with self._write_lock:
+            with self._cond:
+                pending = set(self._pending)
+                self._pending.clear()
+            conn = self._connect()
+            stored = {row[0] for row in conn.execute("SELECT chat_id FROM conversations")}
+            conn.execute("DELETE FROM conversations")
+            return len(stored | pending)
+
+    def count(self) -> int:
+        self.flush()
+        return self._connect().execute("SELECT COUNT(*) FROM conversations").fetchone()[0]
+
+    def iter_conversations(self) -> Iterator[Tuple[str, Any]]:
+        self.flush()
+        for chat_id, data in self._connect().execute("SELECT chat_id, data FROM conversations"):
+            try:
+                yield chat_id, json.loads(data)
+            except json.JSONDecodeError:
+                continue
+
+    def migrate_from_json(self, json_path: str, overwrite: bool = False) -> Tuple[int, int]:
+        """
+        Importa un conversation_store.json en una sola transacción. Sin overwrite, las
+        conversaciones que ya existen en la base de datos se conservan.
+        Devuelve (importadas, omitidas).
+        """
+        with open(json_path, "r", encoding="utf-8") as f:
+            data = json.load(f)
+        if not isinstance(data, dict):
+            raise ValueError(f"{json_path} no contiene un objeto JSON por usuario")
+
+        conflict = (
+            "ON CONFLICT(chat_id) DO UPDATE SET data = excluded.data, updated_at = excluded.updated_at"
+            if overwrite else "ON CONFLICT(chat_id) DO NOTHING"
+        )
+        now = time.time()
+        conn = self._connect()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            before = conn.total_changes
+            conn.executemany(
+                f"INSERT INTO conversations (chat_id, data, updated_at) VALUES (?, ?, ?) {conflict}",
+                [
+                    (chat_id, json.dumps(conversation, ensure_ascii=False, separators=(",", ":")), now)
+                    for chat_id, conversation in data.items()
+                ]
+            )
+            migrated = conn.total_changes - before
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        return migrated, len(data) - migrated
+
+    def stats(self) -> Dict[str, Any]:
+        with self._cond:
+            pending = len(self._pending)
+        return {"path": self.path, "durability": self.durability, "pending_writes": pending}
+
+
+CONVERSATION_STORE = ConversationStore()
+
+
+def main(argv=None) -> int:
+    argv = list(sys.argv[1:] if argv is None else argv)
+    if not argv or argv[0] != "migrate":
+        print("Uso: python -m app.services.conversation_store migrate [ruta_json] [--overwrite]")
+        return 1
+
+    overwrite = "--overwrite" in argv
+    paths = [arg for arg in argv[1:] if arg != "--overwrite"]
+    json_path = paths[0] if paths else LEGACY_JSON_PATH
+    if not os.path.exists(json_path):
+        print(f"Error: File not found at {json_path}")
+        return 1
+
+    migrated, skipped = CONVERSATION_STORE.migrate_from_json(json_path, overwrite=overwrite)
+    print(f"{migrated} conversations migrated to {CONVERSATION_STORE.path} ({skipped} skipped).")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
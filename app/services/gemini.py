@@ -1,18 +1,179 @@
 import asyncio
+import json
+import time
+import weakref
+from contextlib import asynccontextmanager
+from typing import Any, AsyncIterator, Callable, Dict, Optional
+
 import httpx
 from langsmith import traceable
-from ..config import GEMINI_API_KEY
-import google.generativeai as genai
-
-MAX_RETRIES = 5
-BACKOFF_BASE = 1
-
-genai.configure(api_key=GEMINI_API_KEY)
-model = genai.GenerativeModel("gemini-2.0-flash")
+from ..config import (
+    GEMINI_API_KEY,
+    GEMINI_MODEL,
+    GEMINI_BASE_URL,
+    GEMINI_TIMEOUT_SECONDS,
+    GEMINI_CONNECT_TIMEOUT_SECONDS,
+    GEMINI_MAX_CONNECTIONS
+)
+from app.services import metrics
+from app.services.llm_resilience import CircuitOpenError, resilient_call
+from app.services.llm_scheduler import LLM_SCHEDULER, INTERACTIVE, BACKGROUND, LLMOverloaded
+
+"""
+Cliente asíncrono de Gemini sobre su API REST (generateContent) con httpx.
+Las llamadas no ocupan hilos del executor: comparten un pool de conexiones keep-alive y
+pasan antes por el planificador global (app/services/llm_scheduler.py), que limita cuántas
+hay en vuelo y su ritmo. GEMINI_BASE_URL puede apuntar a un servidor local de pruebas
+(app/benchmarking/gemini_stub.py).
+Con streamGenerateContent (SSE) los fragmentos de texto se entregan según llegan.
+Reintentos, cobertura y circuit breaker: app/services/llm_resilience.py.
+"""
+
+PROMPT_FALLBACK_RESPONSE = "Ahora mismo no puedo generar la respuesta automáticamente."
+LLM_FALLBACK_RESPONSE = (
+    "Ahora mismo no puedo generar la respuesta automáticamente. "
+    "Si lo deseas, puedo ayudarte a crear un ticket de soporte."
+)
+
+
+class GeminiError(Exception):
+    def __init__(self, message: str, status_code: Optional[int] = None):
+        super().__init__(message)
+        self.status_code = status_code
+
+
+def _parts_text(payload: Dict[str, Any]) -> str:
+    candidates = payload.get("candidates") or []
+    if not candidates:
+        reason = (payload.get("promptFeedback") or {}).get("blockReason")
+        if reason:
+            raise GeminiError(f"Gemini blocked the prompt ({reason})")
+        return ""
+    parts = (candidates[0].get("content") or {}).get("parts") or []
+    return "".join(part.get("text", "") for part in parts)
+
+
+def _response_text(payload: Dict[str, Any]) -> str:
+    if not payload.get("candidates") and not (payload.get("promptFeedback") or {}).get("blockReason"):
+        raise GeminiError("Gemini returned no candidates")
+    return _parts_text(payload).strip()
+
+
+class GeminiClient:
+    """
+    El cliente httpx va ligado al bucle de eventos: la API usa uno solo, pero la UI de
+    Streamlit ejecuta cada mensaje con asyncio.run, así que se crea un cliente por bucle.
+    """
+
+    def __init__(self, api_key: str = GEMINI_API_KEY, model: str = GEMINI_MODEL, base_url: str = GEMINI_BASE_URL,
+                 timeout: float = GEMINI_TIMEOUT_SECONDS, connect_timeout: float = GEMINI_CONNECT_TIMEOUT_SECONDS,
+                 max_connections: int = GEMINI_MAX_CONNECTIONS):
+        self.api_key = api_key
+        self.model = model
+        self.base_url = base_url.rstrip("/")
+        self.timeout = timeout
+        self.connect_timeout = connect_timeout
+        self.max_connections = max(1, max_connections)
+        self._sessions: "weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, httpx.AsyncClient]" = (
+            weakref.WeakKeyDictionary()
+        )
+        self._in_flight = 0
+
+    def _session(self) -> httpx.AsyncClient:
+        loop = asyncio.get_running_loop()
+        client = self._sessions.get(loop)
+        if client is None or client.is_closed:
+            client = httpx.AsyncClient(
+                base_url=self.base_url,
+                headers={"x-goog-api-key": self.api_key or ""},
+                timeout=httpx.Timeout(self.timeout, connect=self.connect_timeout),
+                limits=httpx.Limits(
+                    max_connections=self.max_connections,
+                    max_keepalive_connections=self.max_connections
+                )
+            )
+            self._sessions[loop] = client
+        return client
+
+    @asynccontextmanager
+    async def _slot(self):
+        # Mide las peticiones HTTP en vuelo y su duración (la cola está en el planificador).
+        client = self._session()
+        started = time.perf_counter()
+        self._in_flight += 1
+        metrics.set_gauge("llm_in_flight", self._in_flight)
+        try:
+            yield client
+        finally:
+            self._in_flight -= 1
+            metrics.set_gauge("llm_in_flight", self._in_flight)
+            metrics.observe("llm_call_seconds", time.perf_counter() - started)
+
+    @staticmethod
+    def _body(prompt: str) -> Dict[str, Any]:
+        return {"contents": [{"role": "user", "parts": [{"text": prompt}]}]}
+
+    async def generate(self, prompt: str, timeout: Optional[float] = None) -> str:
+        """Texto de la respuesta. Lanza GeminiError (o httpx.HTTPError) si la llamada falla."""
+        async with self._slot() as client:
+            response = await client.post(
+                f"/models/{self.model}:generateContent",
+                json=self._body(prompt),
+                timeout=timeout if timeout is not None else httpx.USE_CLIENT_DEFAULT
+            )
+        if response.status_code != 200:
+            raise GeminiError(f"Gemini HTTP {response.status_code}: {response.text[:200]}", response.status_code)
+        return _response_text(response.json())
+
+    async def stream(self, prompt: str, timeout: Optional[float] = None) -> AsyncIterator[str]:
+        """Fragmentos de texto de la respuesta según los va generando el modelo."""
+        async with self._slot() as client:
+            started = time.perf_counter()
+            async with client.stream(
+                "POST",
+                f"/models/{self.model}:streamGenerateContent",
+                params={"alt": "sse"},
+                json=self._body(prompt),
+                timeout=timeout if timeout is not None else httpx.USE_CLIENT_DEFAULT
+            ) as response:
+                if response.status_code != 200:
+                    await response.aread()
+                    raise GeminiError(f"Gemini HTTP {response.status_code}: {response.text[:200]}", response.status_code)
+                first = True
+                async for line in response.aiter_lines():
+                    if not line.startswith("data:"):
+                        continue
+                    chunk = _parts_text(json.loads(line[5:]))
+                    if not chunk:
+                        continue
+                    if first:
+                        metrics.observe("llm_first_token_seconds", time.perf_counter() - started)
+                        first = False
+                    yield chunk
+
+    async def aclose(self) -> None:
+        """Cierra el cliente del bucle actual (al apagar la API)."""
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            return
+        client = self._sessions.pop(loop, None)
+        if client is not None:
+            await client.aclose()
+
+
+GEMINI_CLIENT = GeminiClient()
 
 
 @traceable(name="Gemini Call")
-async def call_gemini_llm(conversation_history, tools=None):
+async def call_gemini_llm(conversation_history, tools=None, on_token: Optional[Callable[[str], None]] = None,
+                          priority: str = INTERACTIVE):
+    """
+    Devuelve {"Response", "solved"}. Con on_token la respuesta se pide en streaming y
+    on_token(fragmento) se llama con cada trozo según llega; solved se calcula al final.
+    Si la llamada falla tras los reintentos, el breaker está abierto o el planificador no la
+    admite a tiempo, la respuesta es LLM_FALLBACK_RESPONSE y lleva además "fallback": True.
+    """
 
     prompt_parts = []
 
@@ -24,13 +185,21 @@ async def call_gemini_llm(conversation_history, tools=None):
 
     prompt = "\n".join(prompt_parts)
 
-    try:
-        response = await asyncio.to_thread(
-            model.generate_content,
-            prompt
-        )
+    chunks = []
 
-        text = response.text.strip() if response.text else ""
+    async def stream_text() -> str:
+        async for chunk in GEMINI_CLIENT.stream(prompt):
+            chunks.append(chunk)
+            on_token(chunk)
+        return "".join(chunks).strip()
+
+    try:
+        async with LLM_SCHEDULER.slot(priority):
+            if on_token is None:
+                text = await resilient_call(lambda: GEMINI_CLIENT.generate(prompt))
+            else:
+                # Un streaming solo se reintenta si aún no ha entregado texto.
+                text = await resilient_call(stream_text, hedge=False, can_retry=lambda: not chunks)
 
         solved = True
         if "no puedo ayudarte" in text.lower() or "ticket" in text.lower():
@@ -44,27 +213,25 @@ async def call_gemini_llm(conversation_history, tools=None):
 
     except Exception as e:
 
-        print("Gemini error:", repr(e))
+        if not isinstance(e, (CircuitOpenError, LLMOverloaded)):
+            print("Gemini error:", repr(e))
+            metrics.inc("llm_errors")
 
         return {
-            "Response": (
-                "Ahora mismo no puedo generar la respuesta automáticamente. "
-                "Si lo deseas, puedo ayudarte a crear un ticket de soporte."
-            ),
-            "solved": False
+            "Response": LLM_FALLBACK_RESPONSE,
+            "solved": False,
+            "fallback": True
         }
 
 
-async def call_gemini_prompt(prompt_text: str) -> str:
+async def call_gemini_prompt(prompt_text: str, priority: str = BACKGROUND) -> str:
 
     try:
-        response = await asyncio.to_thread(
-            model.generate_content,
-            prompt_text
-        )
-        return response.text.strip() if response.text else ""
+        async with LLM_SCHEDULER.slot(priority):
+            return await resilient_call(lambda: GEMINI_CLIENT.generate(prompt_text))
 
-    except Exception:
-        return (
-            "Ahora mismo no puedo generar la respuesta automáticamente."
-        )
+    except Exception as e:
+        if not isinstance(e, (CircuitOpenError, LLMOverloaded)):
+            print("Gemini error:", repr(e))
+            metrics.inc("llm_errors")
+        return PROMPT_FALLBACK_RESPONSE
@@ -1,29 +1,67 @@
 import os
-import json
 import re
+import hashlib
+import threading
+import time
+from dataclasses import dataclass
+from typing import Any, Dict, FrozenSet, List, Optional
 import torch
 import numpy as np
-from rank_bm25 import BM25Okapi
-from sentence_transformers import SentenceTransformer
 from rapidfuzz import process
 
+from app.services import metrics, kb_service
+from app.services.kb_service import KBState, is_hybrid_entry
+from app.services.bm25_index import SparseBM25
+from app.services.vector_index import build_vector_index, top_k_indices
+from app.services.passage_index import STEP, PassageIndex, extract_passages
+from app.services.KnowledgeBaseFiltering import build_corpus_embeddings
+from app.services.model_registry import get_model, model_tag
+from app.services.query_cache import QUERY_EMBEDDING_CACHE, frequent_queries, warm_up
+from app.config import QUERY_CACHE_WARMUP, SHARED_ENCODER_MODEL, PASSAGE_INDEX_ENABLED
+
 """
 Módulo de búsqueda híbrida (BM25 + embeddings).
 Usado únicamente cuando el usuario selecciona 'Modelo ML (embeddings)'.
 """
 
 BASE_DIR = os.path.dirname(os.path.abspath(__file__))
-KB_PATH = os.path.join(BASE_DIR, "..", "data", "KnowledgeBase.json")
+KB_PATH = kb_service.KB_PATH
+VECTOR_INDEX_FILE = os.path.join(BASE_DIR, "..", "data", "kb_index_hybrid.npz")
+PASSAGE_INDEX_FILE = os.path.join(BASE_DIR, "..", "data", "kb_passage_index_hybrid.npz")
+PASSAGE_CACHE_FILE = os.path.join(BASE_DIR, "..", "data", "kb_passage_embeddings_hybrid.npy")
 
 kb = None
 kb_filtrada = None
 KB_VOCAB = set()
 bm25 = None
 embeddings_kb = None
+vector_index = None
 model = None
 texts = None
 
-MODEL_NAME = "intfloat/e5-base-v2"
+
+@dataclass(frozen=True)
+class HybridSnapshot:
+    """Versión inmutable de la KB del modo híbrido: BM25, índice vectorial y vocabulario."""
+    version: int
+    fingerprint: str
+    kb_state: KBState
+    kb_filtrada: List[Dict[str, Any]]
+    vocab: FrozenSet[str]
+    texts: List[str]
+    bm25: SparseBM25
+    index: Any
+    built_at: float
+    passages: Optional[PassageIndex] = None
+
+
+_snapshot: Optional[HybridSnapshot] = None
+_build_lock = threading.Lock()
+
+MODEL_NAME = SHARED_ENCODER_MODEL or "intfloat/e5-base-v2"
+
+# Con un índice aproximado, cuántos candidatos por resultado se piden a cada recuperador.
+CANDIDATES_PER_RESULT = 20
 
 INFORMAL_MAP = {
     "no va": "no funciona",
@@ -41,61 +79,237 @@ TECH_CORE_TERMS = {
 }
 
 
-def initialize_hybrid_search():
-    global kb, kb_filtrada, KB_VOCAB, bm25, embeddings_kb, model, texts
+def _build_snapshot() -> HybridSnapshot:
+    global model
+
+    kb_state = kb_service.current()
+    current = _snapshot
+    if current is not None and current.kb_state.generation == kb_state.generation:
+        return current
+
+    filtered = kb_state.hybrid_entries
+    item_texts = kb_state.hybrid_texts
+
+    vocab = set()
+    for item in filtered:
+        vocab.update(re.findall(r'\w+', item["title"].lower()))
+        vocab.update(item["keywords_tags"])
+
+    model = get_model(MODEL_NAME)
+    fingerprint = hashlib.sha1(
+        (model_tag(MODEL_NAME) + "\n" + "\n".join(item_texts)).encode("utf-8")
+    ).hexdigest()
+
+    if current is not None and current.fingerprint == fingerprint:
+        # Solo cambian campos que no se indexan: se reutilizan BM25 e índice vectorial.
+        lexical, index = current.bm25, current.index
+    else:
+        tokenized_texts = [re.findall(r'\w+', text.lower()) for text in item_texts]
+        lexical = SparseBM25(tokenized_texts, [item["id"] for item in filtered])
+
+        with torch.no_grad():
+            embeddings = model.encode(
+                item_texts,
+                normalize_embeddings=True,
+                convert_to_numpy=True,
+                show_progress_bar=False
+            ).astype(np.float32, copy=False)
+        # La búsqueda usa solo el almacenamiento del índice; si es compacto, la copia
+        # float32 se libera.
+        index = build_vector_index(embeddings, VECTOR_INDEX_FILE, fingerprint)
+
+    passages = _build_passages(filtered, current.passages if current is not None else None)
+
+    return HybridSnapshot(
+        version=(current.version + 1) if current is not None else 1,
+        fingerprint=fingerprint,
+        kb_state=kb_state,
+        kb_filtrada=filtered,
+        vocab=frozenset(vocab),
+        texts=item_texts,
+        bm25=lexical,
+        index=index,
+        built_at=time.time(),
+        passages=passages
+    )
+
+
+def _build_passages(filtered: List[Dict[str, Any]], current: Optional[PassageIndex]) -> Optional[PassageIndex]:
+    # Pasos, síntomas y preguntas de cada entrada con su propio embedding, para poder
+    # señalar el paso que encaja con la consulta. Los embeddings van a una caché por
+    # contenido como la del modo generativo: al arrancar solo se codifican los pasajes
+    # nuevos o editados.
+    if not PASSAGE_INDEX_ENABLED:
+        return None
+    passages = extract_passages(filtered)
+    if not passages:
+        return None
+    fingerprint = hashlib.sha1(
+        (model_tag(MODEL_NAME) + f"\n{len(filtered)}\n"
+         + "\n".join(f"{p.entry}|{p.kind}|{p.text}" for p in passages)).encode("utf-8")
+    ).hexdigest()
+    if current is not None and current.fingerprint == fingerprint:
+        return current
+
+    records = [{"id": f"{filtered[p.entry].get('id')}#{p.kind}{p.item}"} for p in passages]
+    with torch.no_grad():
+        matrix, stats = build_corpus_embeddings(
+            records, PASSAGE_CACHE_FILE, [p.text for p in passages],
+            encoder=model, model_name=MODEL_NAME, normalize=True
+        )
+    print(f"Hybrid passages: {len(passages)} ({stats['reused']} reused, {stats['recomputed']} recomputed).")
+    return PassageIndex(passages, np.asarray(matrix, dtype=np.float32), len(filtered), PASSAGE_INDEX_FILE, fingerprint)
 
-    if kb is not None:
-        return
 
-    if not os.path.exists(KB_PATH):
-        raise FileNotFoundError(f"No se encontró la KB en {KB_PATH}")
-
-    try:
-        with open(KB_PATH, "r", encoding="utf-8") as f:
-            kb = json.load(f)
-            if not isinstance(kb, list):
-                kb = []
-    except json.JSONDecodeError:
-        print("KB corrupta en hybrid_search")
-        kb = []
-
-    kb_filtrada = [
-        item for item in kb
-        if not item["title"].lower().startswith("solicitud")
-    ]
-
-    for item in kb_filtrada:
-        KB_VOCAB.update(re.findall(r'\w+', item["title"].lower()))
-        KB_VOCAB.update(item["keywords_tags"])
-
-    texts = [
-        f"{item['description_problem']} "
-        f"{' '.join(item['symptoms'])} "
-        f"{' '.join(item['keywords_tags'])}"
-        for item in kb_filtrada
-    ]
-
-    tokenized_texts = [re.findall(r'\w+', text.lower()) for text in texts]
-    bm25 = BM25Okapi(tokenized_texts)
-
-    model = SentenceTransformer(MODEL_NAME, device="cpu")
-    model.eval()
+def _encode_texts(texts: List[str]) -> np.ndarray:
     with torch.no_grad():
-        embeddings_kb = model.encode(
+        return model.encode(
             texts,
             normalize_embeddings=True,
             convert_to_numpy=True,
             show_progress_bar=False
+        ).astype(np.float32, copy=False)
+
+
+def apply_change(kb_state: KBState) -> bool:
+    """
+    Publica un snapshot para una generación que cambia una sola entrada de la anterior:
+    se codifica solo esa entrada y BM25, el índice vectorial y los pasajes se actualizan
+    sobre copias. Devuelve False si hay que reconstruir entero.
+    """
+    change = kb_state.change
+    if change is None or model is None or not kb_state.hybrid_positions:
+        return False
+
+    with _build_lock:
+        current = _snapshot
+        if current is None or current.kb_state.generation != kb_state.generation - 1:
+            return False
+        start, stop = change.hybrid_start, change.hybrid_stop
+        new_items = [kb_state.entries[p] for p in kb_state.hybrid_positions[start:start + change.hybrid_count]]
+        new_passages = extract_passages(new_items) if PASSAGE_INDEX_ENABLED else []
+        if current.passages is None and new_passages:
+            return False
+
+        began = time.time()
+        item_texts = kb_state.hybrid_texts
+        new_texts = item_texts[start:start + change.hybrid_count]
+        fingerprint, lexical, index, passages = current.fingerprint, current.bm25, current.index, current.passages
+        if current.texts[start:stop] != new_texts or [i["id"] for i in current.kb_filtrada[start:stop]] != [i["id"] for i in new_items]:
+            # Misma huella que daría una construcción completa, para poder reutilizar el índice después.
+            fingerprint = hashlib.sha1(
+                (model_tag(MODEL_NAME) + "\n" + "\n".join(item_texts)).encode("utf-8")
+            ).hexdigest()
+            lexical = current.bm25.copy()
+            lexical.splice(start, stop, [(item["id"], re.findall(r'\w+', text.lower())) for item, text in zip(new_items, new_texts)])
+            lexical.refresh()
+            index = current.index.splice(start, stop, _encode_texts(new_texts) if new_texts else np.empty((0, 0)), fingerprint)
+        if passages is not None and (start != stop or change.hybrid_count):
+            passages = passages.splice(
+                start, stop, change.hybrid_count, new_passages,
+                _encode_texts([p.text for p in new_passages]) if new_passages else np.empty((0, 0)),
+                hashlib.sha1(f"{passages.fingerprint}|{fingerprint}|{start}:{stop}".encode("utf-8")).hexdigest()
+            )
+
+        vocab = set(current.vocab)
+        for item in new_items:
+            vocab.update(re.findall(r'\w+', item["title"].lower()))
+            vocab.update(item["keywords_tags"])
+
+        snapshot = HybridSnapshot(
+            version=current.version + 1,
+            fingerprint=fingerprint,
+            kb_state=kb_state,
+            kb_filtrada=kb_state.hybrid_entries,
+            vocab=frozenset(vocab),
+            texts=item_texts,
+            bm25=lexical,
+            index=index,
+            built_at=time.time(),
+            passages=passages
         )
+        _publish(snapshot)
+
+    elapsed = time.time() - began
+    metrics.inc("kb_incremental_updates", engine="hybrid")
+    metrics.observe("kb_incremental_seconds", elapsed, engine="hybrid")
+    print(f"Snapshot híbrido v{snapshot.version} (generación {kb_state.generation}) actualizado en {elapsed:.2f} segundos.")
+    return True
+
 
-def soft_spellcheck(query: str) -> str:
+def _publish(snapshot: HybridSnapshot) -> None:
+    # Las búsquedas leen _snapshot una sola vez; los alias de módulo son para los benchmarks.
+    global _snapshot, kb, kb_filtrada, KB_VOCAB, bm25, embeddings_kb, vector_index, texts
+    if snapshot is _snapshot:
+        return
+    _snapshot = snapshot
+    kb, kb_filtrada, KB_VOCAB, texts = snapshot.kb_state.entries, snapshot.kb_filtrada, snapshot.vocab, snapshot.texts
+    bm25, vector_index, embeddings_kb = snapshot.bm25, snapshot.index, snapshot.index.store
+    metrics.set_gauge("kb_snapshot_version", snapshot.version, engine="hybrid")
+    metrics.set_gauge("kb_snapshot_entries", len(snapshot.kb_filtrada), engine="hybrid")
+
+
+def initialize_hybrid_search(force_reload: bool = False):
+    if _snapshot is not None and not force_reload:
+        return
+
+    with _build_lock:
+        if _snapshot is not None and not force_reload:
+            return
+        start = time.time()
+        snapshot = _build_snapshot()
+        if snapshot is not _snapshot:
+            print(
+                f"Snapshot híbrido v{snapshot.version} (generación {snapshot.kb_state.generation}) preparado en {time.time() - start:.2f} segundos "
+                f"({len(snapshot.kb_filtrada)} entradas)."
+            )
+        _publish(snapshot)
+
+    warm_up_query_cache()
+
+
+def snapshot_info():
+    snapshot = _snapshot
+    if snapshot is None:
+        return None
+    return {
+        "version": snapshot.version,
+        "fingerprint": snapshot.fingerprint,
+        "kb_generation": snapshot.kb_state.generation,
+        "entries": len(snapshot.kb_filtrada),
+        "built_at": snapshot.built_at
+    }
+
+def _encode(text: str) -> np.ndarray:
+    return model.encode([text], normalize_embeddings=True)[0]
+
+def encode_query(query_augmented: str) -> np.ndarray:
+    return QUERY_EMBEDDING_CACHE.get_or_encode(model_tag(MODEL_NAME), query_augmented, _encode)
+
+def augment_query(query_norm: str, vocab=None) -> str:
+    query_augmented = expand_informal_language(query_norm)
+    return soft_spellcheck(query_augmented, vocab)
+
+def warm_up_query_cache(limit: int = QUERY_CACHE_WARMUP) -> None:
+    # Se precalienta con la consulta ya aumentada, que es lo que realmente se codifica.
+    queries = []
+    for query in frequent_queries(limit):
+        query_norm = normalize_query(query)
+        if not is_out_of_domain(query_norm):
+            queries.append(augment_query(query_norm))
+    if queries:
+        warmed = warm_up(model_tag(MODEL_NAME), queries, _encode)
+        print(f"Caché de embeddings de consultas precalentada con {warmed} consultas frecuentes.")
+
+def soft_spellcheck(query: str, vocab=None) -> str:
+    vocab = KB_VOCAB if vocab is None else vocab
     tokens = query.split()
     fixed = []
     for t in tokens:
         if len(t) < 5:
             fixed.append(t)
         else:
-            match, score, _ = process.extractOne(t, KB_VOCAB)
+            match, score, _ = process.extractOne(t, vocab)
             fixed.append(match if score > 85 else t)
     return " ".join(fixed)
 
@@ -121,44 +335,63 @@ def is_out_of_domain(query: str) -> bool:
 
 def buscar_hibrido(query: str, alpha: float = 0.25, top_k: int = 3):
     initialize_hybrid_search()
+    # Toda la búsqueda usa el mismo snapshot aunque se publique otro mientras tanto.
+    snapshot = _snapshot
+    kb_filtrada, vector_index = snapshot.kb_filtrada, snapshot.index
 
     query_norm = normalize_query(query)
 
     if is_out_of_domain(query_norm):
         return []
 
-    query_augmented = expand_informal_language(query_norm)
-    query_augmented = soft_spellcheck(query_augmented)
+    query_augmented = augment_query(query_norm, snapshot.vocab)
 
     tokens = re.findall(r'\w+', query_augmented.lower())
-    bm25_scores = np.array(bm25.get_scores(tokens))
-
-    bm25_norm = bm25_scores / bm25_scores.max() if bm25_scores.max() > 0 else bm25_scores
-
-    query_emb = model.encode([query_augmented], normalize_embeddings=True)[0]
-    sim_scores = embeddings_kb @ query_emb
+    query_emb = encode_query(query_augmented)
+
+    if vector_index.exact:
+        candidates = None
+        bm25_scores = snapshot.bm25.get_scores(tokens)
+        bm25_max = bm25_scores.max() if len(bm25_scores) else 0.0
+        # Se puntúa sobre el almacenamiento del índice (float32, float16 o int8).
+        sim_scores = vector_index.store.score(query_emb)
+    else:
+        # Índice aproximado: se combinan los mejores candidatos densos y léxicos y tanto
+        # BM25 como el coseno se calculan solo sobre ellos.
+        n_candidates = top_k * CANDIDATES_PER_RESULT
+        dense_idx, _ = vector_index.search(query_emb, n_candidates)
+        lexical_idx, lexical_scores = snapshot.bm25.top_k(tokens, n_candidates)
+        candidates = np.union1d(dense_idx, lexical_idx)
+        bm25_scores = snapshot.bm25.score_documents(tokens, candidates)
+        bm25_max = lexical_scores[0] if len(lexical_scores) else 0.0
+        sim_scores = vector_index.store.score(query_emb, candidates)
+
+    bm25_norm = bm25_scores / bm25_max if bm25_max > 0 else bm25_scores
     sim_norm = (sim_scores + 1) / 2
-
     hybrid_score = alpha * bm25_norm + (1 - alpha) * sim_norm
 
-    top_idx = np.argsort(hybrid_score)[::-1][:top_k]
-
     resultados = []
-    for i in top_idx:
-        item = kb_filtrada[i]
-        resultados.append({
+    for j in top_k_indices(hybrid_score, top_k):
+        position = int(j if candidates is None else candidates[j])
+        item = kb_filtrada[position]
+        resultado = {
             "id": item["id"],
             "title": item["title"],
-            "score_hybrid": float(hybrid_score[i]),
-            "score_cosine": float(sim_scores[i]),
-            "score_bm25": float(bm25_scores[i])
-        })
+            "score_hybrid": float(hybrid_score[j]),
+            "score_cosine": float(sim_scores[j]),
+            "score_bm25": float(bm25_scores[j])
+        }
+        if snapshot.passages is not None:
+            # Paso más parecido a la consulta, con el mismo embedding ya calculado.
+            best = snapshot.passages.for_entry(query_emb, position, STEP, 1)
+            if best:
+                resultado["best_step"] = best[0][0].item
+                resultado["score_step"] = best[0][1]
+        resultados.append(resultado)
 
     return resultados
 
 def get_kb_item_by_id(incidente_id: str):
     initialize_hybrid_search()
-    for item in kb_filtrada:
-        if item.get("id") == incidente_id:
-            return item
-    return None
\ No newline at end of file
+    item = _snapshot.kb_state.get(incidente_id)
+    return item if item is not None and is_hybrid_entry(item) else None
\ No newline at end of file
@@ -0,0 +1,137 @@
+import threading
+import time
+import traceback
+from typing import Any, Dict, List, Optional
+
+from app.services import kb_service, metrics
+
+"""
+Recarga en caliente de los índices de la KB.
+Cada motor construye un snapshot nuevo en segundo plano y lo publica de forma atómica;
+las consultas en curso terminan con el snapshot anterior. Las peticiones de recarga que
+llegan mientras hay una en marcha se agrupan en una única recarga posterior.
+Cada generación nueva que publica kb_service dispara una recarga; si la generación solo
+cambia una entrada de la anterior (alta, edición o baja desde el diario), los motores
+aplican el cambio sobre su snapshot sin reconstruir nada más. Todo ello ocurre en el hilo
+de recarga: kb_service avisa desde quien escribe (a menudo el bucle de eventos), que solo
+encola la generación y sigue.
+"""
+
+_lock = threading.Lock()
+_state: Dict[str, Any] = {
+    "reloading": False,
+    "pending": False,
+    "reloads": 0,
+    "last_reload_at": None,
+    "last_reload_seconds": None,
+    "last_error": None
+}
+# Generaciones publicadas pendientes de aplicar, en orden.
+_changes: List[kb_service.KBState] = []
+
+
+def reload_indexes() -> None:
+    """Reconstruye y publica los snapshots de los motores ya inicializados."""
+    from app.services import KnowledgeBaseFiltering as kbf
+    from app.services import hybrid_search
+
+    start = time.time()
+    # Recoge cambios hechos a mano en KnowledgeBase.json (no relee si el fichero no cambió).
+    kb_service.reload(notify=False)
+    kbf.rebuild_embeddings()
+    # El modo híbrido se inicializa de forma perezosa: si aún no se ha usado, ya leerá
+    # la KB nueva en su primera búsqueda.
+    if hybrid_search.snapshot_info() is not None:
+        hybrid_search.initialize_hybrid_search(force_reload=True)
+    elapsed = time.time() - start
+
+    with _lock:
+        _state["reloads"] += 1
+        _state["last_reload_at"] = time.time()
+        _state["last_reload_seconds"] = round(elapsed, 3)
+        _state["last_error"] = None
+    metrics.observe("kb_reload_seconds", elapsed)
+    print(f"KB indexes reloaded in {elapsed:.2f} seconds.")
+
+
+def _reload_loop() -> None:
+    while True:
+        with _lock:
+            changes, full = list(_changes), _state["pending"]
+            _changes.clear()
+            _state["pending"] = False
+            if not changes and not full:
+                _state["reloading"] = False
+                return
+        # Los cambios se aplican en orden; si uno no se puede aplicar, la recarga completa
+        # cubre también los que le siguen.
+        if not full and not all(apply_change(state) for state in changes):
+            full = True
+        if not full:
+            continue
+        try:
+            reload_indexes()
+        except Exception as e:
+            traceback.print_exc()
+            metrics.inc("kb_reload_failures")
+            with _lock:
+                _state["last_error"] = str(e)
+
+
+def _start(full: bool, state: Optional[kb_service.KBState] = None) -> bool:
+    # Encola el trabajo y arranca el hilo si no hay uno en marcha. False si se ha agrupado.
+    with _lock:
+        if full:
+            _state["pending"] = True
+        if state is not None:
+            _changes.append(state)
+        if _state["reloading"]:
+            return False
+        _state["reloading"] = True
+    threading.Thread(target=_reload_loop, name="kb-reload", daemon=True).start()
+    return True
+
+
+def schedule_reload() -> bool:
+    """Lanza una recarga en segundo plano. Devuelve False si se ha agrupado con una en curso."""
+    return _start(full=True)
+
+
+def apply_change(state: kb_service.KBState) -> bool:
+    """Aplica state.change en los motores ya inicializados. False si alguno necesita recarga completa."""
+    from app.services import KnowledgeBaseFiltering as kbf
+    from app.services import hybrid_search
+
+    if state.change is None:
+        return False
+    try:
+        applied = kbf.apply_change(state)
+        if applied and hybrid_search.snapshot_info() is not None:
+            applied = hybrid_search.apply_change(state)
+    except Exception as e:
+        traceback.print_exc()
+        metrics.inc("kb_incremental_failures")
+        with _lock:
+            _state["last_error"] = str(e)
+        return False
+    return applied
+
+
+def _on_new_generation(state: kb_service.KBState) -> None:
+    # Nada de codificar aquí: se llama desde quien escribe en la KB, p. ej. el bucle de eventos.
+    _start(full=False, state=state)
+
+
+kb_service.subscribe(_on_new_generation)
+
+
+def status() -> Dict[str, Any]:
+    from app.services import KnowledgeBaseFiltering as kbf
+    from app.services import hybrid_search
+
+    with _lock:
+        state = dict(_state)
+    state["kb_generation"] = kb_service.current().generation
+    state["generative"] = kbf.snapshot_info()
+    state["hybrid"] = hybrid_search.snapshot_info()
+    return state
@@ -0,0 +1,429 @@
+import hashlib
+import json
+import os
+import re
+import threading
+import time
+from bisect import bisect_left
+from dataclasses import dataclass
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+from app.config import DATA_DIR, KB_JOURNAL_COMPACT_EVERY
+from app.services import metrics
+from app.services.context_packer import IncidentTexts, serialize_incident
+
+"""
+Servicio único de la base de conocimiento.
+KnowledgeBase.json se lee una sola vez y se publica como un snapshot inmutable con un
+contador de generación, el mapa id → posición y los textos derivados que usa cada motor.
+Los dos motores de búsqueda y los nodos del grafo leen de aquí; quien necesite enterarse
+de una generación nueva se suscribe con subscribe().
+
+Las altas, ediciones y bajas de una incidencia no reescriben KnowledgeBase.json: se
+añaden como una línea al diario (KnowledgeBase.journal.jsonl) y la generación nueva se
+deriva de la anterior tocando solo esa entrada; KBState.change indica qué posiciones
+cambian, para que los motores actualicen sus índices sin reconstruirlos. Cada
+KB_JOURNAL_COMPACT_EVERY cambios el diario se vuelca en KnowledgeBase.json (compactación).
+"""
+
+KB_PATH = str(DATA_DIR / "KnowledgeBase.json")
+
+
+def preprocess_text(text: str) -> str:
+    if text is None:
+        return ""
+    text = text.lower()
+    text = re.sub(r'[^\w\s]', '', text)
+    text = re.sub(r'\s+', ' ', text).strip()
+    return text
+
+
+def incident_text(incident: Dict[str, Any]) -> str:
+    """Texto que codifica el modo generativo."""
+    return preprocess_text(
+        incident.get('description_problem', '')
+        + ' '
+        + incident.get('title', '')
+        + ' '
+        + ", ".join(incident.get('keywords_tags', []))
+    )
+
+
+def hybrid_text(item: Dict[str, Any]) -> str:
+    """Texto que indexan BM25 y los embeddings del modo híbrido."""
+    return (
+        f"{item['description_problem']} "
+        f"{' '.join(item['symptoms'])} "
+        f"{' '.join(item['keywords_tags'])}"
+    )
+
+
+def is_hybrid_entry(item: Dict[str, Any]) -> bool:
+    # Las solicitudes no son incidencias: el modo híbrido no las indexa.
+    return not item["title"].lower().startswith("solicitud")
+
+
+@dataclass(frozen=True)
+class KBChange:
+    """Diferencia con la generación anterior: entries[start:stop] pasa a ser `count` entradas."""
+    op: str
+    entry_id: str
+    start: int
+    stop: int
+    count: int
+    # Lo mismo en la lista de entradas del modo híbrido (hybrid_positions).
+    hybrid_start: int
+    hybrid_stop: int
+    hybrid_count: int
+
+
+@dataclass(frozen=True)
+class KBState:
+    generation: int
+    content_hash: str
+    entries: List[Dict[str, Any]]
+    by_id: Dict[str, int]
+    generative_texts: List[str]
+    hybrid_positions: List[int]
+    hybrid_texts: List[str]
+    # Formas serializadas de cada entrada para el prompt generativo.
+    prompt_texts: List[IncidentTexts]
+    loaded_at: float
+    # Solo en las generaciones que vienen de un cambio del diario sobre la anterior.
+    change: Optional[KBChange] = None
+
+    def get(self, incident_id: str) -> Optional[Dict[str, Any]]:
+        position = self.by_id.get(incident_id)
+        return self.entries[position] if position is not None else None
+
+    @property
+    def hybrid_entries(self) -> List[Dict[str, Any]]:
+        return [self.entries[i] for i in self.hybrid_positions]
+
+
+_lock = threading.Lock()
+_state: Optional[KBState] = None
+_file_signature: Optional[Tuple[Any, Any]] = None
+_listeners: List[Callable[[KBState], None]] = []
+_journal_ops = 0
+_compacting = False
+
+
+def journal_path(path: str = KB_PATH) -> str:
+    return os.path.splitext(path)[0] + ".journal.jsonl"
+
+
+def _file_stat(path: str) -> Optional[Tuple[int, int]]:
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+    return stat.st_mtime_ns, stat.st_size
+
+
+def _signature(path: str) -> Tuple[Any, Any]:
+    # La KB son dos ficheros: el JSON base y su diario.
+    return _file_stat(path), _file_stat(journal_path(path))
+
+
+def _read_file(path: str) -> Optional[List[Dict[str, Any]]]:
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            data = json.load(f)
+    except FileNotFoundError:
+        print(f"Error: File not found at {path}")
+        return None
+    except json.JSONDecodeError:
+        print(f"Error: Invalid JSON format in {path}")
+        return None
+    return data if isinstance(data, list) else []
+
+
+def _read_journal(path: str) -> List[Dict[str, Any]]:
+    ops = []
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            for line in f:
+                if not line.strip():
+                    continue
+                try:
+                    ops.append(json.loads(line))
+                except json.JSONDecodeError:
+                    # Una última línea a medio escribir (caída durante el append) se ignora.
+                    print(f"Skipping invalid line in KB journal {path}.")
+    except FileNotFoundError:
+        pass
+    return ops
+
+
+def _content_hash(entries: List[Dict[str, Any]]) -> str:
+    return hashlib.sha1(json.dumps(entries, sort_keys=True, ensure_ascii=False).encode("utf-8")).hexdigest()
+
+
+def _index_ids(entries: List[Dict[str, Any]]) -> Dict[str, int]:
+    by_id: Dict[str, int] = {}
+    for position, entry in enumerate(entries):
+        # Con ids repetidos gana la primera aparición, como en las búsquedas lineales de antes.
+        by_id.setdefault(entry.get("id"), position)
+    return by_id
+
+
+def _locate(entries: List[Dict[str, Any]], by_id: Dict[str, int],
+            op: Dict[str, Any]) -> Optional[Tuple[int, int, List[Dict[str, Any]]]]:
+    """(start, stop, entradas nuevas) de una operación del diario, o None si no cambia nada."""
+    if op.get("op") == "put":
+        entry = op["entry"]
+        position = by_id.get(entry.get("id"))
+        if position is None:
+            return len(entries), len(entries), [entry]
+        if entries[position] == entry:
+            return None
+        return position, position + 1, [entry]
+    if op.get("op") == "delete":
+        position = by_id.get(op.get("id"))
+        if position is None:
+            return None
+        return position, position + 1, []
+    print(f"Unknown KB journal operation: {op.get('op')}")
+    return None
+
+
+def _replay(entries: List[Dict[str, Any]], ops: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    # Aplicar dos veces la misma operación no cambia el resultado, así que tras una caída
+    # entre la compactación y el vaciado del diario se puede volver a aplicar entero.
+    entries = list(entries)
+    by_id = _index_ids(entries)
+    for op in ops:
+        located = _locate(entries, by_id, op)
+        if located is None:
+            continue
+        start, stop, new_entries = located
+        entries[start:stop] = new_entries
+        if len(new_entries) == stop - start:
+            continue
+        if start == stop and start + len(new_entries) == len(entries):
+            for position in range(start, len(entries)):
+                by_id.setdefault(entries[position].get("id"), position)
+        else:
+            by_id = _index_ids(entries)
+    return entries
+
+
+def _build_state(entries: List[Dict[str, Any]], generation: int, content_hash: str) -> KBState:
+    by_id = _index_ids(entries)
+    hybrid_positions = [i for i, entry in enumerate(entries) if is_hybrid_entry(entry)]
+    return KBState(
+        generation=generation,
+        content_hash=content_hash,
+        entries=entries,
+        by_id=by_id,
+        generative_texts=[incident_text(entry) for entry in entries],
+        hybrid_positions=hybrid_positions,
+        hybrid_texts=[hybrid_text(entries[i]) for i in hybrid_positions],
+        prompt_texts=[serialize_incident(entry) for entry in entries],
+        loaded_at=time.time()
+    )
+
+
+def _splice_state(state: KBState, op: Dict[str, Any], start: int, stop: int,
+                  new_entries: List[Dict[str, Any]], content_hash: str) -> KBState:
+    """Generación siguiente a `state` con entries[start:stop] sustituidas; solo se derivan los textos nuevos."""
+    entries = state.entries[:start] + new_entries + state.entries[stop:]
+    if len(new_entries) == stop - start:
+        # Edición: misma posición y mismo id.
+        by_id = dict(state.by_id)
+    elif start == len(state.entries):
+        by_id = dict(state.by_id)
+        for offset, entry in enumerate(new_entries):
+            by_id.setdefault(entry.get("id"), start + offset)
+    else:
+        by_id = _index_ids(entries)
+
+    shift = len(new_entries) - (stop - start)
+    hybrid_start = bisect_left(state.hybrid_positions, start)
+    hybrid_stop = bisect_left(state.hybrid_positions, stop)
+    new_hybrid = [start + offset for offset, entry in enumerate(new_entries) if is_hybrid_entry(entry)]
+    tail = state.hybrid_positions[hybrid_stop:]
+    hybrid_positions = state.hybrid_positions[:hybrid_start] + new_hybrid + ([p + shift for p in tail] if shift else tail)
+    hybrid_texts = (
+        state.hybrid_texts[:hybrid_start]
+        + [hybrid_text(entries[p]) for p in new_hybrid]
+        + state.hybrid_texts[hybrid_stop:]
+    )
+
+    return KBState(
+        generation=state.generation + 1,
+        content_hash=content_hash,
+        entries=entries,
+        by_id=by_id,
+        generative_texts=state.generative_texts[:start] + [incident_text(e) for e in new_entries] + state.generative_texts[stop:],
+        hybrid_positions=hybrid_positions,
+        hybrid_texts=hybrid_texts,
+        prompt_texts=state.prompt_texts[:start] + [serialize_incident(e) for e in new_entries] + state.prompt_texts[stop:],
+        loaded_at=time.time(),
+        change=KBChange(
+            op=op["op"],
+            entry_id=op["entry"].get("id") if op["op"] == "put" else op.get("id"),
+            start=start,
+            stop=stop,
+            count=len(new_entries),
+            hybrid_start=hybrid_start,
+            hybrid_stop=hybrid_stop,
+            hybrid_count=len(new_hybrid)
+        )
+    )
+
+
+def _set_state(state: KBState) -> None:
+    # Se llama con _lock tomado.
+    global _state
+    _state = state
+    metrics.set_gauge("kb_generation", state.generation)
+    metrics.set_gauge("kb_entries", len(state.entries))
+
+
+def _publish(entries: List[Dict[str, Any]], signature: Optional[Tuple[Any, Any]]) -> Tuple[KBState, bool]:
+    # Se llama con _lock tomado.
+    global _file_signature
+    _file_signature = signature
+    content_hash = _content_hash(entries)
+    if _state is not None and _state.content_hash == content_hash:
+        return _state, False
+    _set_state(_build_state(entries, (_state.generation + 1) if _state is not None else 1, content_hash))
+    return _state, True
+
+
+def _notify(state: KBState) -> None:
+    for listener in list(_listeners):
+        try:
+            listener(state)
+        except Exception as e:
+            print(f"Error notifying KB listener: {e}")
+
+
+def current() -> KBState:
+    """Snapshot activo; se carga la primera vez que se pide."""
+    state = _state
+    if state is None:
+        state = reload(notify=False)
+    return state
+
+
+def reload(path: str = KB_PATH, notify: bool = True) -> KBState:
+    """
+    Vuelve a leer la KB (JSON base + diario) si alguno de los dos ficheros ha cambiado
+    (mtime/tamaño). Si no se puede leer, se conserva el snapshot anterior.
+    """
+    global _journal_ops
+    with _lock:
+        signature = _signature(path)
+        if _state is not None and signature == _file_signature:
+            return _state
+        entries = _read_file(path)
+        if entries is None:
+            if _state is not None:
+                return _state
+            entries = []
+        ops = _read_journal(journal_path(path))
+        if ops:
+            entries = _replay(entries, ops)
+        _journal_ops = len(ops)
+        state, changed = _publish(entries, signature)
+    if changed:
+        print(f"Knowledge Base generation {state.generation} loaded ({len(state.entries)} entries, {len(ops)} journal changes).")
+        if notify:
+            _notify(state)
+    return state
+
+
+def _append_journal(path: str, op: Dict[str, Any]) -> str:
+    line = json.dumps(op, ensure_ascii=False, separators=(",", ":"))
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(journal_path(path), "a", encoding="utf-8") as f:
+        f.write(line + "\n")
+        f.flush()
+        os.fsync(f.fileno())
+    return line
+
+
+def _commit(op: Dict[str, Any], path: str) -> KBState:
+    """Escribe la operación en el diario y publica la generación derivada de la actual."""
+    global _file_signature, _journal_ops, _compacting
+    current()
+    start = time.perf_counter()
+    with _lock:
+        located = _locate(_state.entries, _state.by_id, op)
+        if located is None:
+            return _state
+        line = _append_journal(path, op)
+        content_hash = hashlib.sha1(f"{_state.content_hash}\n{line}".encode("utf-8")).hexdigest()
+        _set_state(_splice_state(_state, op, *located, content_hash))
+        _file_signature = _signature(path)
+        _journal_ops += 1
+        state = _state
+        compact_now = _journal_ops >= KB_JOURNAL_COMPACT_EVERY and not _compacting
+        if compact_now:
+            _compacting = True
+    metrics.observe("kb_journal_write_seconds", time.perf_counter() - start)
+    metrics.set_gauge("kb_journal_ops", _journal_ops)
+    if compact_now:
+        threading.Thread(target=compact, args=(path,), name="kb-compact", daemon=True).start()
+    _notify(state)
+    return state
+
+
+def add_entry(entry: Dict[str, Any], path: str = KB_PATH) -> KBState:
+    """Añade una entrada (o sustituye la que tenga el mismo id) y publica la generación nueva."""
+    return _commit({"op": "put", "entry": entry}, path)
+
+
+def update_entry(entry: Dict[str, Any], path: str = KB_PATH) -> KBState:
+    return add_entry(entry, path)
+
+
+def delete_entry(incident_id: str, path: str = KB_PATH) -> KBState:
+    return _commit({"op": "delete", "id": incident_id}, path)
+
+
+def compact(path: str = KB_PATH) -> bool:
+    """
+    Vuelca la KB actual en el JSON base (de forma atómica) y vacía el diario. Si el proceso
+    muere entre los dos pasos, al arrancar se vuelve a aplicar el diario sobre la base nueva,
+    con el mismo resultado.
+    """
+    global _file_signature, _journal_ops, _compacting
+    try:
+        with _lock:
+            if _state is None or not _journal_ops:
+                return False
+            start = time.perf_counter()
+            tmp_path = path + ".tmp"
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                json.dump(_state.entries, f, indent=4, ensure_ascii=False)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp_path, path)
+            with open(journal_path(path), "w", encoding="utf-8"):
+                pass
+            _file_signature = _signature(path)
+            compacted, _journal_ops = _journal_ops, 0
+        metrics.inc("kb_journal_compactions")
+        metrics.set_gauge("kb_journal_ops", 0)
+        print(f"KB journal compacted: {compacted} changes written in {time.perf_counter() - start:.2f} seconds.")
+        return True
+    except Exception as e:
+        print(f"Error compacting KB journal: {e}")
+        return False
+    finally:
+        with _lock:
+            _compacting = False
+
+
+def subscribe(listener: Callable[[KBState], None]) -> None:
+    """listener(estado) se llama cada vez que se publica una generación nueva."""
+    if listener not in _listeners:
+        _listeners.append(listener)
+
+
+def get_entry(incident_id: str) -> Optional[Dict[str, Any]]:
+    return current().get(incident_id)
@@ -0,0 +1,203 @@
+import asyncio
+import random
+import threading
+import time
+from typing import Awaitable, Callable, Optional, TypeVar
+
+import httpx
+
+from app.config import (
+    LLM_MAX_RETRIES,
+    LLM_BACKOFF_BASE_SECONDS,
+    LLM_BACKOFF_MAX_SECONDS,
+    LLM_BREAKER_FAILURES,
+    LLM_BREAKER_RESET_SECONDS,
+    LLM_HEDGE_ENABLED,
+    LLM_HEDGE_MIN_DELAY_SECONDS,
+    LLM_HEDGE_MIN_SAMPLES
+)
+from app.services import metrics
+
+"""
+Resiliencia de las llamadas al LLM.
+Los errores transitorios (timeouts, errores de conexión, 429 y 5xx) se reintentan con
+backoff exponencial y jitter. Con LLM_HEDGE_ENABLED, si una llamada tarda más que el p95
+de las anteriores se lanza una segunda igual y se usa la primera que termine. Un circuit
+breaker cuenta los fallos transitorios seguidos: al llegar a LLM_BREAKER_FAILURES se abre
+y durante LLM_BREAKER_RESET_SECONDS las llamadas fallan al momento (el grafo responde
+entonces en modo híbrido); después deja pasar una sola llamada de prueba.
+"""
+
+T = TypeVar("T")
+
+RETRYABLE_STATUS = {408, 429, 500, 502, 503, 504}
+
+# Valor del gauge llm_breaker_state.
+CLOSED, HALF_OPEN, OPEN = "closed", "half_open", "open"
+_STATE_VALUES = {CLOSED: 0, HALF_OPEN: 1, OPEN: 2}
+
+
+class CircuitOpenError(Exception):
+    pass
+
+
+def is_retryable(exc: BaseException) -> bool:
+    """Errores transitorios: merece la pena reintentar y cuentan como fallo del servicio."""
+    if isinstance(exc, httpx.TransportError):
+        return True
+    return getattr(exc, "status_code", None) in RETRYABLE_STATUS
+
+
+def backoff_delay(attempt: int, base: float = LLM_BACKOFF_BASE_SECONDS, cap: float = LLM_BACKOFF_MAX_SECONDS) -> float:
+    """Espera antes del reintento `attempt` (desde 0): la mitad fija y la otra mitad aleatoria."""
+    delay = min(cap, base * 2 ** attempt)
+    return delay / 2 + random.uniform(0, delay / 2)
+
+
+class CircuitBreaker:
+    def __init__(self, failure_threshold: int = LLM_BREAKER_FAILURES, reset_seconds: float = LLM_BREAKER_RESET_SECONDS):
+        self.failure_threshold = max(1, failure_threshold)
+        self.reset_seconds = reset_seconds
+        self.state = CLOSED
+        self.failures = 0
+        self.opened_at = 0.0
+        self.rejections = 0
+        # En semiabierto solo hay una llamada de prueba a la vez.
+        self._probing = False
+        self._lock = threading.Lock()
+        metrics.set_gauge("llm_breaker_state", _STATE_VALUES[CLOSED])
+
+    def _set(self, state: str) -> None:
+        if state == self.state:
+            return
+        print(f"LLM circuit breaker: {self.state} -> {state}")
+        self.state = state
+        if state == OPEN:
+            self.opened_at = time.monotonic()
+        metrics.inc("llm_breaker_transitions", to=state)
+        metrics.set_gauge("llm_breaker_state", _STATE_VALUES[state])
+
+    def is_open(self) -> bool:
+        """True mientras las llamadas se rechazan sin intentarlas."""
+        with self._lock:
+            return self.state == OPEN and time.monotonic() - self.opened_at < self.reset_seconds
+
+    def allow(self) -> bool:
+        with self._lock:
+            if self.state == CLOSED:
+                return True
+            if self.state == OPEN and time.monotonic() - self.opened_at >= self.reset_seconds:
+                self._set(HALF_OPEN)
+            if self.state == HALF_OPEN and not self._probing:
+                self._probing = True
+                return True
+            self.rejections += 1
+        metrics.inc("llm_breaker_rejections")
+        return False
+
+    def record_success(self) -> None:
+        with self._lock:
+            self.failures = 0
+            self._probing = False
+            self._set(CLOSED)
+
+    def record_failure(self) -> None:
+        with self._lock:
+            self.failures += 1
+            self._probing = False
+            if self.state == HALF_OPEN or self.failures >= self.failure_threshold:
+                self._set(OPEN)
+
+    def release(self) -> None:
+        # La llamada de prueba se canceló sin resultado: la siguiente podrá probar.
+        with self._lock:
+            self._probing = False
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "state": self.state,
+                "consecutive_failures": self.failures,
+                "rejections": self.rejections
+            }
+
+
+LLM_BREAKER = CircuitBreaker()
+
+# Duración de las llamadas que han ido bien, para el retardo de las peticiones de cobertura.
+_latencies = metrics.Histogram(256)
+_latencies_lock = threading.Lock()
+
+
+def hedge_delay() -> Optional[float]:
+    """p95 de las últimas llamadas (con un mínimo), o None si aún no hay muestras suficientes."""
+    with _latencies_lock:
+        if len(_latencies.recent) < LLM_HEDGE_MIN_SAMPLES:
+            return None
+        return max(LLM_HEDGE_MIN_DELAY_SECONDS, _latencies.percentile(0.95))
+
+
+async def _hedged(call: Callable[[], Awaitable[T]]) -> T:
+    delay = hedge_delay()
+    tasks = [asyncio.ensure_future(call())]
+    try:
+        if delay is None:
+            return await tasks[0]
+        done, _ = await asyncio.wait(tasks, timeout=delay)
+        if not done:
+            metrics.inc("llm_hedges")
+            tasks.append(asyncio.ensure_future(call()))
+        pending = set(tasks)
+        error: Optional[BaseException] = None
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                if task.exception() is None:
+                    if task is not tasks[0]:
+                        metrics.inc("llm_hedge_wins")
+                    return task.result()
+                error = task.exception()
+        raise error
+    finally:
+        for task in tasks:
+            if not task.done():
+                task.cancel()
+
+
+async def resilient_call(call: Callable[[], Awaitable[T]], hedge: bool = LLM_HEDGE_ENABLED,
+                         can_retry: Optional[Callable[[], bool]] = None, breaker: CircuitBreaker = LLM_BREAKER,
+                         max_retries: int = LLM_MAX_RETRIES) -> T:
+    """
+    Ejecuta call() con reintentos, cobertura opcional y circuit breaker. can_retry permite
+    vetar el reintento (p. ej. si un streaming ya ha entregado texto). Lanza CircuitOpenError
+    si el breaker está abierto, o el último error de la llamada.
+    """
+    for attempt in range(max(0, max_retries) + 1):
+        if not breaker.allow():
+            raise CircuitOpenError("LLM circuit breaker is open")
+        started = time.perf_counter()
+        recorded = False
+        try:
+            result = await (_hedged(call) if hedge else call())
+            breaker.record_success()
+            recorded = True
+            with _latencies_lock:
+                _latencies.observe(time.perf_counter() - started)
+            return result
+        except Exception as e:
+            if not is_retryable(e):
+                # El servicio ha respondido (petición inválida, prompt bloqueado...): no es una caída.
+                breaker.record_success()
+                recorded = True
+                raise
+            breaker.record_failure()
+            recorded = True
+            if attempt >= max_retries or breaker.is_open() or (can_retry is not None and not can_retry()):
+                raise
+            reason = getattr(e, "status_code", None) or type(e).__name__
+            print(f"LLM call failed ({reason}), retry {attempt + 1}/{max_retries}")
+            metrics.inc("llm_retries", reason=reason)
+        finally:
+            if not recorded:
+                breaker.release()
+        await asyncio.sleep(backoff_delay(attempt))
@@ -0,0 +1,234 @@
+import asyncio
+import heapq
+import itertools
+import threading
+import time
+from contextlib import asynccontextmanager
+from typing import Dict, List, Optional, Tuple
+
+from app.config import (
+    LLM_MAX_IN_FLIGHT,
+    LLM_RATE_PER_SECOND,
+    LLM_RATE_BURST,
+    LLM_QUEUE_MAX,
+    LLM_QUEUE_TIMEOUT_SECONDS,
+    LLM_BATCH_QUEUE_TIMEOUT_SECONDS
+)
+from app.services import metrics
+
+"""
+Planificador global de llamadas al LLM, compartido por todo el proceso (API y UI, cada una
+con su bucle de eventos). Una llamada entra si hay hueco (LLM_MAX_IN_FLIGHT) y token en el
+cubo (LLM_RATE_PER_SECOND con ráfagas de LLM_RATE_BURST); si no, espera en una cola acotada
+por prioridad: el chat interactivo pasa antes que los resúmenes en segundo plano y que el
+tráfico de lotes o benchmarks. Si la espera supera su plazo, o la cola está llena, la llamada
+se rechaza al momento con LLMOverloaded (el grafo responde entonces en modo híbrido).
+"""
+
+INTERACTIVE, BACKGROUND, BATCH = "interactive", "background", "batch"
+PRIORITIES = {INTERACTIVE: 0, BACKGROUND: 1, BATCH: 2}
+
+QUEUED, GRANTED, REJECTED = "queued", "granted", "rejected"
+
+
+class LLMOverloaded(Exception):
+    def __init__(self, message: str, reason: str):
+        super().__init__(message)
+        self.reason = reason
+
+
+class TokenBucket:
+    """Sin bloqueo propio: se usa bajo el del planificador. rate <= 0 desactiva el límite."""
+
+    def __init__(self, rate: float, burst: int):
+        self.rate = rate
+        self.capacity = max(1, burst)
+        self.tokens = float(self.capacity)
+        self.updated = time.monotonic()
+
+    def take(self) -> float:
+        """0 si se ha tomado un token; si no, segundos hasta que haya uno."""
+        if self.rate <= 0:
+            return 0.0
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0.0
+        return (1 - self.tokens) / self.rate
+
+
+class _Waiter:
+    __slots__ = ("priority", "loop", "future", "enqueued", "state", "reason")
+
+    def __init__(self, priority: str, loop: asyncio.AbstractEventLoop):
+        self.priority = priority
+        self.loop = loop
+        self.future = loop.create_future()
+        self.enqueued = time.perf_counter()
+        self.state = QUEUED
+        self.reason = ""
+
+
+def _wake(future: asyncio.Future) -> None:
+    if not future.done():
+        future.set_result(None)
+
+
+class LLMScheduler:
+    def __init__(self, max_in_flight: int = LLM_MAX_IN_FLIGHT, rate_per_second: float = LLM_RATE_PER_SECOND,
+                 burst: int = LLM_RATE_BURST, max_queue: int = LLM_QUEUE_MAX,
+                 queue_timeout: float = LLM_QUEUE_TIMEOUT_SECONDS,
+                 batch_queue_timeout: float = LLM_BATCH_QUEUE_TIMEOUT_SECONDS):
+        self.max_in_flight = max(1, max_in_flight)
+        self.max_queue = max(0, max_queue)
+        self.queue_timeout = queue_timeout
+        self.batch_queue_timeout = batch_queue_timeout
+        self._bucket = TokenBucket(rate_per_second, burst)
+        # Montículo de (prioridad, orden de llegada, espera).
+        self._queue: List[Tuple[int, int, _Waiter]] = []
+        self._order = itertools.count()
+        self._depth: Dict[str, int] = {p: 0 for p in PRIORITIES}
+        # Segundos hasta el próximo token cuando la cola está parada por el límite de ritmo.
+        self._retry_after: Optional[float] = None
+        self._lock = threading.Lock()
+        self.in_flight = 0
+        self.admitted = 0
+        self.rejected = 0
+
+    def _timeout(self, priority: str) -> float:
+        return self.queue_timeout if priority == INTERACTIVE else self.batch_queue_timeout
+
+    def _push(self, waiter: _Waiter) -> None:
+        heapq.heappush(self._queue, (PRIORITIES[waiter.priority], next(self._order), waiter))
+        self._depth[waiter.priority] += 1
+        metrics.set_gauge("llm_queue_depth", self._depth[waiter.priority], priority=waiter.priority)
+
+    def _remove(self, waiter: _Waiter) -> None:
+        self._queue = [item for item in self._queue if item[2] is not waiter]
+        heapq.heapify(self._queue)
+        self._depth[waiter.priority] -= 1
+        metrics.set_gauge("llm_queue_depth", self._depth[waiter.priority], priority=waiter.priority)
+
+    def _reject(self, waiter: _Waiter, reason: str) -> None:
+        waiter.state = REJECTED
+        waiter.reason = reason
+        self.rejected += 1
+        metrics.inc("llm_rejected", reason=reason, priority=waiter.priority)
+
+    def _grant(self, waiter: _Waiter) -> None:
+        waiter.state = GRANTED
+        self.in_flight += 1
+        self.admitted += 1
+        metrics.set_gauge("llm_scheduler_in_flight", self.in_flight)
+        metrics.observe("llm_queue_seconds", time.perf_counter() - waiter.enqueued, priority=waiter.priority)
+
+    def _dispatch(self) -> List[_Waiter]:
+        # Da paso a los primeros de la cola mientras haya hueco y tokens; devuelve a quién despertar.
+        woken = []
+        self._retry_after = None
+        while self._queue and self.in_flight < self.max_in_flight:
+            delay = self._bucket.take()
+            if delay > 0:
+                self._retry_after = delay
+                break
+            waiter = heapq.heappop(self._queue)[2]
+            self._depth[waiter.priority] -= 1
+            metrics.set_gauge("llm_queue_depth", self._depth[waiter.priority], priority=waiter.priority)
+            self._grant(waiter)
+            woken.append(waiter)
+        return woken
+
+    def _notify(self, woken: List[_Waiter]) -> None:
+        for waiter in woken:
+            try:
+                waiter.loop.call_soon_threadsafe(_wake, waiter.future)
+            except RuntimeError:
+                # Su bucle ya se ha cerrado: nadie va a usar el hueco.
+                if waiter.state == GRANTED:
+                    self.release()
+
+    async def acquire(self, priority: str = INTERACTIVE, timeout: Optional[float] = None) -> None:
+        """Espera turno; lanza LLMOverloaded si la cola está llena o vence el plazo."""
+        if priority not in PRIORITIES:
+            raise ValueError(f"Unknown LLM priority: {priority}")
+        timeout = self._timeout(priority) if timeout is None else timeout
+        waiter = _Waiter(priority, asyncio.get_running_loop())
+        woken: List[_Waiter] = []
+        with self._lock:
+            if not self._queue and self.in_flight < self.max_in_flight and self._bucket.take() == 0:
+                self._grant(waiter)
+                return
+            if len(self._queue) >= self.max_queue:
+                worst = max(self._queue, default=None)
+                if worst is None or worst[0] <= PRIORITIES[priority]:
+                    self._reject(waiter, "queue_full")
+                    raise LLMOverloaded("LLM queue is full", "queue_full")
+                # Una llamada más prioritaria desplaza a la última de menor prioridad.
+                self._remove(worst[2])
+                self._reject(worst[2], "preempted")
+                woken.append(worst[2])
+            self._push(waiter)
+            woken += self._dispatch()
+        self._notify(woken)
+
+        deadline = waiter.enqueued + timeout
+        try:
+            while waiter.state == QUEUED:
+                remaining = deadline - time.perf_counter()
+                if remaining <= 0:
+                    break
+                # Con la cola parada por el límite de ritmo nadie libera huecos: se reintenta al llegar el token.
+                poll = min(remaining, self._retry_after) if self._retry_after else remaining
+                try:
+                    await asyncio.wait_for(asyncio.shield(waiter.future), max(poll, 0.001))
+                except asyncio.TimeoutError:
+                    pass
+                with self._lock:
+                    woken = self._dispatch() if waiter.state == QUEUED else []
+                self._notify(woken)
+        except BaseException:
+            with self._lock:
+                if waiter.state == QUEUED:
+                    self._remove(waiter)
+                    waiter.state = REJECTED
+                granted = waiter.state == GRANTED
+            if granted:
+                self.release()
+            raise
+
+        with self._lock:
+            if waiter.state == QUEUED:
+                self._remove(waiter)
+                self._reject(waiter, "deadline")
+        if waiter.state != GRANTED:
+            raise LLMOverloaded(f"LLM call not admitted ({waiter.reason})", waiter.reason)
+
+    def release(self) -> None:
+        with self._lock:
+            self.in_flight -= 1
+            metrics.set_gauge("llm_scheduler_in_flight", self.in_flight)
+            woken = self._dispatch()
+        self._notify(woken)
+
+    @asynccontextmanager
+    async def slot(self, priority: str = INTERACTIVE, timeout: Optional[float] = None):
+        await self.acquire(priority, timeout)
+        try:
+            yield
+        finally:
+            self.release()
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "in_flight": self.in_flight,
+                "max_in_flight": self.max_in_flight,
+                "queued": dict(self._depth),
+                "admitted": self.admitted,
+                "rejected": self.rejected
+            }
+
+
+LLM_SCHEDULER = LLMScheduler()
@@ -0,0 +1,83 @@
+import threading
+from collections import defaultdict, deque
+from typing import Any, Deque, Dict, Optional
+
+"""
+Métricas de proceso (contadores, gauges e histogramas) en memoria.
+Los nombres siguen el formato nombre{etiqueta=valor,...} y se exponen en /metrics.
+"""
+
+HISTOGRAM_WINDOW = 1024
+
+_lock = threading.Lock()
+_counters: Dict[str, float] = defaultdict(float)
+_gauges: Dict[str, float] = {}
+_histograms: Dict[str, "Histogram"] = {}
+
+
+class Histogram:
+    # Cuenta y suma totales más una ventana de las últimas observaciones para percentiles.
+    def __init__(self, window: int = HISTOGRAM_WINDOW):
+        self.count = 0
+        self.total = 0.0
+        self.recent: Deque[float] = deque(maxlen=window)
+
+    def observe(self, value: float) -> None:
+        self.count += 1
+        self.total += value
+        self.recent.append(value)
+
+    def percentile(self, q: float) -> Optional[float]:
+        if not self.recent:
+            return None
+        values = sorted(self.recent)
+        return values[min(len(values) - 1, int(q * len(values)))]
+
+    def summary(self) -> Dict[str, Any]:
+        return {
+            "count": self.count,
+            "sum": self.total,
+            "p50": self.percentile(0.50),
+            "p95": self.percentile(0.95),
+            "p99": self.percentile(0.99)
+        }
+
+
+def _key(name: str, labels: Dict[str, Any]) -> str:
+    if not labels:
+        return name
+    return name + "{" + ",".join(f"{k}={v}" for k, v in sorted(labels.items())) + "}"
+
+
+def inc(name: str, value: float = 1, **labels) -> None:
+    with _lock:
+        _counters[_key(name, labels)] += value
+
+
+def set_gauge(name: str, value: float, **labels) -> None:
+    with _lock:
+        _gauges[_key(name, labels)] = value
+
+
+def observe(name: str, value: float, **labels) -> None:
+    key = _key(name, labels)
+    with _lock:
+        histogram = _histograms.get(key)
+        if histogram is None:
+            histogram = _histograms[key] = Histogram()
+        histogram.observe(value)
+
+
+def percentile(name: str, q: float, **labels) -> Optional[float]:
+    with _lock:
+        histogram = _histograms.get(_key(name, labels))
+        return histogram.percentile(q) if histogram else None
+
+
+def snapshot() -> Dict[str, Any]:
+    with _lock:
+        return {
+            "counters": dict(_counters),
+            "gauges": dict(_gauges),
+            "histograms": {k: h.summary() for k, h in _histograms.items()}
+        }
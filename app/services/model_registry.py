@@ -0,0 +1,247 @@
+import os
+import re
+import threading
+import time
+from typing import TYPE_CHECKING, Any, Dict, List
+
+import numpy as np
+
+from app.config import DATA_DIR, ENCODER_BACKEND, ENCODER_BACKENDS, ENCODER_PARITY_TOLERANCE
+from app.services import metrics
+
+if TYPE_CHECKING:
+    from sentence_transformers import SentenceTransformer
+
+"""
+Registro de modelos de embeddings del proceso.
+Cada encoder se carga de forma perezosa una única vez y sobrevive a las recargas de
+la KB; ambos motores de búsqueda lo piden aquí en lugar de instanciarlo ellos.
+
+Backends por modelo (ENCODER_BACKEND / ENCODER_BACKENDS):
+- "torch": SentenceTransformer tal cual.
+- "int8": cuantización dinámica int8 de las capas Linear con PyTorch.
+- "onnx": grafo ONNX exportado desde los pesos en caché y ejecutado con onnxruntime.
+Los backends alternativos pasan una comprobación de paridad (similitud coseno con el
+modelo de referencia); si no la superan se usa el modelo torch.
+torch y sentence-transformers se importan al cargar el primer modelo, no al importar
+este módulo, para que la API arranque sin esperar a ellos.
+"""
+
+ONNX_DIR = DATA_DIR / "onnx"
+
+PARITY_SENTENCES = [
+    "la impresora no imprime",
+    "no me funciona la vpn",
+    "no puedo acceder al correo desde el móvil",
+    "me da error al iniciar sesión en el ordenador de la oficina",
+]
+
+_models: Dict[str, Any] = {}
+_stats: Dict[str, Dict[str, Any]] = {}
+_lock = threading.Lock()
+
+
+def backend_for(name: str) -> str:
+    # ENCODER_BACKENDS: "modelo=backend;otro_modelo=backend"
+    for entry in ENCODER_BACKENDS.split(";"):
+        if "=" in entry:
+            model_name, backend = entry.rsplit("=", 1)
+            if model_name.strip() == name:
+                return backend.strip()
+    return ENCODER_BACKEND
+
+
+def model_tag(name: str) -> str:
+    """Identificador del encoder para claves de caché: cambia si cambia el backend."""
+    backend = _stats.get(name, {}).get("backend") or backend_for(name)
+    return name if backend == "torch" else f"{name}@{backend}"
+
+
+class OnnxEncoder:
+    """Encoder con la misma interfaz de encode() que SentenceTransformer, sobre onnxruntime."""
+
+    def __init__(self, reference: "SentenceTransformer", onnx_path: str):
+        import onnxruntime as ort
+        from sentence_transformers.models import Normalize
+
+        self.onnx_path = onnx_path
+        self.tokenizer = reference.tokenizer
+        self.max_seq_length = reference.max_seq_length
+        pooling = reference[1]
+        self.pooling_cls = bool(getattr(pooling, "pooling_mode_cls_token", False))
+        self.normalize = any(isinstance(module, Normalize) for module in reference)
+        self.dimension = reference.get_sentence_embedding_dimension()
+        self.session = ort.InferenceSession(onnx_path, providers=["CPUExecutionProvider"])
+        self.input_names = {i.name for i in self.session.get_inputs()}
+
+    @staticmethod
+    def export(reference: "SentenceTransformer", onnx_path: str) -> None:
+        import torch
+
+        transformer = reference[0].auto_model
+        transformer.eval()
+        sample = reference.tokenizer(["texto de ejemplo"], return_tensors="pt")
+        os.makedirs(os.path.dirname(onnx_path), exist_ok=True)
+        with torch.no_grad():
+            torch.onnx.export(
+                transformer,
+                (sample["input_ids"], sample["attention_mask"]),
+                onnx_path,
+                input_names=["input_ids", "attention_mask"],
+                output_names=["last_hidden_state"],
+                dynamic_axes={
+                    "input_ids": {0: "batch", 1: "sequence"},
+                    "attention_mask": {0: "batch", 1: "sequence"},
+                    "last_hidden_state": {0: "batch", 1: "sequence"}
+                },
+                opset_version=14
+            )
+
+    def eval(self):
+        return self
+
+    def get_sentence_embedding_dimension(self) -> int:
+        return self.dimension
+
+    def encode(self, sentences, batch_size: int = 32, convert_to_tensor: bool = False, convert_to_numpy: bool = True,
+               normalize_embeddings: bool = False, show_progress_bar: bool = False, **kwargs):
+        single = isinstance(sentences, str)
+        if single:
+            sentences = [sentences]
+
+        order = sorted(range(len(sentences)), key=lambda i: len(sentences[i]))
+        embeddings = np.empty((len(sentences), self.dimension), dtype=np.float32)
+        for start in range(0, len(order), batch_size):
+            batch = order[start:start + batch_size]
+            tokens = self.tokenizer(
+                [sentences[i] for i in batch],
+                padding=True,
+                truncation=True,
+                max_length=self.max_seq_length,
+                return_tensors="np"
+            )
+            feed = {name: tokens[name].astype(np.int64) for name in self.input_names}
+            hidden = self.session.run(None, feed)[0]
+            if self.pooling_cls:
+                pooled = hidden[:, 0]
+            else:
+                mask = tokens["attention_mask"][..., None].astype(np.float32)
+                pooled = (hidden * mask).sum(axis=1) / np.clip(mask.sum(axis=1), 1e-9, None)
+            embeddings[batch] = pooled
+
+        if self.normalize or normalize_embeddings:
+            embeddings /= np.clip(np.linalg.norm(embeddings, axis=1, keepdims=True), 1e-12, None)
+
+        result = embeddings
+        if convert_to_tensor:
+            import torch
+            result = torch.from_numpy(embeddings)
+        return result[0] if single else result
+
+
+def _cosine_parity(reference, candidate, sentences: List[str]) -> float:
+    expected = np.asarray(reference.encode(sentences, convert_to_numpy=True, show_progress_bar=False), dtype=np.float32)
+    actual = np.asarray(candidate.encode(sentences, convert_to_numpy=True, show_progress_bar=False), dtype=np.float32)
+    cosine = (expected * actual).sum(axis=1) / (
+        np.linalg.norm(expected, axis=1) * np.linalg.norm(actual, axis=1)
+    )
+    return float(cosine.min())
+
+
+def check_parity(name: str, sentences: List[str] = PARITY_SENTENCES, tolerance: float = ENCODER_PARITY_TOLERANCE) -> Dict[str, Any]:
+    """Compara el encoder cargado con el modelo torch de referencia."""
+    from sentence_transformers import SentenceTransformer
+
+    reference = SentenceTransformer(name, device="cpu")
+    reference.eval()
+    min_cosine = _cosine_parity(reference, get_model(name), sentences)
+    return {"model": name, "backend": model_tag(name), "min_cosine": min_cosine, "ok": min_cosine >= 1 - tolerance}
+
+
+def _build_backend(name: str, backend: str, reference: "SentenceTransformer"):
+    import torch
+
+    if backend == "int8":
+        return torch.quantization.quantize_dynamic(reference, {torch.nn.Linear}, dtype=torch.qint8)
+    if backend == "onnx":
+        onnx_path = str(ONNX_DIR / (re.sub(r"[^\w.-]", "_", name) + ".onnx"))
+        if not os.path.exists(onnx_path):
+            print(f"Exporting '{name}' to ONNX ({onnx_path})...")
+            OnnxEncoder.export(reference, onnx_path)
+        return OnnxEncoder(reference, onnx_path)
+    raise ValueError(f"Unknown encoder backend '{backend}'")
+
+
+def _resident_bytes(model) -> int:
+    import torch
+
+    if isinstance(model, OnnxEncoder):
+        return os.path.getsize(model.onnx_path)
+    total = 0
+    for value in model.state_dict().values():
+        if isinstance(value, tuple):
+            # Capas Linear cuantizadas: (pesos empaquetados, bias).
+            value = [v for v in value if isinstance(v, torch.Tensor)]
+        for tensor in (value if isinstance(value, list) else [value]):
+            if isinstance(tensor, torch.Tensor):
+                total += tensor.numel() * tensor.element_size()
+    return total
+
+
+def get_model(name: str):
+    model = _models.get(name)
+    if model is not None:
+        return model
+
+    with _lock:
+        model = _models.get(name)
+        if model is not None:
+            return model
+
+        from sentence_transformers import SentenceTransformer
+
+        backend = backend_for(name)
+        print(f"Loading SentenceTransformer model '{name}' (backend: {backend})...")
+        start = time.time()
+        model = SentenceTransformer(name, device="cpu")
+        model.eval()
+
+        if backend != "torch":
+            try:
+                candidate = _build_backend(name, backend, model)
+                min_cosine = _cosine_parity(model, candidate, PARITY_SENTENCES)
+                if min_cosine >= 1 - ENCODER_PARITY_TOLERANCE:
+                    print(f"Backend '{backend}' for '{name}' passed parity check (min cosine {min_cosine:.4f}).")
+                    model = candidate
+                else:
+                    print(
+                        f"Backend '{backend}' for '{name}' failed parity check (min cosine {min_cosine:.4f}). "
+                        f"Using torch model."
+                    )
+                    backend = "torch"
+            except Exception as e:
+                print(f"Could not build '{backend}' backend for '{name}': {e}. Using torch model.")
+                backend = "torch"
+
+        load_seconds = time.time() - start
+        resident = _resident_bytes(model)
+        _stats[name] = {
+            "backend": backend,
+            "load_seconds": load_seconds,
+            "resident_mb": resident / (1024 * 1024),
+            "dimension": model.get_sentence_embedding_dimension()
+        }
+        metrics.set_gauge("model_load_seconds", load_seconds, model=name)
+        metrics.set_gauge("model_resident_bytes", resident, model=name)
+        print(f"Model '{name}' loaded in {load_seconds:.2f} seconds ({resident / (1024 * 1024):.0f} MB).")
+
+        _models[name] = model
+        return model
+
+
+def is_loaded(name: str) -> bool:
+    return name in _models
+
+
+def model_stats() -> Dict[str, Dict[str, Any]]:
+    return {name: dict(stats) for name, stats in _stats.items()}
@@ -0,0 +1,97 @@
+from dataclasses import dataclass, replace
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+
+import numpy as np
+
+from app.services.vector_index import build_vector_index, top_k_indices
+
+"""
+Índice secundario de pasajes de la KB.
+Cada paso de diagnóstico, síntoma y pregunta inicial de una incidencia es un pasaje con
+su propio embedding, enlazado a la posición de su incidencia. Los pasajes de una misma
+incidencia quedan contiguos, así que elegir sus pasos más relevantes solo puntúa esa
+porción con el embedding de la consulta que ya se ha calculado: no se codifica nada más.
+"""
+
+STEP, SYMPTOM, QUESTION = "step", "symptom", "question"
+
+
+@dataclass(frozen=True)
+class Passage:
+    entry: int
+    kind: str
+    item: int
+    text: str
+
+
+def extract_passages(entries: Sequence[Dict[str, Any]]) -> List[Passage]:
+    """Pasajes de las entradas en orden; entry es la posición de la entrada en `entries`."""
+    passages = []
+    for position, entry in enumerate(entries):
+        guide = entry.get("resolution_guide_llm") or {}
+        for i, step in enumerate(guide.get("diagnostic_steps") or []):
+            if isinstance(step, dict):
+                text = ". ".join(filter(None, [step.get("title", ""), step.get("user_action", "")]))
+            else:
+                text = str(step)
+            if text.strip():
+                passages.append(Passage(position, STEP, i, text))
+        for i, symptom in enumerate(entry.get("symptoms") or []):
+            if str(symptom).strip():
+                passages.append(Passage(position, SYMPTOM, i, str(symptom)))
+        for i, question in enumerate(guide.get("initial_questions") or []):
+            if str(question).strip():
+                passages.append(Passage(position, QUESTION, i, str(question)))
+    return passages
+
+
+class PassageIndex:
+    def __init__(self, passages: List[Passage], matrix: Optional[np.ndarray], n_entries: int,
+                 path: Optional[str] = None, fingerprint: str = "", index: Any = None):
+        self.passages = passages
+        self.fingerprint = fingerprint
+        self.index = index if index is not None else build_vector_index(matrix, path, fingerprint)
+        self.entries = np.fromiter((p.entry for p in passages), dtype=np.int64, count=len(passages))
+        self.kinds = np.array([p.kind for p in passages])
+        # Pasajes de la entrada e: filas offsets[e]:offsets[e + 1].
+        self.offsets = np.searchsorted(self.entries, np.arange(n_entries + 1))
+
+    def __len__(self) -> int:
+        return len(self.passages)
+
+    def splice(self, start: int, stop: int, count: int, passages: List[Passage], matrix: np.ndarray,
+               fingerprint: str = "") -> "PassageIndex":
+        """
+        Copia con las entradas start:stop sustituidas por `count` entradas nuevas. `passages`
+        son los pasajes de las nuevas (entry numerado desde 0) y `matrix` sus embeddings.
+        """
+        first, last = int(self.offsets[start]), int(self.offsets[stop])
+        shift = count - (stop - start)
+        tail = self.passages[last:]
+        if shift:
+            tail = [replace(p, entry=p.entry + shift) for p in tail]
+        spliced = self.passages[:first] + [replace(p, entry=start + p.entry) for p in passages] + tail
+        index = self.index.splice(first, last, matrix, fingerprint)
+        return PassageIndex(spliced, None, len(self.offsets) - 1 + shift, fingerprint=fingerprint, index=index)
+
+    def for_entry(self, query: np.ndarray, entry: int, kind: Optional[str] = None,
+                  k: Optional[int] = None) -> List[Tuple[Passage, float]]:
+        """Pasajes de una entrada, de más a menos relevante para la consulta."""
+        if entry + 1 >= len(self.offsets):
+            return []
+        rows = np.arange(self.offsets[entry], self.offsets[entry + 1])
+        if kind is not None:
+            rows = rows[self.kinds[rows] == kind]
+        if not len(rows):
+            return []
+        scores = self.index.store.score(query, rows)
+        top = top_k_indices(scores, k if k is not None else len(rows))
+        return [(self.passages[rows[i]], float(scores[i])) for i in top]
+
+    def best_steps(self, query: np.ndarray, entry: int, k: int) -> List[int]:
+        """Índices de los k pasos más relevantes de la entrada, en su orden original."""
+        return sorted(p.item for p, _ in self.for_entry(query, entry, STEP, k))
+
+    def search(self, query: np.ndarray, k: int) -> List[Tuple[Passage, float]]:
+        rows, scores = self.index.search(query, k)
+        return [(self.passages[r], float(s)) for r, s in zip(rows, scores)]
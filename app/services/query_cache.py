@@ -0,0 +1,142 @@
+import re
+import threading
+import time
+from collections import Counter, OrderedDict
+from typing import Any, Callable, List, Tuple
+
+from app.config import (
+    QUERY_CACHE_MAX_ENTRIES,
+    QUERY_CACHE_MAX_MB,
+    QUERY_CACHE_TTL_SECONDS
+)
+from app.services import metrics
+from app.services.conversation_store import CONVERSATION_STORE
+
+"""
+Caché LRU + TTL de embeddings de consultas, compartida por los dos motores de búsqueda.
+La clave es (modelo, consulta normalizada); un acierto evita pasar por el transformer.
+"""
+
+
+def normalize_cache_query(query: str) -> str:
+    # Los tokenizadores de ambos modelos pasan a minúsculas, así que esto no cambia el embedding.
+    return re.sub(r"\s+", " ", (query or "").lower()).strip()
+
+
+def _nbytes(value: Any) -> int:
+    if hasattr(value, "nbytes"):
+        return int(value.nbytes)
+    if hasattr(value, "element_size"):
+        return int(value.element_size() * value.nelement())
+    return 0
+
+
+class QueryEmbeddingCache:
+    def __init__(self, max_entries: int = QUERY_CACHE_MAX_ENTRIES, max_bytes: int = int(QUERY_CACHE_MAX_MB * 1024 * 1024),
+                 ttl_seconds: float = QUERY_CACHE_TTL_SECONDS):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl_seconds = ttl_seconds
+        self._entries: "OrderedDict[Tuple[str, str], Tuple[float, int, Any]]" = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, model_name: str, query: str):
+        key = (model_name, normalize_cache_query(query))
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and time.monotonic() - entry[0] > self.ttl_seconds:
+                self._drop(key)
+                entry = None
+            if entry is None:
+                self.misses += 1
+                metrics.inc("query_cache_misses", model=model_name)
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+        metrics.inc("query_cache_hits", model=model_name)
+        return entry[2]
+
+    def contains(self, model_name: str, query: str) -> bool:
+        key = (model_name, normalize_cache_query(query))
+        with self._lock:
+            entry = self._entries.get(key)
+            return entry is not None and time.monotonic() - entry[0] <= self.ttl_seconds
+
+    def put(self, model_name: str, query: str, embedding: Any) -> None:
+        key = (model_name, normalize_cache_query(query))
+        size = _nbytes(embedding)
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            if key in self._entries:
+                self._drop(key)
+            self._entries[key] = (time.monotonic(), size, embedding)
+            self._bytes += size
+            while self._entries and (len(self._entries) > self.max_entries or self._bytes > self.max_bytes):
+                self._drop(next(iter(self._entries)))
+                self.evictions += 1
+                metrics.inc("query_cache_evictions")
+            metrics.set_gauge("query_cache_entries", len(self._entries))
+            metrics.set_gauge("query_cache_bytes", self._bytes)
+
+    def get_or_encode(self, model_name: str, query: str, encode: Callable[[str], Any]):
+        """Devuelve el embedding cacheado o llama a encode(consulta_normalizada) y lo guarda."""
+        embedding = self.get(model_name, query)
+        if embedding is None:
+            embedding = encode(normalize_cache_query(query))
+            self.put(model_name, query, embedding)
+        return embedding
+
+    def _drop(self, key) -> None:
+        _, size, _ = self._entries.pop(key)
+        self._bytes -= size
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+
+    def stats(self) -> dict:
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                "entries": len(self._entries),
+                "bytes": self._bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "hit_ratio": self.hits / total if total else 0.0
+            }
+
+
+QUERY_EMBEDDING_CACHE = QueryEmbeddingCache()
+
+
+def frequent_queries(limit: int) -> List[str]:
+    """Mensajes de usuario más repetidos en el almacén de conversaciones, para precalentar la caché."""
+    if limit <= 0:
+        return []
+    counts = Counter()
+    try:
+        for _, conversation in CONVERSATION_STORE.iter_conversations():
+            messages = conversation.get("conversation", []) if isinstance(conversation, dict) else conversation
+            for message in messages if isinstance(messages, list) else []:
+                if isinstance(message, dict) and message.get("role") == "user" and message.get("content"):
+                    counts[normalize_cache_query(message["content"])] += 1
+    except Exception as e:
+        print(f"Error reading conversations for query cache warm-up: {e}")
+        return []
+    return [query for query, _ in counts.most_common(limit)]
+
+
+def warm_up(model_name: str, queries: List[str], encode: Callable[[str], Any]) -> int:
+    warmed = 0
+    for query in queries:
+        if not QUERY_EMBEDDING_CACHE.contains(model_name, query):
+            QUERY_EMBEDDING_CACHE.put(model_name, query, encode(normalize_cache_query(query)))
+            warmed += 1
+    return warmed
@@ -8,11 +8,13 @@ import requests
 from cryptography.x509 import load_pem_x509_certificate
 from cryptography.hazmat.backends import default_backend
 
+from app.services.conversation_store import CONVERSATION_STORE
+from app.services.context_store import CONTEXT_STORE
+
 BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
 DATA_DIR = os.path.join(BASE_DIR, "data")
 
 KB_PATH = os.path.join(DATA_DIR, "KnowledgeBase.json")
-CONVERSATION_STORE_PATH = os.path.join(DATA_DIR, "conversation_store.json")
 
 def convert_markdown_for_google_chat(text: str) -> str:
     text = re.sub(r'\s+\*\s+', '\n- ', text)
@@ -22,62 +24,25 @@ def convert_markdown_for_google_chat(text: str) -> str:
     return text
 
 def get_conversation(chat_id: str):
-    if not os.path.exists(CONVERSATION_STORE_PATH):
-        return []
-
-    try:
-        with open(CONVERSATION_STORE_PATH, 'r', encoding='utf-8') as f:
-            data = json.load(f)
-            return data.get(chat_id, [])
-    except json.JSONDecodeError:
-        print("❌ conversation_store.json corrupto")
-        return []
+    return CONVERSATION_STORE.get(chat_id)
 
 
 def save_conversation(chat_id: str, conversation):
-    os.makedirs(os.path.dirname(CONVERSATION_STORE_PATH), exist_ok=True)
-
-    try:
-        with open(CONVERSATION_STORE_PATH, 'r', encoding='utf-8') as f:
-            data = json.load(f)
-            if not isinstance(data, dict):
-                data = {}
-    except Exception:
-        data = {}
-
-    data[chat_id] = conversation
-
-    tmp_path = CONVERSATION_STORE_PATH + ".tmp"
-    with open(tmp_path, 'w', encoding='utf-8') as f:
-        json.dump(data, f, indent=4, ensure_ascii=False)
-
-    os.replace(tmp_path, CONVERSATION_STORE_PATH)
+    CONVERSATION_STORE.put(chat_id, conversation)
 
 def delete_converation_cache():
-    if os.path.exists(KB_PATH):
-        with open(KB_PATH + 'conversation_store.json', 'w') as f:
-            json.dump({}, f, indent=4, ensure_ascii=False)
+    removed = CONVERSATION_STORE.clear()
+    print(f"{removed} conversations removed from the conversation store.")
 
 def delete_conversation_cache_user(user=None):
     if user:
-        conversation_file_path = os.path.join(KB_PATH, 'conversation_store.json')
-        if os.path.exists(conversation_file_path):
-            try:
-                with open(conversation_file_path, 'r') as f:
-                    conversation_data = json.load(f)
-            except json.JSONDecodeError:
-                conversation_data = {}
-            if user in conversation_data:
-                del conversation_data[user]
-                with open(conversation_file_path, 'w') as f:
-                    json.dump(conversation_data, f, indent=4, ensure_ascii=False)  # Using indent for readability
-                print(f"User '{user}' conversation data removed successfully.")
-                return True
-            else:
-                print(f"User '{user}' not found in conversation cache.")
-                return False
+        # El contexto de embeddings del modo generativo también se olvida.
+        CONTEXT_STORE.forget(user)
+        if CONVERSATION_STORE.delete(user):
+            print(f"User '{user}' conversation data removed successfully.")
+            return True
         else:
-            print("Conversation store file does not exist.")
+            print(f"User '{user}' not found in conversation cache.")
             return False
     else:
         print("No user specified for deletion.")
@@ -0,0 +1,212 @@
+import os
+import time
+from typing import Optional, Tuple
+
+import numpy as np
+
+from app.config import (
+    EMBEDDING_STORAGE_DTYPE,
+    EMBEDDING_REDUCED_DIM,
+    EMBEDDING_REDUCTION,
+    VECTOR_INDEX_TYPE,
+    VECTOR_INDEX_MIN_SIZE,
+    IVF_NLIST,
+    IVF_NPROBE,
+    IVF_TRAIN_ITERATIONS
+)
+from app.services.compact_embeddings import CompactEmbeddings
+
+"""
+Índices vectoriales para los embeddings de la KB.
+- FlatIndex: búsqueda exacta por producto escalar (la de siempre).
+- IVFIndex: índice invertido sobre centroides k-means; solo se puntúan los vectores
+  de las nprobe listas más cercanas a la consulta. Se persiste en un .npz.
+Ambos índices puntúan sobre CompactEmbeddings (float32, float16 o int8, con reducción
+de dimensión opcional); en float32 sin reducción no se copia la matriz de la KB.
+"""
+
+
+def top_k_indices(scores: np.ndarray, k: int) -> np.ndarray:
+    """Posiciones de los k mayores scores, de mayor a menor, sin ordenar el array entero."""
+    k = min(k, len(scores))
+    if k <= 0:
+        return np.empty(0, dtype=np.int64)
+    if k < len(scores):
+        top = np.argpartition(-scores, k - 1)[:k]
+    else:
+        top = np.arange(len(scores))
+    return top[np.argsort(-scores[top], kind="stable")]
+
+
+class FlatIndex:
+    exact = True
+
+    def __init__(self, store: CompactEmbeddings):
+        self.store = store
+
+    def __len__(self) -> int:
+        return len(self.store)
+
+    def search(self, query: np.ndarray, k: int, nprobe: Optional[int] = None) -> Tuple[np.ndarray, np.ndarray]:
+        scores = self.store.score(query)
+        top = top_k_indices(scores, k)
+        return top, scores[top]
+
+    def splice(self, start: int, stop: int, vectors: np.ndarray, fingerprint: str = "") -> "FlatIndex":
+        """Copia con los vectores start:stop sustituidos por `vectors`."""
+        return FlatIndex(self.store.splice(start, stop, vectors))
+
+
+class IVFIndex:
+    exact = False
+
+    def __init__(self, store: CompactEmbeddings, centroids: np.ndarray, order: np.ndarray, offsets: np.ndarray,
+                 nprobe: int = IVF_NPROBE, fingerprint: str = ""):
+        self.store = store
+        self.centroids = centroids
+        self.order = order
+        self.offsets = offsets
+        self.nprobe = nprobe
+        self.fingerprint = fingerprint
+
+    def __len__(self) -> int:
+        return len(self.store)
+
+    @classmethod
+    def train(cls, store: CompactEmbeddings, nlist: int = IVF_NLIST, nprobe: int = IVF_NPROBE,
+              iterations: int = IVF_TRAIN_ITERATIONS, fingerprint: str = "", seed: int = 0) -> "IVFIndex":
+        # Los centroides viven en el espacio almacenado (reducido si hay PCA/truncado).
+        n_vectors = len(store)
+        if nlist <= 0:
+            nlist = int(4 * np.sqrt(n_vectors))
+        nlist = max(1, min(nlist, n_vectors))
+
+        rng = np.random.default_rng(seed)
+        sample_size = min(n_vectors, nlist * 64)
+        sample = np.asarray(store.decode(np.sort(rng.choice(n_vectors, sample_size, replace=False))), dtype=np.float32)
+        centroids = sample[rng.choice(sample_size, nlist, replace=False)].copy()
+
+        for _ in range(iterations):
+            assignment = cls._assign(sample, centroids)
+            sums = np.zeros_like(centroids)
+            np.add.at(sums, assignment, sample)
+            counts = np.bincount(assignment, minlength=nlist)
+            empty = counts == 0
+            centroids[~empty] = sums[~empty] / counts[~empty, None]
+            if empty.any():
+                # Las listas vacías se vuelven a sembrar con puntos aleatorios de la muestra.
+                centroids[empty] = sample[rng.choice(sample_size, int(empty.sum()), replace=False)]
+
+        assignment = np.empty(n_vectors, dtype=np.int64)
+        for start in range(0, n_vectors, 8192):
+            block = np.asarray(store.decode(slice(start, start + 8192)), dtype=np.float32)
+            assignment[start:start + 8192] = np.argmax(block @ centroids.T, axis=1)
+        order = np.argsort(assignment, kind="stable").astype(np.int64)
+        offsets = np.searchsorted(assignment[order], np.arange(nlist + 1)).astype(np.int64)
+        return cls(store, centroids, order, offsets, nprobe=nprobe, fingerprint=fingerprint)
+
+    @staticmethod
+    def _assign(vectors: np.ndarray, centroids: np.ndarray, chunk: int = 8192) -> np.ndarray:
+        assignment = np.empty(vectors.shape[0], dtype=np.int64)
+        for start in range(0, vectors.shape[0], chunk):
+            block = vectors[start:start + chunk]
+            assignment[start:start + chunk] = np.argmax(block @ centroids.T, axis=1)
+        return assignment
+
+    def splice(self, start: int, stop: int, vectors: np.ndarray, fingerprint: str = "") -> "IVFIndex":
+        """
+        Copia con los vectores start:stop sustituidos por `vectors`. Los nuevos van a la lista
+        de su centroide más cercano; los centroides no se reentrenan (se hace en la siguiente
+        construcción completa).
+        """
+        store = self.store.splice(start, stop, vectors)
+        assignment = np.empty(len(self.store), dtype=np.int64)
+        assignment[self.order] = np.repeat(np.arange(len(self.centroids)), np.diff(self.offsets))
+        count = len(store) - len(self.store) + (stop - start)
+        added = self._assign(np.asarray(store.decode(slice(start, start + count)), dtype=np.float32), self.centroids)
+        assignment = np.concatenate([assignment[:start], added, assignment[stop:]])
+        order = np.argsort(assignment, kind="stable").astype(np.int64)
+        offsets = np.searchsorted(assignment[order], np.arange(len(self.centroids) + 1)).astype(np.int64)
+        return IVFIndex(store, self.centroids, order, offsets, nprobe=self.nprobe, fingerprint=fingerprint or self.fingerprint)
+
+    def search(self, query: np.ndarray, k: int, nprobe: Optional[int] = None) -> Tuple[np.ndarray, np.ndarray]:
+        nprobe = min(nprobe or self.nprobe, len(self.centroids))
+
+        projected, offset = self.store.project(query)
+        probe = top_k_indices(self.centroids @ projected, nprobe)
+        candidates = np.concatenate([self.order[self.offsets[c]:self.offsets[c + 1]] for c in probe])
+        if len(candidates) < k:
+            return FlatIndex(self.store).search(query, k)
+
+        scores = self.store.score_projected(projected, candidates) + offset
+        top = top_k_indices(scores, k)
+        return candidates[top], scores[top]
+
+    def save(self, path: str) -> None:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = path + ".tmp"
+        with open(tmp_path, "wb") as f:
+            np.savez(
+                f,
+                centroids=self.centroids,
+                order=self.order,
+                offsets=self.offsets,
+                fingerprint=np.array(self.fingerprint),
+                count=np.array(len(self))
+            )
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path: str, store: CompactEmbeddings, fingerprint: str, nprobe: int = IVF_NPROBE) -> Optional["IVFIndex"]:
+        if not os.path.exists(path):
+            return None
+        try:
+            with np.load(path) as data:
+                if str(data["fingerprint"]) != fingerprint or int(data["count"]) != len(store):
+                    return None
+                if data["centroids"].shape[1] != store.shape[1]:
+                    return None
+                return cls(store, data["centroids"], data["order"], data["offsets"],
+                           nprobe=nprobe, fingerprint=fingerprint)
+        except Exception as e:
+            print(f"Error loading vector index {path}: {e}")
+            return None
+
+
+def build_vector_index(matrix: np.ndarray, path: Optional[str] = None, fingerprint: str = "",
+                       kind: str = VECTOR_INDEX_TYPE):
+    """
+    Devuelve el índice configurado para la matriz. Por debajo de VECTOR_INDEX_MIN_SIZE
+    vectores siempre se usa la búsqueda exacta. Si hay un índice IVF persistido con la
+    misma huella (mismos vectores y mismo formato compacto) se reutiliza.
+    """
+    store = CompactEmbeddings.from_matrix(matrix)
+    if store.storage_dtype != "float32" or store.reduction:
+        print(
+            f"KB embeddings stored as {store.storage_dtype}"
+            f"{f' ({store.reduction} to {store.shape[1]} dims)' if store.reduction else ''}: "
+            f"{store.nbytes / (1024 * 1024):.1f} MB."
+        )
+
+    if kind == "flat" or len(store) < VECTOR_INDEX_MIN_SIZE:
+        return FlatIndex(store)
+
+    if kind != "ivf":
+        print(f"Unknown VECTOR_INDEX_TYPE '{kind}', using exact search.")
+        return FlatIndex(store)
+
+    fingerprint = f"{fingerprint}|{EMBEDDING_STORAGE_DTYPE}|{EMBEDDING_REDUCED_DIM}|{EMBEDDING_REDUCTION}"
+    if path:
+        index = IVFIndex.load(path, store, fingerprint)
+        if index is not None:
+            return index
+
+    start = time.time()
+    index = IVFIndex.train(store, fingerprint=fingerprint)
+    print(f"IVF index trained in {time.time() - start:.2f} seconds ({len(index.centroids)} lists, {len(index)} vectors).")
+    if path:
+        try:
+            index.save(path)
+        except Exception as e:
+            print(f"Error saving vector index {path}: {e}")
+    return index
@@ -0,0 +1,111 @@
+import asyncio
+import threading
+import time
+import traceback
+from typing import Any, Dict, Optional
+
+from app.services import metrics
+
+"""
+Calentamiento en segundo plano del backend.
+Importar la app ya no carga torch, los modelos ni la KB: el servidor acepta conexiones
+enseguida y este módulo prepara, en un hilo aparte, todo lo que necesita el grafo.
+/healthz y /readyz consultan su estado; las peticiones que llegan antes de estar listo
+esperan como mucho WARMUP_WAIT_SECONDS y después reciben un 503.
+"""
+
+STAGES = ["imports", "generative_kb", "hybrid_kb", "support_graph"]
+
+_lock = threading.Lock()
+_ready = threading.Event()
+_thread: Optional[threading.Thread] = None
+_graph = None
+_state: Dict[str, Any] = {
+    "status": "pending",
+    "stage": None,
+    "stages": {},
+    "started_at": None,
+    "ready_at": None,
+    "error": None
+}
+
+
+def _run_stage(name: str, fn):
+    with _lock:
+        _state["stage"] = name
+    start = time.time()
+    result = fn()
+    elapsed = time.time() - start
+    with _lock:
+        _state["stages"][name] = round(elapsed, 3)
+    metrics.set_gauge("warmup_stage_seconds", elapsed, stage=name)
+    print(f"Warm-up stage '{name}' completed in {elapsed:.2f} seconds.")
+    return result
+
+
+def _import_modules():
+    from app.services import KnowledgeBaseFiltering, hybrid_search
+    from app.agents import support_graph
+    return KnowledgeBaseFiltering, hybrid_search, support_graph
+
+
+def _warm_up() -> None:
+    global _graph
+    try:
+        kbf, hybrid_search, support_graph = _run_stage("imports", _import_modules)
+        _run_stage("generative_kb", lambda: kbf.initialize_model_and_kb(kbf.EMBEDDING_CACHE_FILE))
+        _run_stage("hybrid_kb", hybrid_search.initialize_hybrid_search)
+        _graph = _run_stage("support_graph", support_graph.build_support_graph)
+    except Exception as e:
+        traceback.print_exc()
+        with _lock:
+            _state["status"] = "failed"
+            _state["error"] = str(e)
+        metrics.inc("warmup_failures")
+        return
+
+    with _lock:
+        _state["status"] = "ready"
+        _state["stage"] = None
+        _state["ready_at"] = time.time()
+        total = _state["ready_at"] - _state["started_at"]
+    metrics.set_gauge("warmup_seconds", total)
+    print(f"Backend ready in {total:.2f} seconds.")
+    _ready.set()
+
+
+def start() -> None:
+    """Lanza el calentamiento una sola vez (idempotente)."""
+    global _thread
+    with _lock:
+        if _thread is not None:
+            return
+        _state["status"] = "warming"
+        _state["started_at"] = time.time()
+        _thread = threading.Thread(target=_warm_up, name="warmup", daemon=True)
+    _thread.start()
+
+
+def is_ready() -> bool:
+    return _ready.is_set()
+
+
+def status() -> Dict[str, Any]:
+    with _lock:
+        state = dict(_state, stages=dict(_state["stages"]))
+    state["completed"] = [stage for stage in STAGES if stage in state["stages"]]
+    state["progress"] = len(state["completed"]) / len(STAGES)
+    if state["started_at"] is not None:
+        state["elapsed_seconds"] = round((state["ready_at"] or time.time()) - state["started_at"], 3)
+    return state
+
+
+async def wait_until_ready(timeout: float) -> bool:
+    """Espera sin bloquear el event loop a que termine el calentamiento."""
+    if _ready.is_set() or timeout <= 0:
+        return _ready.is_set()
+    return await asyncio.to_thread(_ready.wait, timeout)
+
+
+def get_graph():
+    return _graph